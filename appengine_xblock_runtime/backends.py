@@ -0,0 +1,372 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage backends for running the XBlock runtime without the datastore.
+
+The classes in this module implement the XBlock KeyValueStore, IdReader and
+IdGenerator interfaces over a simple Backend interface instead of ndb, using
+the same key_string() keying as the datastore classes. An in-memory and a
+SQLite backend are provided. They allow the runtime to be benchmarked and
+profiled locally without the App Engine testbed, and to be run in workers
+outside App Engine. Nothing in this module depends on App Engine.
+
+KeyValueStore shares its snapshot, write buffering and conflict detection
+with store.KeyValueStore, through base.BufferedKeyValueStore, and records the
+same operations in its stats. The layers which are specific to the datastore
+are not modelled: the cache policy, sharded counters and field groups. A
+benchmark over a backend therefore measures the runtime, the shared store
+logic and the pattern of storage calls, but not those layers.
+"""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+import base
+
+import xblock.exceptions
+import xblock.runtime
+
+
+# The tables used by the classes in this module.
+KEY_VALUE_TABLE = 'key_value'
+USAGE_TABLE = 'usage'
+DEFINITION_TABLE = 'definition'
+
+# Stands for the value of a key which is absent.
+ABSENT = object()
+
+
+class Backend(object):
+    """A store of JSON-serializable values held under string keys in tables."""
+
+    def get_multi(self, table, keys):
+        """Retrieve the values of several keys.
+
+        Args:
+            table: str. The name of the table.
+            keys: iterable of str. The keys being retrieved.
+
+        Returns:
+            dict. Maps each key which is present to its value.
+        """
+        raise NotImplementedError()
+
+    def write_multi(self, table, puts, deletes, expected=None):
+        """Atomically store and delete several keys.
+
+        Args:
+            table: str. The name of the table.
+            puts: dict. Maps keys to the values to be stored.
+            deletes: iterable of str. The keys to be deleted.
+            expected: dict. Maps keys to the value they must currently hold,
+                or to ABSENT if they must be absent.
+
+        Raises:
+            base.ContentionError: If a key does not hold its expected value.
+                Nothing is written in this case.
+        """
+        raise NotImplementedError()
+
+
+class MemoryBackend(Backend):
+    """A backend which holds its tables in memory.
+
+    Values are held serialized, so that readers never share objects with each
+    other or with writers.
+    """
+
+    def __init__(self):
+        self._tables = collections.defaultdict(dict)
+        self._lock = threading.Lock()
+
+    def get_multi(self, table, keys):
+        with self._lock:
+            rows = self._tables[table]
+            return dict(
+                (key, json.loads(rows[key])) for key in keys if key in rows)
+
+    def write_multi(self, table, puts, deletes, expected=None):
+        encoded = dict(
+            (key, json.dumps(value)) for key, value in puts.iteritems())
+        with self._lock:
+            rows = self._tables[table]
+            for key, value in (expected or {}).iteritems():
+                current = json.loads(rows[key]) if key in rows else ABSENT
+                if current != value:
+                    raise base.ContentionError(key)
+            rows.update(encoded)
+            for key in deletes:
+                rows.pop(key, None)
+
+
+class SqliteBackend(Backend):
+    """A backend which holds its tables in a SQLite database."""
+
+    # SQLite limits the number of parameters in a single statement.
+    _BATCH_SIZE = 500
+
+    def __init__(self, path=':memory:'):
+        """Initialize the backend.
+
+        Args:
+            path: str. The path of the database file, or ':memory:' for a
+                private in-memory database.
+        """
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS rows ('
+            'tbl TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (tbl, key))')
+
+    def _select(self, table, keys):
+        keys = list(keys)
+        values = {}
+        for start in xrange(0, len(keys), self._BATCH_SIZE):
+            batch = keys[start:start + self._BATCH_SIZE]
+            cursor = self._connection.execute(
+                'SELECT key, value FROM rows WHERE tbl = ? AND key IN (%s)' %
+                ','.join(['?'] * len(batch)), [table] + batch)
+            values.update((key, json.loads(value)) for key, value in cursor)
+        return values
+
+    def get_multi(self, table, keys):
+        with self._lock:
+            return self._select(table, keys)
+
+    def write_multi(self, table, puts, deletes, expected=None):
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                if expected:
+                    current = self._select(table, expected.keys())
+                    for key, value in expected.iteritems():
+                        if current.get(key, ABSENT) != value:
+                            raise base.ContentionError(key)
+                self._connection.executemany(
+                    'INSERT OR REPLACE INTO rows (tbl, key, value) '
+                    'VALUES (?, ?, ?)',
+                    [(table, key, json.dumps(value))
+                     for key, value in puts.iteritems()])
+                self._connection.executemany(
+                    'DELETE FROM rows WHERE tbl = ? AND key = ?',
+                    [(table, key) for key in deletes])
+            except:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+
+class KeyValueStore(base.BufferedKeyValueStore):
+    """Implementation of XBlock KeyValueStore over a storage backend.
+
+    Like store.KeyValueStore, this is request-scoped. It keeps a snapshot of
+    the values it has read, can prefetch values in batch, and can buffer
+    writes and flush them in one batch, optionally checking for conflicting
+    writes. The snapshot, the pending writes and the originals are keyed by
+    key string, and hold values, or ABSENT for keys which are absent.
+    """
+
+    def __init__(self, backend, stats=None, write_listeners=()):
+        """Initialize the store.
+
+        Args:
+            backend: Backend. The backend holding the values.
+            stats: instrumentation.RequestStats. Records the operations made
+                by the store. A runtime sets this to its own stats if none
+                are given.
+            write_listeners: iterable of callable. Each is called with a list
+                of the xblock.runtime.KeyValueStore.Key which were written,
+                after they are written.
+        """
+        super(KeyValueStore, self).__init__(
+            stats=stats, write_listeners=write_listeners)
+        self._backend = backend
+
+    def _load(self, key_strings):
+        missing = [ks for ks in key_strings if ks not in self._snapshot]
+        if not missing:
+            return
+        start = time.time()
+        values = self._backend.get_multi(KEY_VALUE_TABLE, missing)
+        self.stats.record(
+            'datastore_get', latency=time.time() - start, items=len(missing))
+        for ks in missing:
+            value = values.get(ks, ABSENT)
+            self._snapshot[ks] = value
+            self._originals.setdefault(ks, value)
+
+    def _write(self, puts, deletes, expected=None):
+        start = time.time()
+        self._backend.write_multi(KEY_VALUE_TABLE, puts, deletes, expected)
+        if puts:
+            self.stats.record(
+                'datastore_put', latency=time.time() - start, items=len(puts))
+        if deletes:
+            self.stats.record(
+                'datastore_delete', latency=time.time() - start,
+                items=len(deletes))
+        self._forget_written(puts.keys() + list(deletes))
+
+    def flush(self, transactional=False):
+        """Write all buffered sets and deletes, and leave buffered mode.
+
+        Args:
+            transactional: bool. Whether to check that none of the keys being
+                written have changed since they were read.
+
+        Raises:
+            base.ContentionError: If transactional, and a key being written
+                has been changed since it was read by this store.
+        """
+        puts, deletes, written_keys = self._take_pending()
+        expected = None
+        if transactional:
+            expected = self._expected(puts.keys() + deletes)
+        self._write(puts, deletes, expected=expected)
+        self._notify(written_keys)
+
+    def prefetch(self, keys):
+        """Load the given keys into the snapshot with a single batch read."""
+        missing = set(
+            base.key_string(key) for key in keys
+            if base.key_string(key) not in self._snapshot)
+        if not missing:
+            return
+        start = time.time()
+        self._load(missing)
+        self.stats.record(
+            'prefetch', latency=time.time() - start, items=len(missing))
+
+    def get_many(self, keys):
+        """Retrieve the values of several keys, omitting absent ones."""
+        self.prefetch(keys)
+        values = {}
+        for key in keys:
+            value = self._snapshot[base.key_string(key)]
+            if value is not ABSENT:
+                values[key] = value
+        return values
+
+    def get(self, key):
+        start = time.time()
+        ks = base.key_string(key)
+        self._load([ks])
+        value = self._snapshot[ks]
+        if value is ABSENT:
+            self.stats.record('get', key.scope, latency=time.time() - start)
+            raise KeyError()
+        self.stats.record(
+            'get', key.scope, latency=time.time() - start,
+            payload_bytes=self.stats.payload_size(value))
+        return value
+
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    def set_many(self, update_dict):
+        start = time.time()
+        puts = dict(
+            (base.key_string(key), value)
+            for key, value in update_dict.iteritems())
+        self._snapshot.update(puts)
+        if self.buffering:
+            self._pending.update(puts)
+        else:
+            self._write(puts, [])
+        for key, value in update_dict.iteritems():
+            self._written(key)
+            self.stats.record(
+                'set', key.scope, latency=time.time() - start,
+                payload_bytes=self.stats.payload_size(value))
+
+    def delete(self, key):
+        start = time.time()
+        ks = base.key_string(key)
+        self._snapshot[ks] = ABSENT
+        if self.buffering:
+            self._pending[ks] = base.DELETED
+        else:
+            self._write({}, [ks])
+        self._written(key)
+        self.stats.record('delete', key.scope, latency=time.time() - start)
+
+    def has(self, key):
+        start = time.time()
+        ks = base.key_string(key)
+        self._load([ks])
+        self.stats.record('has', key.scope, latency=time.time() - start)
+        return self._snapshot[ks] is not ABSENT
+
+
+class IdReader(xblock.runtime.IdReader):
+    """Implementation of XBlock IdReader over a storage backend."""
+
+    def __init__(self, backend):
+        super(IdReader, self).__init__()
+        self._backend = backend
+
+    def get_definition_ids(self, usage_ids):
+        """Retrieve the definition ids of several usages in one batch."""
+        usage_ids = [str(usage_id) for usage_id in usage_ids]
+        rows = self._backend.get_multi(USAGE_TABLE, usage_ids)
+        for usage_id in usage_ids:
+            if usage_id not in rows:
+                raise xblock.exceptions.NoSuchUsage(usage_id)
+        return [rows[usage_id] for usage_id in usage_ids]
+
+    def get_block_types(self, def_ids):
+        """Retrieve the block types of several definitions in one batch."""
+        def_ids = [str(def_id) for def_id in def_ids]
+        rows = self._backend.get_multi(DEFINITION_TABLE, def_ids)
+        for def_id in def_ids:
+            if def_id not in rows:
+                raise xblock.exceptions.NoSuchDefinition(def_id)
+        return [rows[def_id] for def_id in def_ids]
+
+    def get_definition_id(self, usage_id):
+        """Retrieve the definition id to which this usage id is bound."""
+        return self.get_definition_ids([usage_id])[0]
+
+    def get_block_type(self, def_id):
+        """Retrieve the block type to which this definition is bound."""
+        return self.get_block_types([def_id])[0]
+
+
+class IdGenerator(xblock.runtime.IdGenerator):
+    """Implementation of XBlock IdGenerator over a storage backend."""
+
+    def __init__(self, backend):
+        super(IdGenerator, self).__init__()
+        self._backend = backend
+
+    def create_usage(self, def_id):
+        """Create a new usage id bound to the given definition id."""
+        assert self._backend.get_multi(DEFINITION_TABLE, [str(def_id)])
+        usage_id = base.generate_id()
+        self._backend.write_multi(USAGE_TABLE, {usage_id: str(def_id)}, [])
+        return usage_id
+
+    def create_definition(self, block_type):
+        """Create a new definition id, bound to the given block type."""
+        definition_id = base.generate_id()
+        self._backend.write_multi(
+            DEFINITION_TABLE, {definition_id: block_type}, [])
+        return definition_id
@@ -0,0 +1,156 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Storage classes shared by the datastore and the local storage backends.
+
+Nothing in this module depends on App Engine, so that the backends module can
+be used outside it.
+"""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import uuid
+
+import instrumentation
+
+from xblock.fields import Scope
+import xblock.runtime
+
+
+# Stands for a value which is to be deleted.
+DELETED = object()
+
+
+def generate_id():
+    return uuid.uuid4().hex
+
+
+class ContentionError(Exception):
+    """A value was changed by another request since it was read."""
+
+
+def key_string(key):
+    key_list = []
+    if key.scope == Scope.children:
+        key_list.append('children')
+    elif key.scope == Scope.parent:
+        key_list.append('parent')
+    else:
+        key_list.append(
+            ['usage', 'definition', 'type', 'all'][key.scope.block])
+
+    if key.block_scope_id is not None:
+        key_list.append(key.block_scope_id)
+    if key.user_id:
+        key_list.append(key.user_id)
+    key_list.append(key.field_name)
+    return '.'.join(key_list)
+
+
+class BufferedKeyValueStore(xblock.runtime.KeyValueStore):
+    """The request-scoped state of a key value store.
+
+    Holds the snapshot of the values the store has read, the writes gathered
+    in buffered mode, and the value first read of each row, against which a
+    transactional flush checks for conflicting writes. Subclasses choose what
+    a row is and how its value is held: store.KeyValueStore holds entities
+    under ndb keys, and backends.KeyValueStore holds values under key strings.
+    """
+
+    def __init__(self, stats=None, write_listeners=()):
+        """Initialize the store.
+
+        Args:
+            stats: instrumentation.RequestStats. Records the operations made
+                by the store. A runtime sets this to its own stats if none
+                are given.
+            write_listeners: iterable of callable. Each is called with a list
+                of the xblock.runtime.KeyValueStore.Key which were written,
+                after they are written.
+        """
+        super(BufferedKeyValueStore, self).__init__()
+        self.stats = stats or instrumentation.NULL_STATS
+        self._write_listeners = list(write_listeners)
+        # Maps key strings to the current value, as held by the subclass.
+        self._snapshot = {}
+        # Maps rows to the value to be written, or to DELETED if the row is to
+        # be deleted. Only used in buffered mode.
+        self._pending = {}
+        # The keys set or deleted in buffered mode, for the write listeners.
+        self._written_keys = []
+        # Maps rows to the value which was first read from storage. Used to
+        # detect conflicting writes.
+        self._originals = {}
+        self.buffering = False
+
+    def reset(self):
+        """Forget all loaded and buffered state, and leave buffered mode."""
+        self._snapshot = {}
+        self._originals = {}
+        self._clear_pending()
+
+    def _clear_pending(self):
+        self._pending = {}
+        self._written_keys = []
+        self.buffering = False
+
+    def _notify(self, keys):
+        if keys:
+            for listener in self._write_listeners:
+                listener(keys)
+
+    def _written(self, key):
+        if self.buffering:
+            self._written_keys.append(key)
+        else:
+            self._notify([key])
+
+    def _take_pending(self):
+        """Return the buffered writes, and leave buffered mode.
+
+        Returns:
+            (dict, list, list). Maps the rows to be written to their values,
+            the rows to be deleted, and the keys to pass to the write
+            listeners once the rows are written.
+        """
+        puts = {}
+        deletes = []
+        for row, value in self._pending.iteritems():
+            if value is DELETED:
+                deletes.append(row)
+            else:
+                puts[row] = value
+        written_keys = self._written_keys
+        self._clear_pending()
+        return puts, deletes, written_keys
+
+    def _expected(self, rows):
+        """Return the values first read of those of the rows which were read."""
+        return dict(
+            (row, self._originals[row]) for row in rows
+            if row in self._originals)
+
+    def _forget_written(self, rows):
+        """Drop the originally read values of rows which have been written."""
+        for row in rows:
+            self._originals.pop(row, None)
+
+    def start_buffering(self):
+        """Gather subsequent writes in memory until flush() is called."""
+        self.buffering = True
+
+    def discard(self):
+        """Drop all buffered writes, and leave buffered mode."""
+        self._snapshot = {}
+        self._clear_pending()
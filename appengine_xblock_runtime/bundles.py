@@ -0,0 +1,236 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Deduplication and bundling of the JavaScript and CSS of fragments."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import hashlib
+import re
+import urlparse
+
+import cache
+
+from xblock.fragment import FragmentResource
+
+from google.appengine.ext import ndb
+
+
+# The file extensions of the bundles of each mimetype which can be bundled.
+BUNDLE_EXTENSIONS = {
+    'application/javascript': '.js',
+    'text/javascript': '.js',
+    'text/css': '.css'}
+
+# Separates the resources in a bundle. The semicolon ends any JavaScript
+# statement left open by the resource before.
+_SEPARATORS = {'.js': ';\n', '.css': '\n'}
+
+# Matches the URLs referred to by CSS, in url() or in an @import string.
+_CSS_URL_RE = re.compile(
+    r'''url\(\s*(['"]?)([^'")\s]+)\1\s*\)|@import\s+(['"])([^'"]+)\3''')
+
+
+def _is_relative(ref):
+    return not (urlparse.urlparse(ref).scheme or ref.startswith(('/', '#')))
+
+
+def _resolve_css_urls(body, base_url):
+    """Return a stylesheet with its relative URLs resolved against base_url.
+
+    Args:
+        body: str. The stylesheet.
+        base_url: str. The URL the stylesheet was loaded from, or None if it
+            was inline in the page.
+
+    Returns:
+        str, or None if base_url is None and the stylesheet has relative URLs,
+        which resolve against the page and so cannot be moved to a bundle.
+    """
+    unresolved = []
+
+    def resolve(match):
+        group = 2 if match.group(2) is not None else 4
+        ref = match.group(group)
+        if not _is_relative(ref):
+            return match.group(0)
+        if base_url is None:
+            unresolved.append(ref)
+            return match.group(0)
+        start = match.start(group) - match.start()
+        end = match.end(group) - match.start()
+        return '%s%s%s' % (
+            match.group(0)[:start], urlparse.urljoin(base_url, ref),
+            match.group(0)[end:])
+
+    body = _CSS_URL_RE.sub(resolve, body)
+    return None if unresolved else body
+
+
+def dedupe_resources(resources):
+    """Return the resources without repeats, keeping the first of each.
+
+    Args:
+        resources: list of xblock.fragment.FragmentResource.
+
+    Returns:
+        list of xblock.fragment.FragmentResource.
+    """
+    seen = set()
+    unique = []
+    for resource in resources:
+        if resource not in seen:
+            seen.add(resource)
+            unique.append(resource)
+    return unique
+
+
+class ResourceBundleEntity(ndb.Model):
+    """The body of a bundle, keyed by the MD5 hash of the body."""
+    mimetype = ndb.StringProperty(indexed=False)
+    body = ndb.BlobProperty(compressed=True)
+
+
+class ResourceBundler(object):
+    """Combines the JavaScript and CSS of a block type into bundles.
+
+    process() replaces the inline JavaScript and CSS of a fragment, and the
+    URLs of those which load_url can read, with the URL of a bundle holding
+    their combined text. Only runs of resources with the same mimetype and
+    placement, not broken by a resource which cannot be bundled, are combined,
+    so that the order in which the browser loads them is kept.
+
+    Bundles are named by the hash of their body, and so never change and may
+    be cached by browsers indefinitely. They are stored in the datastore,
+    through ndb's memcache, so that pages and fragments which refer to them
+    stay valid, and are held in an in-process cache once read or written.
+
+    A bundle is served from a different URL than the stylesheets it holds,
+    so relative URLs in CSS read through load_url are rewritten against the
+    URL of the original stylesheet. Inline CSS with relative URLs, which
+    resolve against the page, is left in place.
+    """
+
+    def __init__(self, url_prefix='/bundle/', load_url=None, local_cache=None):
+        """Initialize the bundler.
+
+        Args:
+            url_prefix: str. The path under which the bundles are served.
+            load_url: callable. Called with the URL of a resource, returns its
+                body as a str, or None if it cannot be read, in which case
+                the URL is left in place. If not given, no URLs are bundled.
+            local_cache: cache.LRUCache. The in-process cache of bundles.
+                Defaults to a new cache of 200 bundles.
+        """
+        self._url_prefix = url_prefix
+        self._load_url = load_url
+        self._local_cache = (
+            cache.LRUCache(max_size=200) if local_cache is None
+            else local_cache)
+
+    def _resource_body(self, resource):
+        if resource.mimetype not in BUNDLE_EXTENSIONS:
+            return None
+        if resource.kind == 'text':
+            body = resource.data
+        elif resource.kind == 'url' and self._load_url is not None:
+            body = self._load_url(resource.data)
+        else:
+            return None
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        if body is not None and resource.mimetype == 'text/css':
+            body = _resolve_css_urls(
+                body, resource.data if resource.kind == 'url' else None)
+        return body
+
+    def _store(self, bundles):
+        """Store the bundles which are not known to be stored already.
+
+        Args:
+            bundles: dict. Maps bundle ids to (body, mimetype).
+        """
+        missing = [
+            bundle_id for bundle_id in bundles
+            if self._local_cache.get(bundle_id) is None]
+        if not missing:
+            return
+        keys = [ndb.Key(ResourceBundleEntity, bundle_id)
+                for bundle_id in missing]
+        new_entities = []
+        for key, entity in zip(keys, ndb.get_multi(keys)):
+            if entity is None:
+                body, mimetype = bundles[key.id()]
+                new_entities.append(ResourceBundleEntity(
+                    key=key, mimetype=mimetype, body=body))
+        ndb.put_multi(new_entities)
+        for bundle_id in missing:
+            self._local_cache.put(bundle_id, bundles[bundle_id])
+
+    def process(self, block_type, resources):
+        """Deduplicate resources and bundle those which can be bundled.
+
+        Args:
+            block_type: str. The type of the block whose resources these are,
+                which is named in the URLs of the bundles.
+            resources: list of xblock.fragment.FragmentResource.
+
+        Returns:
+            list of xblock.fragment.FragmentResource.
+        """
+        result = []
+        # Each run is a tuple of its index in result, its first resource and
+        # the bodies of its resources.
+        runs = []
+        # Maps (mimetype, placement) to the run which is open for them.
+        open_runs = {}
+        for resource in dedupe_resources(resources):
+            group = (resource.mimetype, resource.placement)
+            body = self._resource_body(resource)
+            if body is None:
+                open_runs.pop(group, None)
+                result.append(resource)
+            elif group in open_runs:
+                open_runs[group][2].append(body)
+            else:
+                run = (len(result), resource, [body])
+                open_runs[group] = run
+                runs.append(run)
+                result.append(None)
+        if not runs:
+            return result
+
+        bundles = {}
+        for index, first, bodies in runs:
+            extension = BUNDLE_EXTENSIONS[first.mimetype]
+            body = _SEPARATORS[extension].join(bodies)
+            bundle_id = hashlib.md5(body).hexdigest()
+            bundles[bundle_id] = (body, first.mimetype)
+            result[index] = FragmentResource(
+                'url', '%s%s/%s%s' % (
+                    self._url_prefix, block_type, bundle_id, extension),
+                first.mimetype, first.placement)
+        self._store(bundles)
+        return dedupe_resources(result)
+
+    def get(self, bundle_id):
+        """Return the (body, mimetype) of a bundle, or None if it is unknown."""
+        bundle = self._local_cache.get(bundle_id)
+        if bundle is None:
+            entity = ndb.Key(ResourceBundleEntity, bundle_id).get()
+            if entity is None:
+                return None
+            bundle = (entity.body, entity.mimetype)
+            self._local_cache.put(bundle_id, bundle)
+        return bundle
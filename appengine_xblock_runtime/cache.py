@@ -0,0 +1,94 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process caches shared between the requests served by an instance."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """A bounded, thread-safe cache which evicts the least recently used item.
+
+    Items may be given a time to live, after which they are treated as
+    absent. The cache counts hits and misses so that its effectiveness can be
+    monitored.
+    """
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Retrieve the value for the key, marking it as recently used."""
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._items[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        """Store the value, evicting the least recently used items if full.
+
+        Args:
+            key: hashable. The key of the item.
+            value: the value of the item.
+            ttl: number. The number of seconds for which the item is valid,
+                or None if it does not expire.
+        """
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """Remove the key from the cache. No-op if the key is absent."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """Remove all items and reset the counters."""
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        """Return a dict of the size, hits, misses and hit rate of the cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
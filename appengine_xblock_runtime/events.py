@@ -0,0 +1,218 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Buffering and delivery of the events published by XBlocks."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import json
+import logging
+import threading
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+
+def serialize_event(record):
+    """Encode an event record as a compact line of JSON.
+
+    Values which JSON cannot encode are written as their repr().
+    """
+    return json.dumps(record, separators=(',', ':'), default=repr)
+
+
+class EventSink(object):
+    """Delivers batches of serialized events.
+
+    Subclasses implement write_async(), which starts writing the batch and
+    returns an object with a get_result() method, or None if the write has
+    already completed.
+    """
+
+    def write_async(self, lines):
+        raise NotImplementedError()
+
+
+class LoggingSink(EventSink):
+    """Writes each event to the application log."""
+
+    def write_async(self, lines):
+        for line in lines:
+            logging.info(line)
+
+
+class FileSink(EventSink):
+    """Appends events to a local file, one per line."""
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+
+    def write_async(self, lines):
+        with self._lock:
+            with open(self._path, 'a') as events_file:
+                events_file.write(''.join(line + '\n' for line in lines))
+
+
+class EventBatchEntity(ndb.Model):
+    """A batch of events, as newline-separated lines of JSON."""
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    events = ndb.TextProperty(compressed=True)
+
+
+class DatastoreSink(EventSink):
+    """Stores each batch of events as one EventBatchEntity."""
+
+    def write_async(self, lines):
+        return EventBatchEntity(events='\n'.join(lines)).put_async()
+
+
+class TaskQueueSink(EventSink):
+    """Enqueues batches of events as the payloads of push or pull tasks.
+
+    Batches larger than a task payload are split between tasks.
+    """
+
+    # Leaves headroom under the task queue's limit of 100KB per task.
+    MAX_PAYLOAD_BYTES = 90 * 1024
+
+    def __init__(self, queue_name='default', url=None):
+        """Initialize the sink.
+
+        Args:
+            queue_name: str. The name of the queue.
+            url: str. The URL of the push handler to which the events are
+                posted, or None for a pull queue.
+        """
+        self._queue_name = queue_name
+        self._url = url
+
+    def _task(self, payload):
+        if self._url is None:
+            return taskqueue.Task(payload=payload, method='PULL')
+        return taskqueue.Task(payload=payload, url=self._url)
+
+    def write_async(self, lines):
+        tasks = []
+        chunk = []
+        size = 0
+        for line in lines:
+            if chunk and size + len(line) + 1 > self.MAX_PAYLOAD_BYTES:
+                tasks.append(self._task('\n'.join(chunk)))
+                chunk = []
+                size = 0
+            chunk.append(line)
+            size += len(line) + 1
+        if chunk:
+            tasks.append(self._task('\n'.join(chunk)))
+        return taskqueue.Queue(self._queue_name).add_async(tasks)
+
+
+class EventBuffer(object):
+    """Gathers the events of a request and writes them to a sink in batches.
+
+    Events are serialized as they are published and held until flush(), or
+    until the buffer holds max_events events or max_bytes bytes, when a write
+    of the batch is started without waiting for it. If max_pending writes are
+    already outstanding, the oldest is waited for first, so that a burst of
+    events slows the request rather than growing without bound.
+
+    A buffer is request-scoped and not thread-safe.
+    """
+
+    def __init__(
+            self, sink, max_events=500, max_bytes=256 * 1024, max_pending=2):
+        """Initialize the buffer.
+
+        Args:
+            sink: EventSink. The destination of the events.
+            max_events: int. The number of events in a full batch.
+            max_bytes: int. The serialized size of a full batch.
+            max_pending: int. The number of batch writes which may be
+                outstanding at once.
+        """
+        self._sink = sink
+        self._max_events = max_events
+        self._max_bytes = max_bytes
+        self._max_pending = max_pending
+        self._lines = []
+        self._size = 0
+        self._pending = []
+        # The number of events added since the buffer was created.
+        self._added = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def add(self, record):
+        """Add an event record, starting a write if the batch is full."""
+        line = serialize_event(record)
+        self._lines.append(line)
+        self._size += len(line)
+        self._added += 1
+        if (len(self._lines) >= self._max_events or
+                self._size >= self._max_bytes):
+            self._write_batch()
+
+    def mark(self):
+        """Return a position to which rollback() can return."""
+        return self._added
+
+    def rollback(self, position):
+        """Drop the events added since mark() which are not yet written."""
+        first_unwritten = self._added - len(self._lines)
+        drop = self._added - max(position, first_unwritten)
+        if drop > 0:
+            del self._lines[-drop:]
+            self._added -= drop
+            self._size = sum(len(line) for line in self._lines)
+
+    def _write_batch(self):
+        lines = self._lines
+        self._lines = []
+        self._size = 0
+        if len(self._pending) >= self._max_pending:
+            self._pending.pop(0).get_result()
+        result = self._sink.write_async(lines)
+        if result is not None:
+            self._pending.append(result)
+
+    def flush(self):
+        """Write all buffered events and wait for outstanding writes."""
+        if self._lines:
+            self._write_batch()
+        pending = self._pending
+        self._pending = []
+        for result in pending:
+            result.get_result()
+
+
+def event_record(block, event, user_id=None):
+    """Build the record of an event published by a block.
+
+    Args:
+        block: XBlock. The block which published the event.
+        event: dict. The event.
+        user_id: str. The id of the current user.
+
+    Returns:
+        dict. The event with the time and the ids of the user and block.
+    """
+    return {
+        'time': time.time(),
+        'user_id': user_id,
+        'usage_id': block.scope_ids.usage_id,
+        'block_type': block.scope_ids.block_type,
+        'event': event}
@@ -0,0 +1,125 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming export of XBlock trees as XML."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import re
+
+import runtime
+
+from lxml import etree
+
+
+XML_DECLARATION = "<?xml version='1.0' encoding='utf8'?>\n"
+
+# Matches the serialized stub which stands in for a child block. Attribute
+# values and text are escaped by lxml, so user content cannot match this.
+_STUB_RE = re.compile(r'<%s %s="([^"]*)"/>' % (
+    re.escape(runtime.STUB_TAG), re.escape(runtime.STUB_USAGE_ID_ATTR)))
+
+
+class StreamingExporter(object):
+    """Writes the XML of a tree of blocks to a stream as it is loaded.
+
+    The tree is loaded breadth-first in windows of about window_size blocks,
+    with one runtime.get_blocks() call per level of each window, so the
+    usages, definitions and fields of a level are read in a few batched RPCs.
+    Each block is then serialized on its own, with its children replaced by
+    stubs, and the store's snapshot is cleared. The serialized pieces are
+    written depth-first, splicing in each child's XML in place of its stub,
+    and are dropped once written. Memory therefore depends on the window size
+    rather than on the size of the tree.
+
+    The output is the same as that of Runtime.export_to_xml().
+    """
+
+    def __init__(self, xblock_runtime, window_size=500):
+        """Initialize the exporter.
+
+        Args:
+            xblock_runtime: runtime.Runtime. The runtime used to load blocks.
+            window_size: int. The approximate number of blocks to load before
+                serializing them.
+        """
+        self._runtime = xblock_runtime
+        self._window_size = window_size
+        # Maps usage ids to the serialized block, as a list alternating XML
+        # strings and the usage ids of the children between them.
+        self._pieces = {}
+
+    def _serialize(self, block):
+        node = etree.Element('unknown_root')
+        block.export_xml(node)
+        xml = etree.tostring(node, encoding='utf8', xml_declaration=False)
+        return _STUB_RE.split(xml)
+
+    def _load(self, usage_ids):
+        """Load and serialize a window of blocks, starting with usage_ids."""
+        levels = []
+        level = list(usage_ids)
+        loaded = 0
+        while level:
+            blocks = self._runtime.get_blocks(level)
+            levels.append(blocks)
+            loaded += len(blocks)
+            if loaded >= self._window_size and len(levels) > 1:
+                break
+            level = [
+                child_id for block in blocks
+                for child_id in getattr(block, 'children', [])]
+
+        # The children of the last level are not loaded, and so blocks in it
+        # which have children are left for a later window.
+        for depth, blocks in enumerate(levels):
+            for block in blocks:
+                if (depth < len(levels) - 1 or
+                        not getattr(block, 'children', None)):
+                    self._pieces[block.scope_ids.usage_id] = (
+                        self._serialize(block))
+
+        kvs = self._runtime.key_value_store
+        if kvs is not None and not kvs.buffering:
+            kvs.reset()
+
+    def _write(self, usage_id, out):
+        if usage_id not in self._pieces:
+            self._load([usage_id])
+        pieces = self._pieces.pop(usage_id)
+        missing = [
+            child_id for child_id in pieces[1::2]
+            if child_id not in self._pieces]
+        if missing:
+            self._load(missing)
+        for index, piece in enumerate(pieces):
+            if index % 2:
+                self._write(piece, out)
+            else:
+                out.write(piece)
+
+    def export(self, usage_id, out):
+        """Write the XML of the block with usage_id and its descendants.
+
+        Args:
+            usage_id: str. The usage id of the root block.
+            out: file. The stream to write the UTF-8 encoded XML to.
+        """
+        self._runtime.export_child_stubs = True
+        try:
+            out.write(XML_DECLARATION)
+            self._write(usage_id, out)
+        finally:
+            self._runtime.export_child_stubs = False
+            self._pieces = {}
@@ -0,0 +1,223 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A cache of rendered fragments for views which do not depend on the user."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import copy
+import uuid
+
+import cache
+
+from xblock.fields import Scope
+
+from google.appengine.api import memcache
+
+
+# The scopes whose values may appear in a cached fragment. Writes to these
+# change the version stamp of the block.
+STAMPED_SCOPES = frozenset([Scope.content, Scope.settings, Scope.children])
+
+_STAMP_PREFIX = 'xblock_fragment_stamp:'
+_FRAGMENT_PREFIX = 'xblock_fragment:'
+
+
+class FragmentCache(object):
+    """Caches the rendered fragments of chosen views of chosen block types.
+
+    A fragment is cached under the usage id, the view name and the version
+    stamps of the block's definition and usage. The stamps are held in
+    memcache and are replaced whenever a content, settings or children field
+    of the block is written through a KeyValueStore which has on_write() as a
+    write listener, so that later renders miss the old fragments. Fragments
+    are stored in memcache and in an in-process tier, which holds copies so
+    that callers may modify the fragments they are given.
+
+    Caching is opt-in, for (block_type, view_name) pairs whose output depends
+    only on the content and settings of the block. Blocks with children are
+    never cached, as their fragments include their children's; they are
+    re-rendered, but their cached children are not.
+
+    Where the store's cache policy holds the stamped scopes in the in-process
+    cache, another instance may render a fragment from values older than its
+    stamps, and store it under them. Fragments are therefore kept no longer
+    than those values are, so that such a fragment is served for at most the
+    in-process time to live after it is rendered.
+    """
+
+    def __init__(self, views, ttl=3600, local_cache=None, cache_policy=None):
+        """Initialize the cache.
+
+        Args:
+            views: iterable of (str, str). The (block_type, view_name) pairs
+                whose fragments are cached.
+            ttl: int. The number of seconds for which fragments are kept.
+            local_cache: cache.LRUCache. The in-process tier. Defaults to a
+                new cache of 1000 fragments.
+            cache_policy: store.CachePolicy. The cache policy of the stores
+                which render the fragments. If it holds any stamped scope in
+                the in-process cache, ttl is capped at the shortest time to
+                live of those scopes.
+        """
+        self._views = frozenset(views)
+        self._block_types = frozenset(
+            block_type for block_type, _ in self._views)
+        if cache_policy is not None:
+            process_ttls = [
+                cache_policy.options(scope).process_ttl
+                for scope in STAMPED_SCOPES]
+            ttl = min([ttl] + [
+                process_ttl for process_ttl in process_ttls
+                if process_ttl is not None])
+        self.ttl = ttl
+        self._local_cache = (
+            cache.LRUCache(max_size=1000) if local_cache is None
+            else local_cache)
+
+    def is_cacheable(self, block, view_name):
+        return ((block.scope_ids.block_type, view_name) in self._views and
+                not getattr(block, 'children', None))
+
+    def get_stamps(self, blocks):
+        """Read the version stamps of the cacheable blocks in one batch.
+
+        Stamps missing from memcache are created.
+
+        Args:
+            blocks: iterable of XBlock.
+
+        Returns:
+            dict. Maps the definition and usage ids of the blocks to their
+            stamps. Ids whose stamps could not be stored are omitted.
+        """
+        ids = set()
+        for block in blocks:
+            if block.scope_ids.block_type in self._block_types:
+                ids.add(str(block.scope_ids.def_id))
+                ids.add(str(block.scope_ids.usage_id))
+        if not ids:
+            return {}
+
+        stamps = memcache.get_multi(list(ids), key_prefix=_STAMP_PREFIX)
+        missing = ids.difference(stamps)
+        if missing:
+            memcache.add_multi(
+                dict((block_id, uuid.uuid4().hex) for block_id in missing),
+                key_prefix=_STAMP_PREFIX)
+            # Read back, in case another request added a stamp first.
+            stamps.update(memcache.get_multi(
+                list(missing), key_prefix=_STAMP_PREFIX))
+        return stamps
+
+    def _key(self, block, view_name, stamps):
+        def_id = str(block.scope_ids.def_id)
+        usage_id = str(block.scope_ids.usage_id)
+        if def_id not in stamps or usage_id not in stamps:
+            stamps.update(self.get_stamps([block]))
+            if def_id not in stamps or usage_id not in stamps:
+                return None
+        return '%s%s:%s:%s:%s' % (
+            _FRAGMENT_PREFIX, usage_id, view_name, stamps[def_id],
+            stamps[usage_id])
+
+    def get(self, block, view_name, stamps):
+        """Look up the cached fragment of a view of a block.
+
+        Args:
+            block: XBlock. The block being rendered.
+            view_name: str. The name of the view.
+            stamps: dict. The stamps read by get_stamps() in this request.
+                Any which are missing are read and added.
+
+        Returns:
+            (xblock.fragment.Fragment, str). The cached fragment or None, and
+            the key under which to put() a newly rendered fragment, which is
+            None if the view is not cacheable.
+        """
+        if not self.is_cacheable(block, view_name):
+            return None, None
+        key = self._key(block, view_name, stamps)
+        if key is None:
+            return None, None
+
+        fragment = self._local_cache.get(key)
+        if fragment is None:
+            fragment = memcache.get(key)
+            if fragment is None:
+                return None, key
+            self._local_cache.put(key, fragment, ttl=self.ttl)
+        return copy.deepcopy(fragment), key
+
+    def find_cached(self, blocks, view_name, stamps):
+        """Return the usage ids of the blocks whose view is cached.
+
+        Fragments are looked for in the in-process tier, and then in memcache
+        with one batch call. Those found in memcache are kept in the
+        in-process tier, for the get() calls which follow.
+
+        Args:
+            blocks: list of XBlock.
+            view_name: str. The name of the view.
+            stamps: dict. As for get(). Missing stamps are read in one batch.
+
+        Returns:
+            set of str.
+        """
+        blocks = [
+            block for block in blocks if self.is_cacheable(block, view_name)]
+        stamps.update(self.get_stamps([
+            block for block in blocks
+            if str(block.scope_ids.def_id) not in stamps or
+            str(block.scope_ids.usage_id) not in stamps]))
+
+        cached = set()
+        remote = {}
+        for block in blocks:
+            key = self._key(block, view_name, stamps)
+            if key is None:
+                continue
+            if self._local_cache.get(key) is not None:
+                cached.add(block.scope_ids.usage_id)
+            else:
+                remote[key] = block.scope_ids.usage_id
+        if remote:
+            for key, fragment in memcache.get_multi(remote.keys()).iteritems():
+                self._local_cache.put(key, fragment, ttl=self.ttl)
+                cached.add(remote[key])
+        return cached
+
+    def put(self, key, fragment):
+        fragment = copy.deepcopy(fragment)
+        self._local_cache.put(key, fragment, ttl=self.ttl)
+        memcache.set(key, fragment, time=self.ttl)
+
+    def invalidate(self, block_ids):
+        """Replace the stamps of definitions or usages, orphaning fragments."""
+        memcache.set_multi(
+            dict((str(block_id), uuid.uuid4().hex) for block_id in block_ids),
+            key_prefix=_STAMP_PREFIX)
+
+    def on_write(self, keys):
+        """A KeyValueStore write listener which invalidates written blocks.
+
+        Args:
+            keys: list of xblock.runtime.KeyValueStore.Key. The keys which
+                have been written.
+        """
+        block_ids = set(
+            key.block_scope_id for key in keys
+            if key.scope in STAMPED_SCOPES and key.block_scope_id)
+        if block_ids:
+            self.invalidate(block_ids)
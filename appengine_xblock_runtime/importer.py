@@ -0,0 +1,206 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming import of XBlock XML, for course packages of any size."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import time
+
+import runtime
+
+from lxml import etree
+import xblock.plugin
+
+from google.appengine.ext import ndb
+
+
+# The attribute of a stub element which records the position of the block it
+# replaced among the blocks of the document.
+STUB_INDEX_ATTR = 'index'
+
+
+class ImportCheckpointEntity(ndb.Model):
+    """The progress of a resumable streaming import.
+
+    Blocks are numbered in the order their elements end in the document.
+    'processed' is the number of blocks which have been written, and
+    'open_stubs' lists [index, usage_id] for those of them whose parent had
+    not yet been written. 'root_usage_id' is set once the import completes.
+    """
+    processed = ndb.IntegerProperty(indexed=False, default=0)
+    open_stubs = ndb.JsonProperty(indexed=False, compressed=True)
+    root_usage_id = ndb.StringProperty(indexed=False)
+
+
+class StreamingImporter(object):
+    """Imports XBlock XML incrementally, writing blocks in bounded batches.
+
+    Rather than parsing the whole document into a tree, the importer parses it
+    with iterparse and creates each block as soon as its element ends. The
+    element is then replaced in its parent by a stub carrying the new usage
+    id. Each block is saved by Runtime.parse_xml_node without a parent, which
+    Runtime.add_node_as_child sets from the stub when the parent is created.
+    Only the open ancestors of the current element and their stubbed children
+    are held in memory.
+
+    Usages, definitions and field values are written every batch_size blocks.
+    If a checkpoint id is given, the progress is saved after each batch, and a
+    later run with the same id resumes after the last saved batch. With a
+    deadline, run() stops after the first batch which ends past it, so that
+    the import can be continued by a task.
+
+    Only elements whose tag is a known block type are treated as blocks. Block
+    types which parse the XML of their child blocks themselves, rather than
+    through runtime.add_node_as_child, will not see it.
+    """
+
+    def __init__(self, xblock_runtime, batch_size=100, checkpoint_id=None):
+        """Initialize the importer.
+
+        Args:
+            xblock_runtime: runtime.Runtime. The runtime used to create the
+                blocks. Its key value store must support buffered writes.
+            batch_size: int. The number of blocks written in each batch.
+            checkpoint_id: str. The id under which progress is saved, or None
+                if the import is not resumable.
+        """
+        self._runtime = xblock_runtime
+        self._batch_size = batch_size
+        self._checkpoint_key = (
+            ndb.Key(ImportCheckpointEntity, checkpoint_id)
+            if checkpoint_id else None)
+        self._id_generator = runtime.BatchingIdGenerator(
+            stats=xblock_runtime.stats)
+        self._block_types = {}
+
+    def _is_block(self, element):
+        if not isinstance(element.tag, basestring):
+            return False
+        if element.tag not in self._block_types:
+            try:
+                self._runtime.load_block_type(element.tag)
+                self._block_types[element.tag] = True
+            except xblock.plugin.PluginMissingError:
+                self._block_types[element.tag] = False
+        return self._block_types[element.tag]
+
+    def _load_checkpoint(self):
+        checkpoint = None
+        if self._checkpoint_key is not None:
+            checkpoint = self._checkpoint_key.get()
+        return checkpoint or ImportCheckpointEntity(
+            key=self._checkpoint_key, open_stubs=[])
+
+    def _start_batch(self):
+        kvs = self._runtime.key_value_store
+        kvs.reset()
+        kvs.start_buffering()
+
+    def _write_batch(self, checkpoint, processed, open_stubs):
+        self._id_generator.flush()
+        self._runtime.key_value_store.flush()
+        if self._checkpoint_key is not None:
+            checkpoint.processed = processed
+            checkpoint.open_stubs = sorted(open_stubs.iteritems())
+            checkpoint.put()
+
+    def _replace_with_stub(self, element, index, usage_id):
+        parent = element.getparent()
+        if parent is None:
+            return
+        stub = etree.Element(runtime.STUB_TAG, {
+            runtime.STUB_USAGE_ID_ATTR: usage_id,
+            STUB_INDEX_ATTR: str(index)})
+        stub.tail = element.tail
+        parent.replace(element, stub)
+
+    def run(self, fileobj, deadline=None):
+        """Import the XML in fileobj, or continue a checkpointed import.
+
+        Args:
+            fileobj: file. The XML document. A resumed import must be given the
+                same document.
+            deadline: float. The number of seconds after which to stop at the
+                end of a batch, or None to run to completion.
+
+        Returns:
+            str. The usage id of the root block, or None if the import stopped
+            at the deadline before completing.
+        """
+        checkpoint = self._load_checkpoint()
+        if checkpoint.root_usage_id:
+            return checkpoint.root_usage_id
+
+        start = time.time()
+        skip = checkpoint.processed
+        resumed_stubs = dict(checkpoint.open_stubs or [])
+        # Maps the index of each block whose parent has not been written to
+        # its usage id.
+        open_stubs = {}
+        index = 0
+        in_batch = 0
+        root_usage_id = None
+
+        self._start_batch()
+        try:
+            for _, element in etree.iterparse(fileobj, events=('end',)):
+                if not self._is_block(element):
+                    continue
+
+                if index < skip:
+                    if index in resumed_stubs:
+                        open_stubs[index] = resumed_stubs[index]
+                        self._replace_with_stub(
+                            element, index, resumed_stubs[index])
+                    elif element.getparent() is not None:
+                        element.getparent().remove(element)
+                    index += 1
+                    continue
+
+                for child in element:
+                    if child.tag == runtime.STUB_TAG:
+                        open_stubs.pop(int(child.get(STUB_INDEX_ATTR)), None)
+                usage_id = self._runtime.parse_xml_node(
+                    element, self._id_generator)
+                if element.getparent() is None:
+                    root_usage_id = usage_id
+                else:
+                    open_stubs[index] = usage_id
+                    self._replace_with_stub(element, index, usage_id)
+                index += 1
+                in_batch += 1
+
+                if in_batch >= self._batch_size and root_usage_id is None:
+                    self._write_batch(checkpoint, index, open_stubs)
+                    in_batch = 0
+                    if (deadline is not None and
+                            time.time() - start >= deadline):
+                        return None
+                    self._start_batch()
+
+            self._write_batch(checkpoint, index, open_stubs)
+        except:
+            self._runtime.key_value_store.discard()
+            raise
+
+        if self._checkpoint_key is not None:
+            checkpoint.root_usage_id = root_usage_id
+            checkpoint.put()
+        return root_usage_id
+
+
+def import_xml_file(xblock_runtime, fileobj, batch_size=100):
+    """Import the XML in fileobj with bounded memory, returning its usage id."""
+    return StreamingImporter(xblock_runtime, batch_size=batch_size).run(fileobj)
@@ -0,0 +1,191 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Request-scoped counters and timings for the runtime and its stores."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import json
+import logging
+import threading
+import time
+
+
+# Callbacks which are passed the summary of every exported RequestStats. The
+# list is replaced rather than changed, so that it can be read without a lock.
+_EXPORTERS = []
+_EXPORTERS_LOCK = threading.Lock()
+
+
+def register_exporter(exporter):
+    """Register a callback to receive the summary of each request's stats.
+
+    Args:
+        exporter: callable. Called with the dict returned by
+            RequestStats.summary() whenever RequestStats.export() is called.
+    """
+    global _EXPORTERS
+    with _EXPORTERS_LOCK:
+        if exporter not in _EXPORTERS:
+            _EXPORTERS = _EXPORTERS + [exporter]
+
+
+def unregister_exporter(exporter):
+    global _EXPORTERS
+    with _EXPORTERS_LOCK:
+        _EXPORTERS = [item for item in _EXPORTERS if item != exporter]
+
+
+def logging_exporter(summary):
+    """An exporter which writes the summary to the log as one JSON line."""
+    logging.info('xblock_runtime_stats %s', json.dumps(summary))
+
+
+def scope_name(scope):
+    if scope is None:
+        return None
+    return getattr(scope, 'name', None) or str(scope)
+
+
+class RequestStats(object):
+    """Aggregates the operations made while serving a single request.
+
+    For each operation, and for each scope it was applied to, the stats hold
+    the number of calls, the total and greatest latency, and the number of
+    bytes of field values passed. Recording costs a dict lookup and a few
+    additions, so the stats can be left on in production. Measuring payload
+    sizes JSON-encodes each value read or written, so it is off unless asked
+    for, such as when profiling.
+    Like the runtime which owns them, stats belong to one request and are not
+    shared between threads.
+
+    Operations on the datastore itself are recorded as 'datastore_get',
+    'datastore_put' and 'datastore_delete', counting the entities in each
+    batch, so that the number of RPCs made by a request can be read off.
+    """
+
+    def __init__(self, measure_payloads=False, exporters=None):
+        """Initialize the stats.
+
+        Args:
+            measure_payloads: bool. Whether to record the size of the values
+                read and written. Each value is JSON-encoded to measure it.
+            exporters: list of callable. Callbacks to which the summary is
+                passed on export(), in addition to those registered with
+                register_exporter().
+        """
+        self.measure_payloads = measure_payloads
+        self._exporters = list(exporters or [])
+        self._start = time.time()
+        # Maps (op, scope) to a list of the call count, the number of
+        # items, the total latency, the greatest latency and the payload bytes.
+        self._ops = {}
+
+    def record(self, op, scope=None, latency=0.0, payload_bytes=0, items=1):
+        """Record one call of an operation.
+
+        Args:
+            op: str. The name of the operation.
+            scope: xblock.fields.Scope. The scope the operation applied to, if
+                any.
+            latency: float. The time in seconds the operation took.
+            payload_bytes: int. The size of the data read or written.
+            items: int. The number of keys or entities in the call.
+        """
+        totals = self._ops.get((op, scope))
+        if totals is None:
+            totals = self._ops[(op, scope)] = [0, 0, 0.0, 0.0, 0]
+        totals[0] += 1
+        totals[1] += items
+        totals[2] += latency
+        if latency > totals[3]:
+            totals[3] = latency
+        totals[4] += payload_bytes
+
+    def payload_size(self, value):
+        """Return the size of the JSON encoding of value, if measured."""
+        if not self.measure_payloads:
+            return 0
+        try:
+            return len(json.dumps(value))
+        except (TypeError, ValueError):
+            return 0
+
+    def count(self, op, scope=None):
+        """Return the number of calls recorded for an operation."""
+        if scope is not None:
+            totals = self._ops.get((op, scope))
+            return totals[0] if totals else 0
+        return sum(
+            totals[0] for (name, _), totals in self._ops.iteritems()
+            if name == op)
+
+    def summary(self):
+        """Return the aggregated stats as a JSON-serializable dict.
+
+        Returns:
+            dict. Holds 'elapsed_ms', the time since the stats were created,
+            and 'ops', a list with a dict for each operation and scope giving
+            'op', 'scope', 'calls', 'items', 'total_ms', 'max_ms' and
+            'payload_bytes'.
+        """
+        ops = []
+        for (op, scope), totals in sorted(
+                self._ops.iteritems(),
+                key=lambda item: (item[0][0], scope_name(item[0][1]))):
+            calls, items, total, greatest, payload_bytes = totals
+            ops.append({
+                'op': op,
+                'scope': scope_name(scope),
+                'calls': calls,
+                'items': items,
+                'total_ms': total * 1000,
+                'max_ms': greatest * 1000,
+                'payload_bytes': payload_bytes})
+        return {
+            'elapsed_ms': (time.time() - self._start) * 1000,
+            'ops': ops}
+
+    def export(self):
+        """Pass the summary to this object's and all registered exporters.
+
+        Errors raised by exporters are logged, and do not fail the request.
+        """
+        exporters = self._exporters + _EXPORTERS
+        if not exporters:
+            return
+        summary = self.summary()
+        for exporter in exporters:
+            try:
+                exporter(summary)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Failed to export runtime stats')
+
+
+class _NullStats(RequestStats):
+    """Stats which record nothing, used by components outside a runtime."""
+
+    def __init__(self):
+        super(_NullStats, self).__init__(measure_payloads=False)
+
+    def record(self, op, scope=None, latency=0.0, payload_bytes=0, items=1):
+        pass
+
+    def export(self):
+        pass
+
+
+# The stats of stores and id managers which have not been given any. A runtime
+# replaces these with its own stats when it is constructed.
+NULL_STATS = _NullStats()
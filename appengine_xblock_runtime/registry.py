@@ -0,0 +1,138 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""An instance-wide registry of the classes of XBlock types."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import logging
+import threading
+import time
+
+import instrumentation
+
+import pkg_resources
+import xblock.core
+import xblock.plugin
+
+
+class BlockTypeRegistry(object):
+    """Maps block types to their classes, loading each class once.
+
+    XBlock.load_class() scans the entry points of every distribution in the
+    working set on each call. The registry instead reads the entry points once,
+    on the first lookup, and then imports the module of each block type only
+    when that type is first needed, keeping the class for later lookups.
+    Nothing is read or imported when the registry is created, so creating it
+    adds nothing to the start up of an instance.
+
+    The registry is shared by all the requests of an instance, and is
+    thread-safe.
+    """
+
+    def __init__(self, entry_point=xblock.core.XBlock.entry_point):
+        """Initialize the registry.
+
+        Args:
+            entry_point: str. The name of the group of entry points which
+                declare block types.
+        """
+        self._entry_point = entry_point
+        self._lock = threading.Lock()
+        # Maps each block type to the list of its entry points. None until the
+        # entry points are read.
+        self._entry_points = None
+        self._classes = {}
+        # The seconds taken to read the entry points and to import each class.
+        self.index_time = None
+        self.load_times = {}
+
+    def _index(self):
+        start = time.time()
+        entry_points = {}
+        for entry_point in pkg_resources.iter_entry_points(self._entry_point):
+            entry_points.setdefault(entry_point.name.lower(), []).append(
+                entry_point)
+        self.index_time = time.time() - start
+        logging.info(
+            'Indexed %d XBlock types in %.1f ms', len(entry_points),
+            self.index_time * 1000)
+        return entry_points
+
+    def load_class(
+            self, block_type, default=None, stats=instrumentation.NULL_STATS):
+        """Return the class of a block type, importing it if necessary.
+
+        Args:
+            block_type: str. The name of the block type.
+            default: class. The class to return if the block type is unknown.
+            stats: instrumentation.RequestStats. Records the time taken if
+                the class is imported.
+
+        Returns:
+            class. The XBlock subclass of the block type.
+
+        Raises:
+            xblock.plugin.PluginMissingError: if no block type has the name and
+                no default is given.
+            xblock.plugin.AmbiguousPluginError: if several block types have
+                the name.
+        """
+        identifier = block_type.lower()
+        xblock_class = self._classes.get(identifier)
+        if xblock_class is not None:
+            return xblock_class
+
+        with self._lock:
+            xblock_class = self._classes.get(identifier)
+            if xblock_class is not None:
+                return xblock_class
+            if self._entry_points is None:
+                self._entry_points = self._index()
+            entry_points = self._entry_points.get(identifier, [])
+            if len(entry_points) > 1:
+                raise xblock.plugin.AmbiguousPluginError(
+                    identifier, entry_points)
+            if not entry_points:
+                if default is not None:
+                    return default
+                raise xblock.plugin.PluginMissingError(identifier)
+
+            start = time.time()
+            xblock_class = entry_points[0].load()
+            latency = time.time() - start
+            self.load_times[identifier] = latency
+            self._classes[identifier] = xblock_class
+        stats.record('block_class_import', latency=latency)
+        return xblock_class
+
+    def preload(self, block_types):
+        """Import the classes of the given block types, skipping unknown ones.
+
+        Called by a warmup request, so that user requests do not wait for the
+        imports.
+        """
+        for block_type in block_types:
+            self.load_class(block_type, default=object)
+
+    def clear(self):
+        """Forget the entry points and classes, e.g. after adding eggs."""
+        with self._lock:
+            self._entry_points = None
+            self._classes = {}
+            self.load_times = {}
+
+
+# The registry shared by the runtimes of the instance.
+REGISTRY = BlockTypeRegistry()
@@ -16,45 +16,153 @@
 
 __author__ = 'John Orr (jorr@google.com)'
 
+import contextlib
+import functools
 import logging
-import uuid
+import time
 
+import base
+import cache
+import events
+import instrumentation
+import registry
 import store
 
+from lxml import etree
 import xblock.exceptions
+from xblock.fields import BlockScope
+from xblock.fields import Scope
+from xblock.fields import ScopeIds
+from xblock.fields import UserScope
 import xblock.runtime
 
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 
 
 logging.warning("""
-WARNING: This version of the App Engine XBlock Runtime does not implement any
-transactional locking. As a result, during periods of high traffic, inconsistent
-results are possible arising from race conditions and data contention. We are
-actively working on this, and future releases of the runtime will mitigate the
-issue.""")
+WARNING: The App Engine XBlock Runtime only protects against data contention in
+handlers which are invoked through Runtime.handle_transactionally. Elsewhere,
+during periods of high traffic, inconsistent results are possible arising from
+race conditions.""")
 
 
-def generate_id():
-    return uuid.uuid4().hex
+# The mappings from usage to definition and from definition to block type never
+# change once created, and so can be cached for the lifetime of the instance.
+ID_CACHE = cache.LRUCache(max_size=10000)
+
+# The element which stands in for a child block which has already been created,
+# such as by a streaming import, and the attribute giving its usage id.
+STUB_TAG = 'xblock-stub'
+STUB_USAGE_ID_ATTR = 'usage_id'
+
+
+def field_keys(scope_ids, fields):
+    """Compute the KeyValueStore keys under which a block's fields are stored.
+
+    This mirrors the key construction in xblock.runtime.KvsFieldData, so that
+    the keys can be worked out ahead of the block being read.
+
+    Args:
+        scope_ids: xblock.fields.ScopeIds. The ids of the block.
+        fields: dict. The field declarations of the block class, keyed by name.
+
+    Returns:
+        list of xblock.runtime.KeyValueStore.Key.
+    """
+    keys = []
+    for name, field in fields.iteritems():
+        if field.scope in (Scope.children, Scope.parent):
+            block_id = scope_ids.usage_id
+            user_id = None
+        else:
+            block_scope = field.scope.block
+            if block_scope == BlockScope.ALL:
+                block_id = None
+            elif block_scope == BlockScope.USAGE:
+                block_id = scope_ids.usage_id
+            elif block_scope == BlockScope.DEFINITION:
+                block_id = scope_ids.def_id
+            else:
+                block_id = scope_ids.block_type
+
+            if field.scope.user == UserScope.ONE:
+                user_id = scope_ids.user_id
+            else:
+                user_id = None
+
+        keys.append(xblock.runtime.KeyValueStore.Key(
+            scope=field.scope, user_id=user_id, block_scope_id=block_id,
+            field_name=name))
+    return keys
 
 
 class IdReader(xblock.runtime.IdReader):
-    """Implementation of XBlock IdReader using App Engine datastore."""
+    """Implementation of XBlock IdReader using App Engine datastore.
 
-    def get_definition_id(self, usage_id):
+    Resolved ids are held in an LRU cache, by default the instance-wide
+    ID_CACHE, so that once warm no datastore RPCs are needed. Lookups which
+    miss the cache are recorded in the reader's stats.
+    """
+
+    def __init__(self, id_cache=None, stats=None):
+        super(IdReader, self).__init__()
+        self._id_cache = ID_CACHE if id_cache is None else id_cache
+        self.stats = stats or instrumentation.NULL_STATS
+
+    @ndb.tasklet
+    def _get_entity_async(self, entity_class, entity_id):
+        start = time.time()
+        entity = yield ndb.Key(entity_class, entity_id).get_async()
+        self.stats.record('datastore_get', latency=time.time() - start)
+        raise ndb.Return(entity)
+
+    @ndb.tasklet
+    def get_definition_id_async(self, usage_id):
         """Retrieve the definition id to which this usage id is bound."""
-        usage = ndb.Key(store.UsageEntity, str(usage_id)).get()
-        if usage is None:
-            raise xblock.exceptions.NoSuchUsage(str(usage_id))
-        return str(usage.definition_id)
+        cache_key = ('usage', str(usage_id))
+        def_id = self._id_cache.get(cache_key)
+        if def_id is None:
+            self.stats.record('id_cache_miss')
+            usage = yield self._get_entity_async(
+                store.UsageEntity, str(usage_id))
+            if usage is None:
+                raise xblock.exceptions.NoSuchUsage(str(usage_id))
+            def_id = str(usage.definition_id)
+            self._id_cache.put(cache_key, def_id)
+        raise ndb.Return(def_id)
 
-    def get_block_type(self, def_id):
+    def get_definition_id(self, usage_id):
+        return self.get_definition_id_async(usage_id).get_result()
+
+    @ndb.tasklet
+    def get_block_type_async(self, def_id):
         """Retrieve the block type to which this definition is bound."""
-        definition = ndb.Key(store.DefinitionEntity, str(def_id)).get()
-        if definition is None:
-            raise xblock.exceptions.NoSuchDefinition(str(def_id))
-        return definition.block_type
+        cache_key = ('definition', str(def_id))
+        block_type = self._id_cache.get(cache_key)
+        if block_type is None:
+            self.stats.record('id_cache_miss')
+            definition = yield self._get_entity_async(
+                store.DefinitionEntity, str(def_id))
+            if definition is None:
+                raise xblock.exceptions.NoSuchDefinition(str(def_id))
+            block_type = definition.block_type
+            self._id_cache.put(cache_key, block_type)
+        raise ndb.Return(block_type)
+
+    def get_block_type(self, def_id):
+        return self.get_block_type_async(def_id).get_result()
+
+    def get_definition_ids(self, usage_ids):
+        """Retrieve the definition ids of several usages in one batch."""
+        futures = [
+            self.get_definition_id_async(usage_id) for usage_id in usage_ids]
+        return [future.get_result() for future in futures]
+
+    def get_block_types(self, def_ids):
+        """Retrieve the block types of several definitions in one batch."""
+        futures = [self.get_block_type_async(def_id) for def_id in def_ids]
+        return [future.get_result() for future in futures]
 
 
 class IdGenerator(xblock.runtime.IdGenerator):
@@ -63,19 +171,47 @@ class IdGenerator(xblock.runtime.IdGenerator):
     This manages the graph of many-to-one relationships between
     usages, definitions, and blocks. The schema is:
         usage (n) -- (1) definition (n) -- (1) block_type
+
+    New ids are added to the LRU cache used by IdReader.
     """
 
-    def create_usage(self, def_id):
+    def __init__(self, id_cache=None, stats=None):
+        super(IdGenerator, self).__init__()
+        self._id_cache = ID_CACHE if id_cache is None else id_cache
+        self.stats = stats or instrumentation.NULL_STATS
+
+    @ndb.tasklet
+    def _get_definition_async(self, def_id):
+        start = time.time()
+        definition = yield ndb.Key(
+            store.DefinitionEntity, str(def_id)).get_async()
+        self.stats.record('datastore_get', latency=time.time() - start)
+        raise ndb.Return(definition)
+
+    @ndb.tasklet
+    def _put_async(self, entity):
+        start = time.time()
+        yield entity.put_async()
+        self.stats.record('datastore_put', latency=time.time() - start)
+
+    @ndb.tasklet
+    def create_usage_async(self, def_id):
         """Create a new usage id bound to the given definition id."""
-        definition_key = ndb.Key(store.DefinitionEntity, str(def_id))
-        assert definition_key.get() is not None
-        usage_id = generate_id()
+        definition = yield self._get_definition_async(def_id)
+        assert definition is not None
+        usage_id = base.generate_id()
         usage = store.UsageEntity(id=usage_id)
         usage.definition_id = def_id
-        usage.put()
-        return usage_id
+        yield self._put_async(usage)
+        self._id_cache.put(('usage', usage_id), str(def_id))
+        self.stats.record('create_usage')
+        raise ndb.Return(usage_id)
 
-    def create_definition(self, block_type):
+    def create_usage(self, def_id):
+        return self.create_usage_async(def_id).get_result()
+
+    @ndb.tasklet
+    def create_definition_async(self, block_type):
         """Create a new definition id, bound to the given block type.
 
         Args:
@@ -84,20 +220,470 @@ class IdGenerator(xblock.runtime.IdGenerator):
         Returns:
             str. The id of the new definition.
         """
-        definition_id = generate_id()
+        definition_id = base.generate_id()
+        definition = store.DefinitionEntity(id=definition_id)
+        definition.block_type = block_type
+        yield self._put_async(definition)
+        self._id_cache.put(('definition', definition_id), block_type)
+        self.stats.record('create_definition')
+        raise ndb.Return(definition_id)
+
+    def create_definition(self, block_type):
+        return self.create_definition_async(block_type).get_result()
+
+
+class BatchingIdGenerator(IdGenerator):
+    """An IdGenerator which writes the ids it creates in a single batch.
+
+    Ids are handed out immediately, but the usage and definition entities are
+    held in memory until flush() is called. This is intended for bulk imports,
+    which would otherwise make several datastore RPCs for every block.
+    """
+
+    def __init__(self, id_cache=None, stats=None):
+        super(BatchingIdGenerator, self).__init__(
+            id_cache=id_cache, stats=stats)
+        self._definitions = {}
+        self._usages = []
+
+    @ndb.tasklet
+    def create_usage_async(self, def_id):
+        """Create a new usage id bound to the given definition id."""
+        if str(def_id) not in self._definitions:
+            definition = yield self._get_definition_async(def_id)
+            assert definition is not None
+        usage_id = base.generate_id()
+        usage = store.UsageEntity(id=usage_id)
+        usage.definition_id = def_id
+        self._usages.append(usage)
+        self.stats.record('create_usage')
+        raise ndb.Return(usage_id)
+
+    @ndb.tasklet
+    def create_definition_async(self, block_type):
+        """Create a new definition id, bound to the given block type."""
+        definition_id = base.generate_id()
         definition = store.DefinitionEntity(id=definition_id)
         definition.block_type = block_type
-        definition.put()
-        return definition_id
+        self._definitions[definition_id] = definition
+        self.stats.record('create_definition')
+        raise ndb.Return(definition_id)
+
+    def flush(self):
+        """Write all the pending usages and definitions to the datastore."""
+        definitions = self._definitions.values()
+        usages = self._usages
+        self._definitions = {}
+        self._usages = []
+
+        if definitions or usages:
+            start = time.time()
+            ndb.put_multi(definitions + usages)
+            self.stats.record(
+                'datastore_put', latency=time.time() - start,
+                items=len(definitions) + len(usages))
+        for definition in definitions:
+            self._id_cache.put(
+                ('definition', definition.key.id()), definition.block_type)
+        for usage in usages:
+            self._id_cache.put(
+                ('usage', usage.key.id()), str(usage.definition_id))
 
 
 class Runtime(xblock.runtime.Runtime):
-    """An XBlock runtime which uses the App Engine datastore."""
+    """An XBlock runtime which uses the App Engine datastore.
+
+    A runtime serves a single request. The operations it makes, and those of
+    its id reader and key value store, are gathered in its stats, which can be
+    passed to exporters with runtime.stats.export() at the end of the request.
+
+    A runtime and its store, stats and event buffer hold the state of one
+    request, and must not be shared between threads. They are cheap to create
+    for each request. The state shared by all the requests of an instance is
+    held in thread-safe caches: ID_CACHE, store.PROCESS_CACHE and the tiers
+    of a fragment_cache.FragmentCache. These hold immutable values or copies,
+    so that no request sees objects being changed by another. Requests may
+    therefore be served concurrently, with threadsafe: yes.
+    """
 
     def __init__(
-            self, id_reader=None, field_data=None, student_id=None, **kwargs):
-        super(Runtime, self).__init__(
-            id_reader or IdReader(),
-            field_data or xblock.runtime.KvsFieldData(store.KeyValueStore()),
-            **kwargs)
+            self, id_reader=None, field_data=None, student_id=None,
+            key_value_store=None, stats=None, fragment_cache=None,
+            event_sink=None, class_registry=None, **kwargs):
+        """Initialize the runtime.
+
+        Args:
+            id_reader: xblock.runtime.IdReader. Defaults to an IdReader using
+                the datastore.
+            field_data: xblock.field_data.FieldData. Defaults to field data
+                backed by key_value_store.
+            student_id: str. The id of the current user.
+            key_value_store: the store holding field values, such as a
+                store.KeyValueStore or a backends.KeyValueStore. Defaults to a
+                new store.KeyValueStore. Ignored if field_data is given.
+            stats: instrumentation.RequestStats. Records the operations made
+                in the request. Defaults to new stats, which are also given to
+                the id reader and key value store if they have none.
+            fragment_cache: fragment_cache.FragmentCache. The cache of
+                rendered fragments, or None if fragments are not cached. The
+                key value store should notify it of writes.
+            event_sink: events.EventSink. The destination of the events
+                published by blocks. Defaults to the application log.
+            class_registry: registry.BlockTypeRegistry. The classes of block
+                types. Defaults to the instance-wide registry.REGISTRY.
+            **kwargs: passed on to xblock.runtime.Runtime.
+        """
+        self.stats = stats or instrumentation.RequestStats()
+        if field_data is None:
+            key_value_store = key_value_store or store.KeyValueStore()
+            field_data = xblock.runtime.KvsFieldData(key_value_store)
+        id_reader = id_reader or IdReader()
+        for component in (id_reader, key_value_store):
+            if getattr(component, 'stats', None) is instrumentation.NULL_STATS:
+                component.stats = self.stats
+        super(Runtime, self).__init__(id_reader, field_data, **kwargs)
+        self.key_value_store = key_value_store
         self.user_id = student_id
+        # Whether export_xml writes children as stubs rather than in full. Set
+        # by exporter.StreamingExporter.
+        self.export_child_stubs = False
+        # The number of nested render() calls in progress.
+        self._render_depth = 0
+        self.fragment_cache = fragment_cache
+        # The fragment cache stamps read in this request.
+        self._fragment_stamps = {}
+        self.event_buffer = events.EventBuffer(
+            event_sink or events.LoggingSink())
+        self.class_registry = class_registry or registry.REGISTRY
+
+    def load_block_type(self, block_type):
+        """Return the class of a block type, from the class registry."""
+        return self.class_registry.load_class(
+            block_type, default=getattr(self, 'default_class', None),
+            stats=self.stats)
+
+    @contextlib.contextmanager
+    def buffered_writes(self, transactional=False):
+        """Context manager which gathers all field writes made in its body.
+
+        The writes are flushed to the datastore in one batch when the body
+        completes, and are discarded if it raises, as are any events published
+        in the body which have not yet been written. Nested uses are absorbed
+        by the outermost one.
+
+        Args:
+            transactional: bool. Whether to flush in a transaction which fails
+                with store.ContentionError if another request has changed the
+                values since they were read.
+        """
+        kvs = self.key_value_store
+        if kvs is None or kvs.buffering:
+            yield
+            return
+
+        kvs.start_buffering()
+        events_mark = self.event_buffer.mark()
+        try:
+            yield
+        except:
+            kvs.discard()
+            self.event_buffer.rollback(events_mark)
+            raise
+        kvs.flush(transactional=transactional)
+
+    def handle_transactionally(
+            self, usage_id, handler_name, request, retries=3):
+        """Invoke a handler so that its writes are applied atomically.
+
+        The handler's writes are committed in a single transaction. If any of
+        the values it read were changed by a concurrent request in the
+        meantime, the block is reloaded and the handler is run again. A
+        transaction may write at most store.MAX_TRANSACTION_GROUPS entity
+        groups, and each field is its own group unless its scope is
+        consolidated by the store, so handlers which write many user_state
+        fields need a store which consolidates Scope.user_state.
+
+        Args:
+            usage_id: str. The usage id of the block.
+            handler_name: str. The name of the handler to invoke.
+            request: webob.Request. The request passed to the handler.
+            retries: int. The number of times to re-run the handler.
+
+        Returns:
+            webob.Response. The response from the handler.
+
+        Raises:
+            store.TransactionTooLargeError: If the handler writes more entity
+                groups than a transaction allows.
+        """
+        for attempt in xrange(retries + 1):
+            block = self.get_block(usage_id)
+            try:
+                with self.buffered_writes(transactional=True):
+                    return self.handle(block, handler_name, request)
+            except (store.ContentionError,
+                    datastore_errors.TransactionFailedError):
+                if attempt == retries:
+                    raise
+                self.stats.record('handler_retry')
+                self.key_value_store.reset()
+
+    def handle_batch(self, calls, transactional=False, retries=3):
+        """Invoke several handlers, writing all their changes in one flush.
+
+        The blocks are loaded together, with their fields, by one get_blocks()
+        call, and a block named by several calls is shared between them. If a
+        handler raises, the writes of the whole batch are discarded.
+
+        A transactional batch is retried as a whole on contention, like
+        handle_transactionally(). As a transaction may write no more than
+        store.MAX_TRANSACTION_GROUPS entity groups, this suits only small
+        batches; larger ones raise store.TransactionTooLargeError.
+
+        Args:
+            calls: list of (str, str, webob.Request). The usage id, handler name
+                and request of each call, in the order they are to be run.
+            transactional: bool. Whether to commit the writes atomically.
+            retries: int. The number of times to re-run a transactional batch.
+
+        Returns:
+            list of webob.Response. The response to each call, in order.
+        """
+        usage_ids = []
+        for usage_id, _, _ in calls:
+            if usage_id not in usage_ids:
+                usage_ids.append(usage_id)
+
+        for attempt in xrange(retries + 1):
+            try:
+                with self.buffered_writes(transactional=transactional):
+                    blocks = dict(zip(usage_ids, self.get_blocks(usage_ids)))
+                    return [
+                        self.handle(blocks[usage_id], handler_name, request)
+                        for usage_id, handler_name, request in calls]
+            except (store.ContentionError,
+                    datastore_errors.TransactionFailedError):
+                if not transactional or attempt == retries:
+                    raise
+                self.stats.record('handler_retry')
+                self.key_value_store.reset()
+
+    def get_blocks(self, usage_ids, prefetch=True):
+        """Create several blocks, resolving their ids and fields in batches.
+
+        The id reader must provide get_definition_ids() and get_block_types().
+
+        Args:
+            usage_ids: list of str. The usage ids of the blocks.
+            prefetch: bool. Whether to load the fields of the blocks.
+
+        Returns:
+            list of XBlock. The blocks, in the order of usage_ids.
+        """
+        start = time.time()
+        def_ids = self.id_reader.get_definition_ids(usage_ids)
+        try:
+            block_types = self.id_reader.get_block_types(def_ids)
+        except xblock.exceptions.NoSuchDefinition as e:
+            raise xblock.exceptions.NoSuchUsage(str(e))
+        blocks = [
+            self.construct_xblock(block_type, ScopeIds(
+                self.user_id, block_type, def_id, usage_id))
+            for usage_id, def_id, block_type
+            in zip(usage_ids, def_ids, block_types)]
+        if prefetch:
+            self.prefetch_fields(*blocks)
+        self.stats.record(
+            'get_blocks', latency=time.time() - start, items=len(blocks))
+        return blocks
+
+    def prefetch_fields(self, *blocks):
+        """Load all the fields of the blocks from the store in one batch."""
+        if self.key_value_store is None:
+            return
+        keys = []
+        for block in blocks:
+            keys.extend(field_keys(block.scope_ids, block.fields))
+        self.key_value_store.prefetch(keys)
+
+    def prefetch_tree(self, *blocks):
+        """Load the ids and fields of all the descendants of the blocks.
+
+        The tree is read a level at a time, resolving the children of each
+        level with one get_blocks() call, so that a subtree costs about as many
+        batched round trips as it is deep. Afterwards get_block() and field
+        reads for the descendants are served from the ID cache and the store's
+        snapshot. This is only an optimization, and quietly skips children
+        which do not exist.
+
+        Args:
+            *blocks: XBlock. The roots of the subtrees.
+
+        Returns:
+            list of XBlock. The descendants which were loaded.
+        """
+        return self._prefetch_tree(blocks)
+
+    def _prefetch_tree(self, blocks, skip=None):
+        """Load the descendants of the blocks, leaving out skipped subtrees.
+
+        Args:
+            blocks: list of XBlock. The roots of the subtrees.
+            skip: callable. Called with the blocks of each level, before their
+                fields are loaded, and returns the usage ids of those whose
+                fields and descendants need not be loaded.
+
+        Returns:
+            list of XBlock. The descendants which were loaded.
+        """
+        descendants = []
+        if not hasattr(self.id_reader, 'get_definition_ids'):
+            return descendants
+        start = time.time()
+        seen = set()
+        level = [
+            child_id for block in blocks
+            for child_id in getattr(block, 'children', [])]
+        while level:
+            seen.update(level)
+            children = self._get_existing_blocks(level)
+            if skip is not None:
+                skipped = skip(children)
+                children = [
+                    child for child in children
+                    if child.scope_ids.usage_id not in skipped]
+            self.prefetch_fields(*children)
+            descendants.extend(children)
+            level = [
+                child_id for child in children
+                for child_id in getattr(child, 'children', [])
+                if child_id not in seen]
+        self.stats.record(
+            'prefetch_tree', latency=time.time() - start, items=len(seen))
+        return descendants
+
+    def _get_existing_blocks(self, usage_ids):
+        """Create the blocks of those usage ids which exist, without fields.
+
+        The ids are resolved in one batch, or if any is missing, one at a
+        time so that only the missing ones are left out.
+
+        Args:
+            usage_ids: list of str. The usage ids of the blocks.
+
+        Returns:
+            list of XBlock. The blocks which exist, in the order of usage_ids.
+        """
+        try:
+            return self.get_blocks(usage_ids, prefetch=False)
+        except xblock.exceptions.NoSuchUsage:
+            pass
+        blocks = []
+        for usage_id in usage_ids:
+            try:
+                blocks.extend(self.get_blocks([usage_id], prefetch=False))
+            except xblock.exceptions.NoSuchUsage:
+                self.stats.record('prefetch_missing_usage')
+        return blocks
+
+    def publish(self, block, event):
+        """Buffer an event published by a block, to be written in a batch."""
+        self.event_buffer.add(
+            events.event_record(block, event, user_id=self.user_id))
+        self.stats.record('publish')
+
+    def flush_events(self):
+        """Write all the buffered events. Call at the end of the request."""
+        self.event_buffer.flush()
+
+    def parse_xml_node(self, node, id_generator):
+        """Create and save the block for an already parsed XML node.
+
+        This is parse_xml_string() for a node, as XBlock has no public method
+        for one. The block is saved without a parent. If the node is later
+        replaced by a stub in its parent's node, add_node_as_child() sets the
+        parent when the parent is created.
+
+        Args:
+            node: lxml.etree.Element. The node of the block.
+            id_generator: xblock.runtime.IdGenerator. Creates the ids of the
+                block and its descendants.
+
+        Returns:
+            str. The usage id of the block.
+        """
+        # pylint: disable=protected-access
+        return self._usage_id_from_node(node, None, id_generator)
+
+    def add_node_as_child(self, block, node, id_generator):
+        """Add the block for an XML node as a child of a block being parsed.
+
+        A stub node refers to a child which already exists. It is linked to
+        the parent without being created again.
+        """
+        usage_id = None
+        if node.tag == STUB_TAG:
+            usage_id = node.get(STUB_USAGE_ID_ATTR)
+        if usage_id is None:
+            super(Runtime, self).add_node_as_child(block, node, id_generator)
+            return
+
+        block.children.append(usage_id)
+        if self.key_value_store is not None:
+            self.key_value_store.set(xblock.runtime.KeyValueStore.Key(
+                scope=Scope.parent, user_id=None, block_scope_id=usage_id,
+                field_name='parent'), block.scope_ids.usage_id)
+
+    def add_block_as_child_node(self, block, node):
+        """Add the XML of a child block to the node of its parent."""
+        if self.export_child_stubs:
+            etree.SubElement(node, STUB_TAG, {
+                STUB_USAGE_ID_ATTR: block.scope_ids.usage_id})
+        else:
+            super(Runtime, self).add_block_as_child_node(block, node)
+
+    def render(self, block, view_name, context=None):
+        """Render a view of the block.
+
+        Views rendered without a context are served from the fragment cache
+        where it allows, before the fields of the block are loaded. Otherwise
+        the outermost render() call prefetches the subtree of the block, as
+        containers usually render all their children, leaving out descendants
+        whose view is in the fragment cache.
+        """
+        start = time.time()
+        use_cache = self.fragment_cache is not None and not context
+        cache_key = None
+        if use_cache:
+            fragment, cache_key = self.fragment_cache.get(
+                block, view_name, self._fragment_stamps)
+            if fragment is not None:
+                self.stats.record(
+                    'fragment_cache_hit', latency=time.time() - start)
+                return fragment
+
+        self.prefetch_fields(block)
+        if not self._render_depth:
+            skip = None
+            if use_cache:
+                skip = functools.partial(
+                    self.fragment_cache.find_cached, view_name=view_name,
+                    stamps=self._fragment_stamps)
+            self._prefetch_tree([block], skip=skip)
+
+        self._render_depth += 1
+        try:
+            fragment = super(Runtime, self).render(block, view_name, context)
+        finally:
+            self._render_depth -= 1
+        if cache_key is not None:
+            self.fragment_cache.put(cache_key, fragment)
+        self.stats.record('render', latency=time.time() - start)
+        return fragment
+
+    def handle(self, block, *args, **kwargs):
+        start = time.time()
+        self.prefetch_fields(block)
+        result = super(Runtime, self).handle(block, *args, **kwargs)
+        self.stats.record('handle', latency=time.time() - start)
+        return result
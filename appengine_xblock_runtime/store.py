@@ -16,9 +16,17 @@
 
 __author__ = 'John Orr (jorr@google.com)'
 
+import collections
 import json
+import random
+import threading
+import time
+
+import base
+import cache
+
 from xblock.fields import Scope
-import xblock.runtime
+from xblock.fields import UserScope
 
 from google.appengine.ext import ndb
 
@@ -26,19 +34,31 @@ from google.appengine.ext import ndb
 class BaseEntity(ndb.Model):
     """The base datastore entity for XBlock data.
 
-    XBlock data is stored in subclasses of this class. The data is wrapped
-    as a JSON blob held in the field 'data'. Subclasses provide convenience
-    accessor methods.
+    XBlock data is stored in subclasses of this class. The data is wrapped as
+    a dict in the compressed JSON property 'payload', which ndb decodes only
+    once per entity and then caches on the instance. Subclasses provide
+    convenience accessor methods.
+
+    Entities written by earlier versions of the runtime hold their data as a
+    JSON blob in the text field 'data'. These are still read, and are moved to
+    'payload' the next time they are put. See migrate_legacy_entities().
     """
     data = ndb.TextProperty(indexed=False)
+    payload = ndb.JsonProperty(indexed=False, compressed=True)
+
+    def _fields(self):
+        if self.payload is None:
+            self.payload = json.loads(self.data) if self.data else {}
+            self.data = None
+        return self.payload
 
     def _get(self, field_name):
-        return json.loads(self.data).get(field_name)
+        return self._fields().get(field_name)
 
     def _set(self, field_name, value):
-        json_dict = json.loads(self.data) if self.data else {}
-        json_dict[field_name] = value
-        self.data = json.dumps(json_dict)
+        fields = self._fields()
+        fields[field_name] = value
+        self.payload = fields
 
 
 class DefinitionEntity(BaseEntity):
@@ -63,7 +83,50 @@ class UsageEntity(BaseEntity):
         self._set('definition_id', value)
 
 
-class KeyValueEntity(BaseEntity):
+def _parse_key_string(ks):
+    """Split the id of a row, without its field name, into its parts.
+
+    Assumes that ids contain no dots, as is the case for generated ids.
+
+    Returns:
+        (str, str, str). The block scope prefix of the key string ('usage',
+        'definition', 'type', 'all', 'children' or 'parent'), and the block
+        id and user id, either of which may be None.
+    """
+    parts = ks.split('.')
+    block_scope, ids = parts[0], parts[1:]
+    if block_scope == 'all':
+        return block_scope, None, ids[0] if ids else None
+    return (
+        block_scope, ids[0] if ids else None,
+        ids[1] if len(ids) > 1 else None)
+
+
+class ScopedEntity(BaseEntity):
+    """A base for entities holding field values, indexed by block and user.
+
+    The indexed properties are worked out from the key name when the entity
+    is put, so that all the state of a user, or all the state held for a
+    block, can be queried. See iter_user_state() and iter_block_state().
+    Entities written before these were added are indexed by
+    index_scoped_entities().
+    """
+    block_scope = ndb.StringProperty()
+    block_id = ndb.StringProperty()
+    user_id = ndb.StringProperty()
+
+    def _row_id(self):
+        raise NotImplementedError()
+
+    def _pre_put_hook(self):
+        self.block_scope, self.block_id, self.user_id = _parse_key_string(
+            self._row_id())
+
+
+class KeyValueEntity(ScopedEntity):
+
+    def _row_id(self):
+        return self.key.id().rsplit('.', 1)[0]
 
     @property
     def value(self):
@@ -74,28 +137,776 @@ class KeyValueEntity(BaseEntity):
         self._set('value', value)
 
 
-def key_string(key):
-    key_list = []
-    if key.scope == Scope.children:
-        key_list.append('children')
-    elif key.scope == Scope.parent:
-        key_list.append('parent')
-    else:
-        key_list.append(
-            ['usage', 'definition', 'type', 'all'][key.scope.block])
+class FieldGroupEntity(ScopedEntity):
+    """The values of all the fields of a block in one scope.
 
-    if key.block_scope_id is not None:
-        key_list.append(key.block_scope_id)
-    if key.user_id:
-        key_list.append(key.user_id)
-    key_list.append(key.field_name)
-    return '.'.join(key_list)
+    For user scopes the group holds one user's values. The payload maps field
+    names to values. Used for the scopes which a KeyValueStore consolidates.
+    """
 
+    def _row_id(self):
+        return self.key.id()
 
-class KeyValueStore(xblock.runtime.KeyValueStore):
-    """Implementation of XBlock KeyValueStore using App Engine datastore."""
+    def get_field(self, field_name):
+        return self._get(field_name)
 
-    def get(self, key):
+    def has_field(self, field_name):
+        return field_name in self._fields()
+
+
+class CounterShardEntity(ndb.Model):
+    """One shard of a sharded counter.
+
+    The value of the counter is the sum of the counts in its shards, plus the
+    value of any KeyValueEntity held under the counter's own key.
+    """
+    count = ndb.GenericProperty(indexed=False)
+
+
+def _shard_keys(ks, num_shards):
+    return [
+        ndb.Key(CounterShardEntity, '%s#%d' % (ks, index))
+        for index in xrange(num_shards)]
+
+
+def _counter_entity(ks, kv_entity, shards):
+    shards = [shard for shard in shards if shard is not None]
+    if kv_entity is None and not shards:
+        return None
+    total = kv_entity.value if kv_entity is not None else 0
+    total += sum(shard.count for shard in shards)
+    counter = KeyValueEntity(key=ndb.Key(KeyValueEntity, ks))
+    counter.value = total
+    return counter
+
+
+@ndb.tasklet
+def _increment_counter_async(ks, num_shards, delta):
+    shard_key = ndb.Key(
+        CounterShardEntity, '%s#%d' % (ks, random.randrange(num_shards)))
+
+    @ndb.tasklet
+    def txn():
+        shard = yield shard_key.get_async()
+        if shard is None:
+            shard = CounterShardEntity(key=shard_key, count=0)
+        shard.count += delta
+        yield shard.put_async()
+
+    yield ndb.transaction_async(txn)
+
+
+# Kept here as part of the interface of this module.
+ContentionError = base.ContentionError
+key_string = base.key_string
+
+
+# The greatest number of entity groups written in one cross-group transaction.
+# The datastore allows 25, but the SDK used by the tests and the example
+# allows only 5.
+MAX_TRANSACTION_GROUPS = 5
+
+
+class TransactionTooLargeError(Exception):
+    """A transactional flush would write too many entity groups."""
+
+
+def _entity_value(entity):
+    # pylint: disable=protected-access
+    return (entity is not None, entity and entity._fields())
+
+
+def _field_entity(ks, group, field_name):
+    if group is None or not group.has_field(field_name):
+        return None
+    kv_entity = KeyValueEntity(key=ndb.Key(KeyValueEntity, ks))
+    kv_entity.value = group.get_field(field_name)
+    return kv_entity
+
+
+def migrate_legacy_entities(entity_class, batch_size=500):
+    """Rewrite all entities of a kind which still use the legacy encoding.
+
+    Args:
+        entity_class: subclass of BaseEntity. The kind to migrate.
+        batch_size: int. The number of entities read and written per batch.
+
+    Returns:
+        int. The number of entities which were rewritten.
+    """
+    count = 0
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = entity_class.query().fetch_page(
+            batch_size, start_cursor=cursor)
+        legacy = [entity for entity in entities if entity.payload is None]
+        for entity in legacy:
+            entity._fields()  # pylint: disable=protected-access
+        ndb.put_multi(legacy)
+        count += len(legacy)
+    return count
+
+
+def index_scoped_entities(entity_class, batch_size=500):
+    """Add the block and user index properties to entities which lack them.
+
+    Args:
+        entity_class: KeyValueEntity or FieldGroupEntity. The kind to index.
+        batch_size: int. The number of entities read and written per batch.
+
+    Returns:
+        int. The number of entities which were rewritten.
+    """
+    count = 0
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = entity_class.query().fetch_page(
+            batch_size, start_cursor=cursor)
+        unindexed = [
+            entity for entity in entities if entity.block_scope is None]
+        ndb.put_multi(unindexed)
+        count += len(unindexed)
+    return count
+
+
+def _iter_rows(query, batch_size):
+    """Yield (key string, value) for each field in the rows of the query."""
+    for entity_class in (KeyValueEntity, FieldGroupEntity):
+        cursor = None
+        more = True
+        while more:
+            entities, cursor, more = query(entity_class).fetch_page(
+                batch_size, start_cursor=cursor)
+            for entity in entities:
+                row_id = entity.key.id()
+                if entity_class is KeyValueEntity:
+                    yield row_id, entity.value
+                else:
+                    # pylint: disable=protected-access
+                    fields = entity._fields()
+                    for field_name in sorted(fields):
+                        yield '%s.%s' % (row_id, field_name), fields[field_name]
+
+
+def iter_user_state(user_id, batch_size=500):
+    """Stream all the field values held for one user.
+
+    Covers every user scope, from both per-field rows and field groups, and
+    reads them in batches with query cursors.
+
+    Args:
+        user_id: str. The id of the user.
+        batch_size: int. The number of entities read per batch.
+
+    Yields:
+        (str, object). The key_string() of each field and its value.
+    """
+    return _iter_rows(
+        lambda entity_class: entity_class.query(
+            entity_class.user_id == user_id),
+        batch_size)
+
+
+def iter_block_state(block_id, block_scope='usage', users_only=True,
+                     batch_size=500):
+    """Stream all the field values held for one block.
+
+    Sharded counters are read as their unsharded base value only.
+
+    Args:
+        block_id: str. The usage, definition or block type id of the block.
+        block_scope: str. The prefix of the key strings of the block's fields:
+            'usage' for the state of a usage, 'definition' for its content.
+        users_only: bool. Whether to skip fields not held for a user.
+        batch_size: int. The number of entities read per batch.
+
+    Yields:
+        (str, object). The key_string() of each field and its value.
+    """
+    def query(entity_class):
+        return entity_class.query(
+            entity_class.block_scope == block_scope,
+            entity_class.block_id == block_id)
+
+    for ks, value in _iter_rows(query, batch_size):
+        if not users_only or _parse_key_string(ks.rsplit('.', 1)[0])[2]:
+            yield ks, value
+
+
+def delete_user_state(user_id, batch_size=500):
+    """Delete all the field values held for one user.
+
+    Args:
+        user_id: str. The id of the user.
+        batch_size: int. The number of entities deleted per batch.
+
+    Returns:
+        int. The number of entities deleted.
+    """
+    count = 0
+    for entity_class in (KeyValueEntity, FieldGroupEntity):
+        query = entity_class.query(entity_class.user_id == user_id)
+        cursor = None
+        more = True
+        while more:
+            keys, cursor, more = query.fetch_page(
+                batch_size, start_cursor=cursor, keys_only=True)
+            ndb.delete_multi(keys)
+            for key in keys:
+                PROCESS_CACHE.delete(key)
+            count += len(keys)
+    return count
+
+
+CacheOptions = collections.namedtuple(
+    'CacheOptions', ['use_cache', 'use_memcache', 'process_ttl'])
+CacheOptions.__doc__ = """The cache layers used for the fields in a scope.
+
+Attributes:
+    use_cache: bool. Whether to use the ndb in-context cache.
+    use_memcache: bool. Whether to use memcache.
+    process_ttl: number. The number of seconds for which values are held in
+        the in-process cache shared by all requests on the instance, or None
+        if the in-process cache is not used.
+"""
+
+NDB_CACHE_OPTIONS = CacheOptions(
+    use_cache=True, use_memcache=True, process_ttl=None)
+
+# The options of reads which go straight to the datastore.
+_UNCACHED_OPTIONS = CacheOptions(
+    use_cache=False, use_memcache=False, process_ttl=None)
+
+# The in-process cache of field values shared by all requests on the instance.
+PROCESS_CACHE = cache.LRUCache(max_size=10000)
+
+
+class CachePolicy(object):
+    """Chooses the cache layers used for the fields in each scope.
+
+    Writes through a KeyValueStore remove the written keys from the in-process
+    cache of the instance which made them. Other instances may serve the old
+    value until its time to live has passed, so the in-process cache is best
+    suited to scopes which are seldom written, such as content and settings.
+
+    The policy counts, for each scope, the reads served by the in-process
+    cache and those passed on to ndb.
+    """
+
+    def __init__(
+            self, scope_options=None, default=NDB_CACHE_OPTIONS,
+            process_cache=None):
+        """Initialize the policy.
+
+        Args:
+            scope_options: dict. Maps xblock.fields.Scope to the CacheOptions
+                for fields in that scope.
+            default: CacheOptions. The options for any other scope.
+            process_cache: cache.LRUCache. The in-process cache to use. Defaults
+                to the instance-wide PROCESS_CACHE.
+        """
+        self._scope_options = scope_options or {}
+        self.default = default
+        self.process_cache = (
+            PROCESS_CACHE if process_cache is None else process_cache)
+        self._counts = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def options(self, scope):
+        return self._scope_options.get(scope, self.default)
+
+    def record(self, scope, event):
+        with self._lock:
+            self._counts[scope][event] += 1
+
+    def stats(self):
+        """Return the read counts and in-process hit rate for each scope.
+
+        Returns:
+            dict. Maps each scope which has been read to a dict of the
+            number of 'process_hits', 'process_misses' and 'ndb_reads', and
+            the 'process_hit_rate'.
+        """
+        with self._lock:
+            stats = {}
+            for scope, counts in self._counts.iteritems():
+                lookups = counts['process_hits'] + counts['process_misses']
+                stats[scope] = {
+                    'process_hits': counts['process_hits'],
+                    'process_misses': counts['process_misses'],
+                    'ndb_reads': counts['ndb_reads'],
+                    'process_hit_rate': (
+                        float(counts['process_hits']) / lookups
+                        if lookups else 0.0)}
+            return stats
+
+
+# The policy used by stores which are not given one. It uses ndb's defaults
+# for all scopes.
+DEFAULT_CACHE_POLICY = CachePolicy()
+
+# Marks a key which is absent from the in-process cache.
+_NOT_CACHED = object()
+
+
+def _process_cache_entity(row_key, payload_json):
+    if payload_json is None:
+        return None
+    entity_class = ndb.Model._kind_map[row_key.kind()]  # pylint: disable=W0212
+    return entity_class(key=row_key, payload=json.loads(payload_json))
+
+
+def _legacy_row_scope(ks):
+    # Assumes that ids contain no dots, as is the case for generated ids.
+    parts = ks.split('.')
+    if parts[0] == 'usage' and len(parts) == 4:
+        return Scope.user_state
+    if parts[0] == 'definition' and len(parts) == 3:
+        return Scope.content
+    return None
+
+
+def migrate_to_field_groups(
+        scopes=(Scope.user_state, Scope.content), batch_size=500,
+        delete_old=False):
+    """Copy per-field rows into the field groups of a consolidating store.
+
+    Values already present in a field group are not overwritten, so the
+    migration can be run while stores which consolidate the scopes are in use,
+    and can be safely re-run.
+
+    Args:
+        scopes: iterable of xblock.fields.Scope. The scopes to migrate. Only
+            Scope.user_state and Scope.content are supported.
+        batch_size: int. The number of rows read and written per batch.
+        delete_old: bool. Whether to delete the per-field rows once copied.
+
+    Returns:
+        int. The number of per-field rows which were copied.
+    """
+    count = 0
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = KeyValueEntity.query().fetch_page(
+            batch_size, start_cursor=cursor)
+        by_group = collections.defaultdict(list)
+        for kv_entity in entities:
+            ks = kv_entity.key.id()
+            if _legacy_row_scope(ks) in scopes:
+                group_id, field_name = ks.rsplit('.', 1)
+                by_group[group_id].append((field_name, kv_entity))
+
+        group_ids = by_group.keys()
+        groups = ndb.get_multi(
+            [ndb.Key(FieldGroupEntity, key_id) for key_id in group_ids])
+        for index, group_id in enumerate(group_ids):
+            group = groups[index] or FieldGroupEntity(id=group_id)
+            fields = group._fields()  # pylint: disable=protected-access
+            for field_name, kv_entity in by_group[group_id]:
+                fields.setdefault(field_name, kv_entity.value)
+            group.payload = fields
+            groups[index] = group
+            count += len(by_group[group_id])
+        ndb.put_multi(groups)
+
+        if delete_old:
+            ndb.delete_multi([
+                kv_entity.key for rows in by_group.itervalues()
+                for _, kv_entity in rows])
+    return count
+
+
+class KeyValueStore(base.BufferedKeyValueStore):
+    """Implementation of XBlock KeyValueStore using App Engine datastore.
+
+    By default each field value is stored in its own KeyValueEntity, keyed by
+    key_string(). The store can instead consolidate chosen scopes, keeping all
+    the values of a block's fields in one of those scopes (and for user
+    scopes, of one user) together in a single FieldGroupEntity. Use
+    migrate_to_field_groups() to copy existing per-field rows into groups.
+
+    The store keeps a snapshot of every entity it has loaded, whether in batch
+    through prefetch() or by single get() and has() calls, and records the
+    keys which were found to be absent. Later get() and has() calls for those
+    keys are served without further datastore RPCs, so that a has() followed
+    by a get() costs one lookup. A store instance is therefore request-scoped
+    and should not be shared between requests.
+
+    In buffered mode, sets and deletes are gathered in memory and written to
+    the datastore in one batch by flush(). Repeated writes to the same key are
+    merged, and reads see the buffered values.
+
+    A transactional flush writes the batch in a datastore transaction, and
+    first checks that none of the entities being written were changed by
+    another request since this store read them. This prevents lost updates
+    when the buffered values were computed from values read earlier. Each
+    per-field row is its own entity group, so a batch may span at most
+    MAX_TRANSACTION_GROUPS rows, or field groups in a consolidated scope.
+    Larger batches are refused. Consolidating Scope.user_state keeps all the
+    state of a user in a block in one entity group, however many fields a
+    handler writes.
+
+    Numeric fields in scopes shared between users can be declared as sharded
+    counters. Setting such a field adds the difference from its current value
+    to one of several randomly chosen shard entities, and reading it sums the
+    shards. This lets many students update a popular block concurrently.
+    Counter increments are applied in their own transactions, outside any
+    transactional flush.
+
+    The reads, writes and datastore calls made by the store are recorded in
+    its instrumentation.RequestStats. Write listeners are told of the keys
+    which have been set or deleted once the writes reach the datastore.
+    """
+
+    def __init__(
+            self, sharded_counters=None, cache_policy=None,
+            consolidated_scopes=(), stats=None, write_listeners=()):
+        """Initialize the store.
+
+        Args:
+            sharded_counters: dict. Maps (xblock.fields.Scope, str) pairs
+                naming numeric fields in scopes shared between users, such as
+                Scope.user_state_summary, which are to be stored as sharded
+                counters, to their number of shards.
+            cache_policy: CachePolicy. The cache layers to use for each scope.
+                Defaults to DEFAULT_CACHE_POLICY.
+            consolidated_scopes: iterable of xblock.fields.Scope. The scopes
+                whose fields are stored together in field groups.
+            stats: instrumentation.RequestStats. Records the operations made
+                by the store. A runtime sets this to its own stats if none
+                are given.
+            write_listeners: iterable of callable. Each is called with a list
+                of the xblock.runtime.KeyValueStore.Key which were written,
+                after they are written.
+        """
+        super(KeyValueStore, self).__init__(
+            stats=stats, write_listeners=write_listeners)
+        self._sharded_counters = sharded_counters or {}
+        self._cache_policy = cache_policy or DEFAULT_CACHE_POLICY
+        self._consolidated_scopes = frozenset(consolidated_scopes)
+        # The snapshot maps key strings to a KeyValueEntity holding the
+        # current value, or to None if the key is known to be absent. The
+        # pending writes and the originals are keyed by the ndb keys of the
+        # entities, and the originals are entities or None.
+        # Maps the ndb keys of field groups to their current FieldGroupEntity,
+        # or to None if the group is known to be absent.
+        self._groups = {}
+        # Maps key strings of sharded counters to be deleted to their number
+        # of shards, and of counters to be incremented to a list of their
+        # number of shards and the increment. Only used in buffered mode.
+        self._counter_deletes = {}
+        self._counter_deltas = {}
+        # Whether reads bypass the cache layers. Set once a transactional
+        # flush has found a conflicting write, as the ndb in-context cache
+        # still holds the values read before it, so that the values read on
+        # a retry are current.
+        self._read_uncached = False
+
+    def reset(self):
+        """Forget all loaded and buffered state, and leave buffered mode."""
+        super(KeyValueStore, self).reset()
+        self._groups = {}
+
+    def _clear_pending(self):
+        super(KeyValueStore, self)._clear_pending()
+        self._counter_deletes = {}
+        self._counter_deltas = {}
+
+    def _num_shards(self, key):
+        # Fields held for one user are never contended, and are not sharded.
+        if getattr(key.scope, 'user', None) == UserScope.ONE:
+            return 0
+        return self._sharded_counters.get((key.scope, key.field_name), 0)
+
+    def _is_grouped(self, key):
+        return (key.scope in self._consolidated_scopes and
+                not self._num_shards(key))
+
+    def _row_key(self, key):
+        """Return the ndb key of the entity which holds the value of the key."""
+        ks = key_string(key)
+        if self._is_grouped(key):
+            return ndb.Key(FieldGroupEntity, ks.rsplit('.', 1)[0])
+        return ndb.Key(KeyValueEntity, ks)
+
+    @ndb.tasklet
+    def _load_async(self, keys):
+        """Load the values of keys through the cache layers of the policy.
+
+        Args:
+            keys: iterable of xblock.runtime.KeyValueStore.Key. The keys to
+                load.
+
+        Returns:
+            dict. Maps the key string of each key to a KeyValueEntity holding
+            its value, or to None if it is absent. These are only for reading;
+            field group members and sharded counters are returned as unsaved
+            entities.
+        """
+        policy = self._cache_policy
+        rows = {}
+        groups = collections.defaultdict(list)
+        for key in keys:
+            row_key = self._row_key(key)
+            num_shards = self._num_shards(key)
+            if row_key in rows or row_key in self._groups:
+                continue
+            options = (
+                _UNCACHED_OPTIONS if self._read_uncached
+                else policy.options(key.scope))
+            if options.process_ttl is not None and not num_shards:
+                payload_json = policy.process_cache.get(row_key, _NOT_CACHED)
+                if payload_json is not _NOT_CACHED:
+                    policy.record(key.scope, 'process_hits')
+                    self.stats.record('process_cache_hit', key.scope)
+                    rows[row_key] = _process_cache_entity(
+                        row_key, payload_json)
+                    self._originals.setdefault(row_key, rows[row_key])
+                    continue
+                policy.record(key.scope, 'process_misses')
+            policy.record(key.scope, 'ndb_reads')
+            rows[row_key] = None
+            groups[options].append((row_key, num_shards))
+
+        results = []
+        if groups:
+            results = yield [
+                self._load_from_ndb_async(
+                    items, use_cache=group_options.use_cache,
+                    use_memcache=group_options.use_memcache)
+                for group_options, items in groups.iteritems()]
+        for options, group_rows in zip(groups, results):
+            rows.update(group_rows)
+            if options.process_ttl is None:
+                continue
+            for row_key, num_shards in groups[options]:
+                if not num_shards:
+                    # pylint: disable=W0212
+                    entity = group_rows[row_key]
+                    policy.process_cache.put(
+                        row_key, None if entity is None
+                        else json.dumps(entity._fields()),
+                        ttl=options.process_ttl)
+
+        loaded = {}
+        for key in keys:
+            ks = key_string(key)
+            row_key = self._row_key(key)
+            if row_key.kind() == FieldGroupEntity._get_kind():
+                group = self._groups.setdefault(row_key, rows.get(row_key))
+                loaded[ks] = _field_entity(ks, group, key.field_name)
+            else:
+                loaded[ks] = rows[row_key]
+        raise ndb.Return(loaded)
+
+    @ndb.tasklet
+    def _load_from_ndb_async(self, items, **ctx_options):
+        ndb_keys = []
+        for row_key, num_shards in items:
+            ndb_keys.append(row_key)
+            ndb_keys.extend(_shard_keys(row_key.id(), num_shards))
+        start = time.time()
+        entities = yield ndb.get_multi_async(ndb_keys, **ctx_options)
+        self.stats.record(
+            'datastore_get', latency=time.time() - start, items=len(ndb_keys))
+
+        rows = {}
+        position = 0
+        for row_key, num_shards in items:
+            entity = entities[position]
+            if num_shards:
+                shards = entities[position + 1:position + 1 + num_shards]
+                entity = _counter_entity(row_key.id(), entity, shards)
+            else:
+                self._originals.setdefault(row_key, entity)
+            position += 1 + num_shards
+            rows[row_key] = entity
+        raise ndb.Return(rows)
+
+    def _record_writes(self, start, entities, delete_keys):
+        if entities:
+            self.stats.record(
+                'datastore_put', latency=time.time() - start,
+                items=len(entities))
+        if delete_keys:
+            self.stats.record(
+                'datastore_delete', latency=time.time() - start,
+                items=len(delete_keys))
+
+    def _invalidate(self, row_keys):
+        for row_key in row_keys:
+            self._cache_policy.process_cache.delete(row_key)
+
+    def _forget_written(self, row_keys):
+        """Drop the cached and originally read values of written rows."""
+        self._invalidate(row_keys)
+        super(KeyValueStore, self)._forget_written(row_keys)
+
+    def _take_pending_entities(self):
+        """Return the buffered writes, and leave buffered mode.
+
+        Returns:
+            (list, list, list, dict, dict). The entities to be put, the ndb
+            keys of those to be deleted, the keys for the write listeners, and
+            the sharded counters to be deleted and incremented.
+        """
+        counter_deletes = self._counter_deletes
+        counter_deltas = self._counter_deltas
+        puts, delete_keys, written_keys = self._take_pending()
+        return (puts.values(), delete_keys, written_keys,
+                counter_deletes, counter_deltas)
+
+    @ndb.tasklet
+    def _flush_counters_async(self, counter_deletes, counter_deltas):
+        delete_keys = []
+        for ks, num_shards in counter_deletes.iteritems():
+            delete_keys.append(ndb.Key(KeyValueEntity, ks))
+            delete_keys.extend(_shard_keys(ks, num_shards))
+        if delete_keys:
+            yield ndb.delete_multi_async(delete_keys)
+        increments = [
+            _increment_counter_async(ks, num_shards, delta)
+            for ks, (num_shards, delta) in counter_deltas.iteritems()
+            if delta]
+        if increments:
+            start = time.time()
+            yield increments
+            self.stats.record(
+                'counter_increment', latency=time.time() - start,
+                items=len(increments))
+
+    @ndb.tasklet
+    def flush_async(self):
+        """Write all buffered sets and deletes, and leave buffered mode."""
+        (entities, delete_keys, written_keys,
+         counter_deletes, counter_deltas) = self._take_pending_entities()
+        start = time.time()
+        yield (
+            ndb.put_multi_async(entities) +
+            ndb.delete_multi_async(delete_keys) +
+            [self._flush_counters_async(counter_deletes, counter_deltas)])
+        self._record_writes(start, entities, delete_keys)
+        self._forget_written(
+            [entity.key for entity in entities] + delete_keys)
+        self._notify(written_keys)
+
+    def flush(self, transactional=False, retries=3):
+        """Write all buffered sets and deletes, and leave buffered mode.
+
+        A transaction can write no more than MAX_TRANSACTION_GROUPS entity
+        groups, that is per-field rows or field groups.
+
+        Args:
+            transactional: bool. Whether to write in a transaction which
+                checks for conflicting writes by other requests.
+            retries: int. The number of times a transaction which collides
+                with another one is retried.
+
+        Raises:
+            ContentionError: If transactional, and an entity being written
+                has been changed since it was read by this store. Later reads
+                by the store bypass the caches, so that a retry after reset()
+                sees the current values.
+            TransactionTooLargeError: If transactional, and the writes span
+                more than MAX_TRANSACTION_GROUPS entity groups. Nothing is
+                written, and the buffered writes are dropped.
+        """
+        if not transactional:
+            self.flush_async().get_result()
+            return
+
+        (entities, delete_keys, written_keys,
+         counter_deletes, counter_deltas) = self._take_pending_entities()
+        written = [entity.key for entity in entities] + delete_keys
+        if len(written) > MAX_TRANSACTION_GROUPS:
+            raise TransactionTooLargeError(
+                'A transaction cannot write %d entity groups' % len(written))
+        expected = self._expected(written)
+        read_keys = expected.keys()
+
+        def check_and_write():
+            current = ndb.get_multi(
+                read_keys, use_cache=False, use_memcache=False)
+            for key, entity in zip(read_keys, current):
+                if _entity_value(entity) != _entity_value(expected[key]):
+                    self._invalidate([key])
+                    self._read_uncached = True
+                    raise ContentionError(key.id())
+            ndb.put_multi(entities)
+            ndb.delete_multi(delete_keys)
+
+        start = time.time()
+        ndb.transaction(check_and_write, retries=retries, xg=len(written) > 1)
+        self._record_writes(start, entities, delete_keys)
+        self._forget_written(written)
+        self._flush_counters_async(
+            counter_deletes, counter_deltas).get_result()
+        self._notify(written_keys)
+
+    def discard(self):
+        """Drop all buffered writes, and leave buffered mode."""
+        super(KeyValueStore, self).discard()
+        self._groups = {}
+
+    @ndb.tasklet
+    def prefetch_async(self, keys):
+        """Load the given keys into the snapshot with a single batch get.
+
+        Args:
+            keys: iterable of xblock.runtime.KeyValueStore.Key. The keys which
+                will be read later in the request.
+        """
+        missing = dict(
+            (key_string(key), key) for key in keys
+            if key_string(key) not in self._snapshot)
+        if not missing:
+            return
+        start = time.time()
+        loaded = yield self._load_async(missing.values())
+        for ks, kv_entity in loaded.iteritems():
+            self._snapshot.setdefault(ks, kv_entity)
+        self.stats.record(
+            'prefetch', latency=time.time() - start, items=len(missing))
+
+    def prefetch(self, keys):
+        self.prefetch_async(keys).get_result()
+
+    @ndb.tasklet
+    def get_many_async(self, keys):
+        """Retrieve the values for several keys with a single batch get.
+
+        Args:
+            keys: list of xblock.runtime.KeyValueStore.Key. The keys being
+                retrieved.
+
+        Returns:
+            dict. Maps each key which is present in the store to its value.
+            Keys which are absent are omitted.
+        """
+        yield self.prefetch_async(keys)
+        values = {}
+        for key in keys:
+            kv_entity = self._snapshot[key_string(key)]
+            if kv_entity is not None:
+                values[key] = kv_entity.value
+        raise ndb.Return(values)
+
+    def get_many(self, keys):
+        return self.get_many_async(keys).get_result()
+
+    @ndb.tasklet
+    def _get_entity_async(self, key):
+        ks = key_string(key)
+        if ks in self._snapshot:
+            raise ndb.Return(self._snapshot[ks])
+        loaded = yield self._load_async([key])
+        raise ndb.Return(self._snapshot.setdefault(ks, loaded[ks]))
+
+    @ndb.tasklet
+    def get_async(self, key):
         """Retrieve the value for the given key.
 
         Args:
@@ -107,32 +918,189 @@ class KeyValueStore(xblock.runtime.KeyValueStore):
         Raises:
             KeyError: If there is no matching key in the store.
         """
-        kv_entity = ndb.Key(KeyValueEntity, key_string(key)).get()
+        start = time.time()
+        kv_entity = yield self._get_entity_async(key)
         if kv_entity is None:
+            self.stats.record('get', key.scope, latency=time.time() - start)
             raise KeyError()
-        return kv_entity.value
+        value = kv_entity.value
+        self.stats.record(
+            'get', key.scope, latency=time.time() - start,
+            payload_bytes=self.stats.payload_size(value))
+        raise ndb.Return(value)
 
-    def set(self, key, value):
+    def get(self, key):
+        return self.get_async(key).get_result()
+
+    @ndb.tasklet
+    def _write_row_async(self, entity_or_key):
+        if isinstance(entity_or_key, ndb.Key):
+            row_key, entity = entity_or_key, None
+        else:
+            row_key, entity = entity_or_key.key, entity_or_key
+        if self.buffering:
+            self._pending[row_key] = base.DELETED if entity is None else entity
+            return
+        start = time.time()
+        if entity is None:
+            yield row_key.delete_async()
+            self._record_writes(start, [], [row_key])
+        else:
+            yield entity.put_async()
+            self._record_writes(start, [entity], [])
+        self._forget_written([row_key])
+
+    @ndb.tasklet
+    def _update_groups_async(self, changes):
+        """Apply changes to the fields of field groups, writing each once.
+
+        The groups are loaded first. The changes are then applied to the
+        groups held in self._groups in a single step, with no yield between
+        reading a group and replacing it, so that concurrent updates of the
+        same group are not lost.
+
+        Args:
+            changes: list of (xblock.runtime.KeyValueStore.Key, object). The
+                keys of grouped fields and their new values, or base.DELETED for
+                fields to be deleted.
+        """
+        missing = [
+            key for key, _ in changes if self._row_key(key) not in self._groups]
+        if missing:
+            yield self._load_async(missing)
+
+        fields_by_group = {}
+        for key, value in changes:
+            row_key = self._row_key(key)
+            if row_key not in fields_by_group:
+                group = self._groups[row_key]
+                fields_by_group[row_key] = (
+                    dict(group._fields()) if group  # pylint: disable=W0212
+                    else {})
+            if value is base.DELETED:
+                fields_by_group[row_key].pop(key.field_name, None)
+            else:
+                fields_by_group[row_key][key.field_name] = value
+
+        writes = []
+        for row_key, fields in fields_by_group.iteritems():
+            if fields:
+                group = FieldGroupEntity(key=row_key, payload=fields)
+                self._groups[row_key] = group
+                writes.append(self._write_row_async(group))
+            else:
+                self._groups[row_key] = None
+                writes.append(self._write_row_async(row_key))
+        yield writes
+
+    @ndb.tasklet
+    def _set_counter_async(self, key, value):
+        if not isinstance(value, (int, long, float)):
+            raise TypeError(
+                'Sharded counter %s must be numeric' % key.field_name)
+        ks = key_string(key)
+        num_shards = self._num_shards(key)
+        current = yield self._get_entity_async(key)
+        delta = value - (current.value if current is not None else 0)
+
+        counter = KeyValueEntity(key=ndb.Key(KeyValueEntity, ks))
+        counter.value = value
+        self._snapshot[ks] = counter
+        if self.buffering:
+            pending = self._counter_deltas.setdefault(ks, [num_shards, 0])
+            pending[1] += delta
+        else:
+            start = time.time()
+            yield _increment_counter_async(ks, num_shards, delta)
+            self.stats.record(
+                'counter_increment', key.scope, latency=time.time() - start)
+
+    @ndb.tasklet
+    def _set_values_async(self, items):
+        """Set several values, updating each field group once.
+
+        Args:
+            items: list of (xblock.runtime.KeyValueStore.Key, object). The
+                keys and their new values.
+        """
+        start = time.time()
+        writes = []
+        grouped = []
+        rows = []
+        for key, value in items:
+            if self._num_shards(key):
+                writes.append(self._set_counter_async(key, value))
+                continue
+            ks = key_string(key)
+            kv_entity = KeyValueEntity(key=ndb.Key(KeyValueEntity, ks))
+            kv_entity.value = value
+            rows.append((ks, kv_entity))
+            if self._is_grouped(key):
+                grouped.append((key, value))
+            else:
+                writes.append(self._write_row_async(kv_entity))
+        if grouped:
+            writes.append(self._update_groups_async(grouped))
+        if writes:
+            yield writes
+
+        self._snapshot.update(rows)
+        for key, value in items:
+            self._written(key)
+            self.stats.record(
+                'set', key.scope, latency=time.time() - start,
+                payload_bytes=self.stats.payload_size(value))
+
+    def set_async(self, key, value):
         """Sets the given value in the store. Overwrite any previous value."""
-        key = ndb.Key(KeyValueEntity, key_string(key))
-        kv_entity = KeyValueEntity(key=key)
-        kv_entity.value = value
-        kv_entity.put()
+        return self._set_values_async([(key, value)])
+
+    def set(self, key, value):
+        self.set_async(key, value).get_result()
 
     def set_many(self, update_dict):
-        entities = []
-        for key, value in update_dict.iteritems():
-            ndb_key = ndb.Key(KeyValueEntity, key_string(key))
-            kv_entity = KeyValueEntity(key=ndb_key)
-            kv_entity.value = value
-            entities.append(kv_entity)
-        ndb.put_multi(entities)
+        """Sets several values, writing them to the datastore in one batch."""
+        buffering = self.buffering
+        self.start_buffering()
+        try:
+            self._set_values_async(update_dict.items()).get_result()
+        except:
+            if not buffering:
+                self.discard()
+            raise
+        if not buffering:
+            self.flush()
 
-    def delete(self, key):
+    @ndb.tasklet
+    def delete_async(self, key):
         """Deletes the given key from the store. No-op if the key is absent."""
-        ndb.Key(KeyValueEntity, key_string(key)).delete()
+        start = time.time()
+        ks = key_string(key)
+        num_shards = self._num_shards(key)
+        if num_shards and self.buffering:
+            self._counter_deletes[ks] = num_shards
+            self._counter_deltas.pop(ks, None)
+        elif num_shards:
+            yield ndb.delete_multi_async(
+                [ndb.Key(KeyValueEntity, ks)] + _shard_keys(ks, num_shards))
+        elif key.scope in self._consolidated_scopes:
+            yield self._update_groups_async([(key, base.DELETED)])
+        else:
+            yield self._write_row_async(ndb.Key(KeyValueEntity, ks))
+        self._snapshot[ks] = None
+        self._written(key)
+        self.stats.record('delete', key.scope, latency=time.time() - start)
 
-    def has(self, key):
+    def delete(self, key):
+        self.delete_async(key).get_result()
+
+    @ndb.tasklet
+    def has_async(self, key):
         """Checks whether the key already has a value set in the store."""
-        return ndb.Key(KeyValueEntity, key_string(key)).get(
-            use_memcache=False) is not None
+        start = time.time()
+        kv_entity = yield self._get_entity_async(key)
+        self.stats.record('has', key.scope, latency=time.time() - start)
+        raise ndb.Return(kv_entity is not None)
+
+    def has(self, key):
+        return self.has_async(key).get_result()
@@ -0,0 +1,404 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for the hot paths of the App Engine XBlock runtime.
+
+Measures importing a course with parse_xml_string, loading its root block
+with get_block, rendering the student_view, invoking a handler and exporting
+with export_to_xml, over generated trees of blocks and a number of students.
+Also measures the first lookups of block classes, as made by a new instance.
+
+The runtime is run either on the App Engine testbed stubs or on one of the
+local storage backends. For each benchmark, one JSON object is written per
+line, giving the wall time, the number of storage RPCs, the number of bytes
+serialized in those RPCs and the peak memory used. The local
+backends share the snapshot and write buffering of the datastore store, but
+not its cache policy, sharded counters or field groups, so use the testbed to
+measure those.
+
+The peak memory of a benchmark is measured by running it once in a forked
+copy of the process, as the peak RSS of a process only ever grows, and so
+would hide the memory used by a benchmark which uses less than an earlier
+one. The copy is discarded, and the benchmark is then run again for the other
+measurements, so each benchmark takes about twice as long as it measures.
+
+Usage:
+    python benchmarks/run_benchmarks.py [--backend testbed|memory|sqlite]
+        [--blocks 10,100,1000] [--students 1,10,100] [--cold]
+        [--output FILE]
+"""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+from cStringIO import StringIO
+import gc
+import json
+import optparse
+import os
+import resource
+import sys
+import time
+
+from appengine_xblock_runtime import backends
+from appengine_xblock_runtime import registry
+from appengine_xblock_runtime import runtime
+from appengine_xblock_runtime import store
+import webob
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+
+_LEAVES = [
+    '<html_demo>Some text for the benchmark</html_demo>',
+    '<slider_demo/>',
+    '<thumbs/>']
+
+
+def tree_xml(num_blocks, branching=10):
+    """Generate the XML of a tree with the given number of blocks.
+
+    The interior nodes are vertical_demo blocks with up to `branching`
+    children each, and the leaves cycle through the demo block types.
+    """
+    leaf_count = [0]
+
+    def build(size):
+        if size == 1:
+            leaf_count[0] += 1
+            return _LEAVES[leaf_count[0] % len(_LEAVES)]
+        remaining = size - 1
+        num_children = min(branching, remaining)
+        children = []
+        for index in xrange(num_children):
+            child_size = remaining // (num_children - index)
+            children.append(build(child_size))
+            remaining -= child_size
+        return '<vertical_demo>%s</vertical_demo>' % ''.join(children)
+
+    return build(num_blocks)
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _measure_memory(func):
+    """Run func in a forked child and return its peak RSS, and the growth.
+
+    On Linux the peak RSS of a forked child starts at the current RSS of the
+    parent, rather than at the parent's peak. The child runs func on a copy of
+    the parent's state, which is discarded when it exits.
+
+    Returns:
+        (int, int). The peak RSS of the child and its growth while running
+        func, in kilobytes, or (None, None) if func failed.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        os.close(read_fd)
+        try:
+            before = _peak_rss_kb()
+            func()
+            after = _peak_rss_kb()
+            os.write(write_fd, json.dumps([after, after - before]))
+        finally:
+            os._exit(0)  # pylint: disable=W0212
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        data = pipe.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else (None, None)
+
+
+class BenchmarkRuntime(runtime.Runtime):
+    """A runtime with trivial implementations of the URL and event hooks."""
+
+    def handler_url(
+            self, block, handler_name, suffix='', query='', thirdparty=False):
+        return '/handler/%s/%s/' % (block.scope_ids.usage_id, handler_name)
+
+    def resource_url(self, resource_name):
+        return '/static/%s' % resource_name
+
+    def local_resource_url(self, block, uri):
+        return '/local_resource/%s/%s' % (block.scope_ids.block_type, uri)
+
+    def publish(self, block, event):
+        pass
+
+
+class TestbedEnvironment(object):
+    """Runs the runtime on the testbed's datastore and memcache stubs."""
+
+    name = 'testbed'
+
+    def __init__(self):
+        self.rpcs = 0
+        self.bytes = 0
+        self._testbed = testbed.Testbed()
+        self._testbed.activate()
+        self._testbed.init_datastore_v3_stub()
+        self._testbed.init_memcache_stub()
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'benchmark_pre', self._pre_call, 'datastore_v3')
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark_post', self._post_call, 'datastore_v3')
+
+    def _pre_call(self, service, call, request, response):
+        self.rpcs += 1
+        self.bytes += request.ByteSize()
+
+    def _post_call(self, service, call, request, response):
+        self.bytes += response.ByteSize()
+
+    def make_runtime(self, student_id=None):
+        return BenchmarkRuntime(student_id=student_id)
+
+    def make_id_generator(self):
+        return runtime.BatchingIdGenerator()
+
+    def start_request(self, cold):
+        ndb.get_context().clear_cache()
+        if cold:
+            runtime.ID_CACHE.clear()
+            store.PROCESS_CACHE.clear()
+            memcache.flush_all()
+
+    def close(self):
+        self._testbed.deactivate()
+
+
+class CountingBackend(backends.Backend):
+    """Wraps a backend to count its calls and the bytes they serialize."""
+
+    def __init__(self, backend):
+        self._backend = backend
+        self.rpcs = 0
+        self.bytes = 0
+
+    def get_multi(self, table, keys):
+        self.rpcs += 1
+        values = self._backend.get_multi(table, keys)
+        self.bytes += len(json.dumps(values))
+        return values
+
+    def write_multi(self, table, puts, deletes, expected=None):
+        self.rpcs += 1
+        self.bytes += len(json.dumps(puts))
+        self._backend.write_multi(table, puts, deletes, expected=expected)
+
+
+class BackendEnvironment(object):
+    """Runs the runtime on a local storage backend."""
+
+    def __init__(self, name, backend):
+        self.name = name
+        self._backend = CountingBackend(backend)
+
+    @property
+    def rpcs(self):
+        return self._backend.rpcs
+
+    @property
+    def bytes(self):
+        return self._backend.bytes
+
+    def make_runtime(self, student_id=None):
+        return BenchmarkRuntime(
+            student_id=student_id,
+            id_reader=backends.IdReader(self._backend),
+            key_value_store=backends.KeyValueStore(self._backend))
+
+    def make_id_generator(self):
+        return backends.IdGenerator(self._backend)
+
+    def start_request(self, cold):
+        pass
+
+    def close(self):
+        pass
+
+
+def make_environment(name):
+    if name == 'testbed':
+        return TestbedEnvironment()
+    elif name == 'memory':
+        return BackendEnvironment(name, backends.MemoryBackend())
+    elif name == 'sqlite':
+        return BackendEnvironment(name, backends.SqliteBackend())
+    raise ValueError('Unknown backend %s' % name)
+
+
+class Benchmarks(object):
+    """Runs the benchmarks in one environment and collects the results."""
+
+    def __init__(self, env, cold=False):
+        self.env = env
+        self.cold = cold
+        self.results = []
+
+    def measure(self, benchmark, params, requests, func):
+        """Run func, which makes `requests` requests, and record its costs."""
+        gc.collect()
+        peak_rss, rss_growth = _measure_memory(func)
+        rpcs_before = self.env.rpcs
+        bytes_before = self.env.bytes
+        start = time.time()
+        func()
+        wall_time = time.time() - start
+
+        result = {
+            'benchmark': benchmark,
+            'backend': self.env.name,
+            'cold': self.cold,
+            'requests': requests,
+            'wall_time_s': wall_time,
+            'wall_time_per_request_s': wall_time / requests,
+            'rpcs': self.env.rpcs - rpcs_before,
+            'rpcs_per_request': float(
+                self.env.rpcs - rpcs_before) / requests,
+            'bytes_serialized': self.env.bytes - bytes_before,
+            'peak_rss_kb': peak_rss,
+            'peak_rss_growth_kb': rss_growth}
+        result.update(params)
+        self.results.append(result)
+        return result
+
+    def _request(self, student_id=None):
+        self.env.start_request(self.cold)
+        return self.env.make_runtime(student_id=student_id)
+
+    def _find_block_type(self, usage_id, block_type):
+        rt = self._request()
+        pending = [usage_id]
+        while pending:
+            block = rt.get_block(pending.pop(0))
+            if block.scope_ids.block_type == block_type:
+                return block.scope_ids.usage_id
+            pending.extend(getattr(block, 'children', []))
+        return None
+
+    def run_startup(self, output):
+        """Measure the first lookups of block classes in a new registry."""
+        class_registry = registry.BlockTypeRegistry()
+        block_types = ['vertical_demo', 'html_demo', 'slider_demo', 'thumbs']
+        result = self.measure(
+            'load_block_classes', {'block_types': len(block_types)}, 1,
+            lambda: class_registry.preload(block_types))
+        result['index_time_s'] = class_registry.index_time
+        output(result)
+
+    def run_tree(self, num_blocks, student_counts, output):
+        """Run all the benchmarks for one tree size."""
+        params = {'blocks': num_blocks}
+        xml = tree_xml(num_blocks)
+        usage_ids = []
+
+        def import_tree():
+            rt = self._request()
+            id_generator = self.env.make_id_generator()
+            with rt.buffered_writes():
+                usage_ids.append(rt.parse_xml_string(xml, id_generator))
+                if hasattr(id_generator, 'flush'):
+                    id_generator.flush()
+
+        output(self.measure('parse_xml_string', params, 1, import_tree))
+        root_id = usage_ids[0]
+
+        output(self.measure(
+            'get_block', params, 1,
+            lambda: self._request().get_block(root_id)))
+
+        def export_tree():
+            rt = self._request()
+            rt.export_to_xml(rt.get_block(root_id), StringIO())
+
+        output(self.measure('export_to_xml', params, 1, export_tree))
+
+        thumbs_id = self._find_block_type(root_id, 'thumbs')
+        for num_students in student_counts:
+            student_params = dict(params, students=num_students)
+
+            def render_for_students():
+                for index in xrange(num_students):
+                    rt = self._request(student_id='student%d' % index)
+                    rt.render(rt.get_block(root_id), 'student_view')
+
+            output(self.measure(
+                'render_student_view', student_params, num_students,
+                render_for_students))
+
+            if thumbs_id is None:
+                continue
+
+            def handle_for_students():
+                for index in xrange(num_students):
+                    rt = self._request(student_id='student%d' % index)
+                    request = webob.Request.blank('/')
+                    request.method = 'POST'
+                    request.body = json.dumps({'voteType': 'up'})
+                    rt.handle_transactionally(thumbs_id, 'vote', request)
+
+            output(self.measure(
+                'handle', student_params, num_students, handle_for_students))
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option(
+        '--backend', default='testbed',
+        help='One of testbed, memory or sqlite. Default: %default')
+    parser.add_option(
+        '--blocks', default='10,100,1000',
+        help='Comma-separated tree sizes. Default: %default')
+    parser.add_option(
+        '--students', default='1,10,100',
+        help='Comma-separated numbers of students. Default: %default')
+    parser.add_option(
+        '--cold', action='store_true', default=False,
+        help='Clear the instance caches and memcache before each request.')
+    parser.add_option(
+        '--output', default=None,
+        help='File to write the JSON lines to. Default: stdout')
+    options, _ = parser.parse_args(argv)
+
+    out = open(options.output, 'w') if options.output else sys.stdout
+
+    def output(result):
+        out.write(json.dumps(result, sort_keys=True) + '\n')
+        out.flush()
+
+    env = make_environment(options.backend)
+    try:
+        benchmarks = Benchmarks(env, cold=options.cold)
+        benchmarks.run_startup(output)
+        for num_blocks in _int_list(options.blocks):
+            benchmarks.run_tree(
+                num_blocks, _int_list(options.students), output)
+    finally:
+        env.close()
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
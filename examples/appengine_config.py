@@ -16,13 +16,17 @@
 
 __author__ = 'John Orr (jorr@google.com)'
 
+import logging
 import os
+import time
+
 import pkg_resources
 
 
 # this is the official location of this app for computing of all relative paths
 BUNDLE_ROOT = os.path.dirname(__file__)
 
+_start = time.time()
 eggs = [
     'appengine_xblock_runtime',
     'XBlock',
@@ -31,3 +35,9 @@ eggs = [
 for egg in eggs:
     egg = os.path.join(BUNDLE_ROOT, 'lib', egg)
     pkg_resources.working_set.add_entry(egg)
+
+# Only the egg metadata is read here. The modules of each block type are
+# imported when the type is first used, by registry.BlockTypeRegistry.
+logging.info(
+    'Added %d XBlock eggs in %.1f ms', len(eggs),
+    (time.time() - _start) * 1000)
@@ -16,30 +16,165 @@
 
 __author__ = 'John Orr (jorr@google.com)'
 
-from cStringIO import StringIO
+import calendar
+import hashlib
 import json
 import logging
 import mimetypes
 import os
+import re
+import time
 import urllib
 
+import appengine_xblock_runtime.bundles
+import appengine_xblock_runtime.cache
+import appengine_xblock_runtime.events
+import appengine_xblock_runtime.exporter
+import appengine_xblock_runtime.fragment_cache
+import appengine_xblock_runtime.importer
+import appengine_xblock_runtime.instrumentation
+import appengine_xblock_runtime.registry
 import appengine_xblock_runtime.runtime
+import appengine_xblock_runtime.store
 import django.template.loader
 import jinja2
 import webapp2
-from workbench.runtime import _BlockSet
-from xblock.core import XBlock
+import webob
+from xblock.fields import Scope
 from xblock.fragment import Fragment
+from xblock.plugin import PluginMissingError
 
 from google.appengine.api import users
 
 
+# Fields shared between all students which are written by many of them, and
+# so are stored as sharded counters, mapped to their number of shards.
+SHARDED_COUNTERS = {
+    (Scope.user_state_summary, 'upvotes'): 20,
+    (Scope.user_state_summary, 'downvotes'): 20}
+
+# Authored content is read on every page view but is seldom written, so it is
+# also held in memory on each instance for a short time.
+_AUTHORED_CACHE_OPTIONS = appengine_xblock_runtime.store.CacheOptions(
+    use_cache=True, use_memcache=True, process_ttl=60)
+CACHE_POLICY = appengine_xblock_runtime.store.CachePolicy({
+    Scope.content: _AUTHORED_CACHE_OPTIONS,
+    Scope.settings: _AUTHORED_CACHE_OPTIONS,
+    Scope.children: _AUTHORED_CACHE_OPTIONS})
+
+# The views whose output depends only on the content and settings of a block,
+# and so is rendered once and then served from the fragment cache.
+FRAGMENT_CACHE = appengine_xblock_runtime.fragment_cache.FragmentCache(
+    [('html_demo', 'student_view')], cache_policy=CACHE_POLICY)
+
+# The Jinja environment shared by all page handlers. Templates are compiled once
+# and then held in its cache; they are not reloaded when the files change, as
+# they cannot change within a deployed version.
+TEMPLATE_ENV = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(
+        os.path.join(os.path.dirname(__file__), 'templates')),
+    extensions=['jinja2.ext.autoescape'],
+    autoescape=True,
+    auto_reload=False,
+    cache_size=100)
+
+# Compiled Django templates used by blocks, keyed by name.
+_DJANGO_TEMPLATES = appengine_xblock_runtime.cache.LRUCache(max_size=200)
+
+# The local resources of blocks, keyed by block type and path, as tuples of
+# the body, its ETag and its time of last modification. Larger resources are
+# always read from disk, which bounds the memory held.
+_RESOURCES = appengine_xblock_runtime.cache.LRUCache(max_size=200)
+_MAX_CACHED_RESOURCE_SIZE = 128 * 1024
+
+# Resources are deployed with the application, and so are taken to have been
+# modified when the instance started.
+_STARTUP_TIME = int(time.time())
+
+
+def get_django_template(template_name):
+    """Return the compiled Django template, compiling it on first use."""
+    template = _DJANGO_TEMPLATES.get(template_name)
+    if template is None:
+        template = django.template.loader.get_template(template_name)
+        _DJANGO_TEMPLATES.put(template_name, template)
+    return template
+
+
+def precompile_templates(django_template_names=()):
+    """Compile the page templates, and any named Django templates.
+
+    Called when an instance starts, so that requests do not wait for it.
+
+    Args:
+        django_template_names: iterable of str. The names of Django templates
+            used by blocks which are to be compiled too.
+    """
+    for template_name in TEMPLATE_ENV.list_templates():
+        TEMPLATE_ENV.get_template(template_name)
+    for template_name in django_template_names:
+        get_django_template(template_name)
+
+
+def _load_resource(block_type, resource):
+    cache_key = (block_type, resource)
+    cached = _RESOURCES.get(cache_key)
+    if cached is None:
+        xblock_class = appengine_xblock_runtime.registry.REGISTRY.load_class(
+            block_type)
+        body = xblock_class.open_local_resource(resource).read()
+        cached = (body, hashlib.md5(body).hexdigest(), _STARTUP_TIME)
+        if len(body) <= _MAX_CACHED_RESOURCE_SIZE:
+            _RESOURCES.put(cache_key, cached)
+    return cached
+
+
+_LOCAL_RESOURCE_URL_RE = re.compile(r'^/local_resource/([^/]*)/(.*)$')
+
+
+def _load_local_resource_url(url):
+    """Return the body of a block's local resource from its URL, or None."""
+    match = _LOCAL_RESOURCE_URL_RE.match(url)
+    if match is None:
+        return None
+    try:
+        return _load_resource(*match.groups())[0]
+    except (IOError, PluginMissingError):
+        return None
+
+# Combines the JavaScript and CSS of each block type, whether inline or local
+# resources, so that a page loads a few bundles rather than many files.
+BUNDLER = appengine_xblock_runtime.bundles.ResourceBundler(
+    load_url=_load_local_resource_url)
+
+# The block types whose classes are imported by a warmup request.
+WARMUP_BLOCK_TYPES = ('vertical_demo', 'html_demo', 'slider_demo', 'thumbs')
+
+# Events published by blocks are stored in batches in the datastore.
+EVENT_SINK = appengine_xblock_runtime.events.DatastoreSink()
+
+# Log a summary of the datastore calls and latencies of every request.
+appengine_xblock_runtime.instrumentation.register_exporter(
+    appengine_xblock_runtime.instrumentation.logging_exporter)
+
+
 class WorkbenchRuntime(appengine_xblock_runtime.runtime.Runtime):
     """A XBlock runtime which uses the App Engine datastore."""
 
+    def __init__(self, **kwargs):
+        if 'field_data' not in kwargs:
+            kwargs.setdefault(
+                'key_value_store', appengine_xblock_runtime.store.KeyValueStore(
+                    sharded_counters=SHARDED_COUNTERS,
+                    cache_policy=CACHE_POLICY,
+                    write_listeners=[FRAGMENT_CACHE.on_write]))
+        kwargs.setdefault('fragment_cache', FRAGMENT_CACHE)
+        kwargs.setdefault('event_sink', EVENT_SINK)
+        super(WorkbenchRuntime, self).__init__(**kwargs)
+
     def render_template(self, template_name, **kwargs):
         """Loads the django template for `template_name."""
-        template = django.template.loader.get_template(template_name)
+        template = get_django_template(template_name)
         return template.render(django.template.Context(kwargs))
 
     def wrap_child(self, block, view, frag, context):  # pylint: disable=W0613
@@ -65,17 +200,21 @@ class WorkbenchRuntime(appengine_xblock_runtime.runtime.Runtime):
         )
         wrapped.add_content(html)
         wrapped.add_frag_resources(frag)
+        # Each block adds jQuery, and blocks of a type add the same resources,
+        # so the resources are deduplicated at each level of the tree.
+        wrapped.resources = BUNDLER.process(
+            block.scope_ids.block_type, wrapped.resources)
         return wrapped
 
     def query(self, block):
+        # The workbench is slow to import and seldom needed, so it is imported
+        # on first use rather than when the instance starts.
+        from workbench.runtime import _BlockSet
         return _BlockSet(self, [block])
 
     def resource_url(self, resource):
         return '/static/%s' % resource
 
-    def publish(self, block, event):
-        logging.info(event)
-
     def handler_url(
             self, block, handler_name, suffix='', query='', thirdparty=False):
         raise Exception('Not used')
@@ -98,29 +237,101 @@ class XBlockEndpointHandler(webapp2.RequestHandler):
             return urllib.unquote(body[:-1])
 
         rt = WorkbenchRuntime(student_id=student_id)
-        block = rt.get_block(usage_id)
-        self.request.body = fix_ajax_request_body(self.request.body)
-        response = block.runtime.handle(block, handler_name, self.request)
+        with rt.buffered_writes():
+            block = rt.get_block(usage_id)
+            self.request.body = fix_ajax_request_body(self.request.body)
+            response = rt.handle(block, handler_name, self.request)
         self.response.body = response.body
         self.response.headers.update(response.headers)
+        rt.flush_events()
+        rt.stats.export()
+
+
+class XBlockBatchEndpointHandler(webapp2.RequestHandler):
+    """Runs several XBlock handler calls in one request.
+
+    The body is a JSON object with a list of 'calls', each giving the
+    'usage_id', the 'handler' name and the JSON 'data' passed to it. The calls
+    share one runtime, their blocks are loaded together and their writes are
+    flushed in one batch. The response holds a list of 'results', each with
+    the 'status' and 'body' of the corresponding call.
+    """
+
+    def post(self):
+        student_id = self.request.get('student')
+        assert student_id == users.get_current_user().user_id()
+
+        calls = []
+        for call in json.loads(self.request.body)['calls']:
+            request = webob.Request.blank('/')
+            request.method = 'POST'
+            request.body = json.dumps(call.get('data'))
+            calls.append((call['usage_id'], call['handler'], request))
+
+        rt = WorkbenchRuntime(student_id=student_id)
+        responses = rt.handle_batch(calls)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'results': [
+            {'status': response.status_int, 'body': response.body}
+            for response in responses]}))
+        rt.flush_events()
+        rt.stats.export()
 
 
 class XBlockLocalResourceHandler(webapp2.RequestHandler):
     """Router for requests for a block's local resources."""
 
+    def _is_not_modified(self, etag, last_modified):
+        if self.request.if_none_match:
+            return etag in self.request.if_none_match
+        if self.request.if_modified_since:
+            return last_modified <= calendar.timegm(
+                self.request.if_modified_since.utctimetuple())
+        return False
+
     def get(self, block_type, resource):
-        xblock_class = XBlock.load_class(block_type)
+        body, etag, last_modified = _load_resource(block_type, resource)
 
         mimetype = mimetypes.guess_type(resource)[0]
         if mimetype is None:
             mimetype = 'application/octet-stream'
 
-        self.response.status = 200
         self.response.headers['Content-Type'] = mimetype
         self.response.cache_control.no_cache = None
         self.response.cache_control.public = 'public'
         self.response.cache_control.max_age = 600
-        self.response.write(xblock_class.open_local_resource(resource).read())
+        self.response.etag = etag
+        self.response.last_modified = last_modified
+        if self._is_not_modified(etag, last_modified):
+            self.response.status = 304
+            return
+        self.response.status = 200
+        self.response.write(body)
+
+
+class ResourceBundleHandler(webapp2.RequestHandler):
+    """Serves the bundled resources of blocks.
+
+    Bundles are named by the hash of their content, and so are cached by
+    browsers without ever being revalidated.
+    """
+
+    def get(self, block_type, bundle_id):  # pylint: disable=W0613
+        bundle = BUNDLER.get(bundle_id)
+        if bundle is None:
+            self.error(404)
+            return
+        body, mimetype = bundle
+
+        self.response.headers['Content-Type'] = mimetype
+        self.response.headers['Cache-Control'] = (
+            'public, max-age=31536000, immutable')
+        self.response.etag = bundle_id
+        if bundle_id in self.request.if_none_match:
+            self.response.status = 304
+            return
+        self.response.status = 200
+        self.response.write(body)
 
 
 class BasePageHandler(webapp2.RequestHandler):
@@ -128,11 +339,17 @@ class BasePageHandler(webapp2.RequestHandler):
 
     def __init__(self, *args, **kwargs):
         super(BasePageHandler, self).__init__(*args, **kwargs)
-        self.template_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(
-                os.path.join(os.path.dirname(__file__), 'templates')),
-            extensions=['jinja2.ext.autoescape'],
-            autoescape=True)
+        self.template_env = TEMPLATE_ENV
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Prepares a new instance before it serves user requests."""
+
+    def get(self):
+        start = time.time()
+        precompile_templates()
+        appengine_xblock_runtime.registry.REGISTRY.preload(WARMUP_BLOCK_TYPES)
+        logging.info('Warmed up in %.1f ms', (time.time() - start) * 1000)
 
 
 class DefaultPageHandler(BasePageHandler):
@@ -162,6 +379,8 @@ class DisplayXblockPageHandler(BasePageHandler):
             'student_id': student_id}
         template = self.template_env.get_template('display_xblock.html')
         self.response.write(template.render(template_values))
+        rt.flush_events()
+        rt.stats.export()
 
 
 class XblockRestHandler(webapp2.RequestHandler):
@@ -171,12 +390,10 @@ class XblockRestHandler(webapp2.RequestHandler):
         student_id = users.get_current_user().user_id()
 
         rt = WorkbenchRuntime(student_id=student_id)
-        block = rt.get_block(usage_id)
-        xml_buffer = StringIO()
-        rt.export_to_xml(block, xml_buffer)
-
         self.response.headers['Content-Type'] = 'text/xml'
-        self.response.write(xml_buffer.getvalue())
+        appengine_xblock_runtime.exporter.StreamingExporter(rt).export(
+            usage_id, self.response.out)
+        rt.stats.export()
 
     def post(self):
         assert self.request.headers['Content-Type'] == 'text/xml'
@@ -184,8 +401,9 @@ class XblockRestHandler(webapp2.RequestHandler):
         self.response.headers['Content-Type'] = 'application/json'
         try:
             rt = WorkbenchRuntime()
-            id_generator = appengine_xblock_runtime.runtime.IdGenerator()
-            usage_id = rt.parse_xml_string(self.request.body, id_generator)
+            usage_id = appengine_xblock_runtime.importer.import_xml_file(
+                rt, self.request.body_file)
+            rt.stats.export()
 
             self.response.write(json.dumps({
                 'status': 'OK',
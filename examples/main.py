@@ -27,9 +27,13 @@ import handlers
 
 app = webapp2.WSGIApplication([
     (r'/handler/([0-9a-fA-F]+)/(.*)/', handlers.XBlockEndpointHandler),
+    (r'/handler_batch', handlers.XBlockBatchEndpointHandler),
     (r'/local_resource/([^/]*)/(.*)', handlers.XBlockLocalResourceHandler),
+    (r'/bundle/([^/]*)/([0-9a-f]+)\.(?:js|css)',
+     handlers.ResourceBundleHandler),
     (r'/display_xblock', handlers.DisplayXblockPageHandler),
     (r'/rest/xblock', handlers.XblockRestHandler),
     (r'/rest/xblock/([0-9a-fA-F]+)', handlers.XblockRestHandler),
+    (r'/_ah/warmup', handlers.WarmupHandler),
     (r'/.*', handlers.DefaultPageHandler)
 ], debug=True)
@@ -0,0 +1,22 @@
+#! /bin/bash
+#
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# author: jorr@google.com (John Orr)
+#
+# This script runs the benchmark suite. Arguments are passed on to
+# benchmarks/run_benchmarks.py, e.g.:
+#   sh ./scripts/benchmarks.sh --backend sqlite --blocks 10,100,1000,10000
+#
+
+. scripts/common.sh
+
+PYTHONPATH=$GOOGLE_APP_ENGINE_HOME
+PYTHONPATH=$PYTHONPATH:$GOOGLE_APP_ENGINE_HOME/lib/webob-1.2.3
+PYTHONPATH=$PYTHONPATH:examples/lib/XBlock
+PYTHONPATH=$PYTHONPATH:examples/lib/XBlock/demo_xblocks
+PYTHONPATH=$PYTHONPATH:examples/lib/XBlock/thumbs
+PYTHONPATH=$PYTHONPATH:.
+export PYTHONPATH
+
+python benchmarks/run_benchmarks.py $*
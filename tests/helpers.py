@@ -0,0 +1,54 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A runtime and a base test case shared by the tests."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import unittest
+
+from appengine_xblock_runtime import runtime
+from google.appengine.ext import testbed
+
+
+class RuntimeForTest(runtime.Runtime):
+
+    def handler_url(
+            self, block, handler_name, suffix='', query='', thirdparty=False):
+        raise Exception("Not Used By Tests")
+
+    def resource_url(self, resource):
+        raise Exception("Not Used By Tests")
+
+    def local_resource_url(self, block, uri):
+        raise Exception("Not Used By Tests")
+
+    def publish(self, block, event):
+        raise Exception("Not Used By Tests")
+
+
+class TestbedTestCase(unittest.TestCase):
+    """Base class for tests which use the mock datastore and memcache."""
+
+    def setUp(self):
+        super(TestbedTestCase, self).setUp()
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        runtime.ID_CACHE.clear()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+        super(TestbedTestCase, self).tearDown()
@@ -0,0 +1,158 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the storage backends, which run without the testbed."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import unittest
+
+from appengine_xblock_runtime import backends
+from appengine_xblock_runtime import base
+from appengine_xblock_runtime import instrumentation
+import xblock.exceptions
+import xblock.fields
+import xblock.runtime
+from tests.helpers import RuntimeForTest
+
+
+class BackendTestMixin(object):
+    """Tests which every backend should pass."""
+
+    def make_backend(self):
+        raise NotImplementedError()
+
+    def setUp(self):
+        super(BackendTestMixin, self).setUp()
+        self.backend = self.make_backend()
+
+    def test_write_then_read(self):
+        '''Should read back written values and omit absent keys.'''
+        self.backend.write_multi('t', {'a': {'x': [1, 2]}, 'b': 2}, [])
+        self.backend.write_multi('t', {}, ['b'])
+        self.assertEqual(
+            {'a': {'x': [1, 2]}}, self.backend.get_multi('t', ['a', 'b']))
+        self.assertEqual({}, self.backend.get_multi('other', ['a']))
+
+    def test_expected_values_are_checked(self):
+        '''A write should fail atomically if an expected value differs.'''
+        self.backend.write_multi('t', {'a': 1}, [])
+        self.assertRaises(
+            base.ContentionError, self.backend.write_multi, 't',
+            {'a': 2, 'b': 2}, [], expected={'a': 0})
+        self.assertEqual({'a': 1}, self.backend.get_multi('t', ['a', 'b']))
+
+        self.backend.write_multi(
+            't', {'a': 2, 'b': 2}, [], expected={'a': 1, 'b': backends.ABSENT})
+        self.assertEqual(
+            {'a': 2, 'b': 2}, self.backend.get_multi('t', ['a', 'b']))
+
+    def test_key_value_store(self):
+        '''The store should honour the KeyValueStore contract.'''
+        kvs = backends.KeyValueStore(self.backend)
+        key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state, user_id='123',
+            block_scope_id='456', field_name='my_field')
+        self.assertFalse(kvs.has(key))
+        kvs.set(key, 'data')
+        self.assertEqual(
+            'data', backends.KeyValueStore(self.backend).get(key))
+        kvs.delete(key)
+        self.assertRaises(
+            KeyError, backends.KeyValueStore(self.backend).get, key)
+
+    def test_transactional_flush(self):
+        '''A transactional flush should detect a conflicting write.'''
+        key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state, user_id='123',
+            block_scope_id='456', field_name='my_field')
+        backends.KeyValueStore(self.backend).set(key, 1)
+
+        kvs = backends.KeyValueStore(self.backend)
+        kvs.start_buffering()
+        kvs.set(key, kvs.get(key) + 1)
+        backends.KeyValueStore(self.backend).set(key, 5)
+        self.assertRaises(
+            base.ContentionError, kvs.flush, transactional=True)
+
+    def test_stats_and_write_listeners(self):
+        '''The store should record its operations and report its writes.'''
+        key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state, user_id='123',
+            block_scope_id='456', field_name='my_field')
+        stats = instrumentation.RequestStats()
+        written = []
+        kvs = backends.KeyValueStore(
+            self.backend, stats=stats, write_listeners=[written.extend])
+
+        kvs.start_buffering()
+        kvs.set(key, 'data')
+        self.assertEqual([], written)
+        kvs.flush()
+        self.assertEqual([key], written)
+        kvs.get(key)
+        kvs.delete(key)
+        self.assertEqual([key, key], written)
+
+        self.assertEqual(1, stats.count('set'))
+        self.assertEqual(1, stats.count('get'))
+        self.assertEqual(1, stats.count('delete'))
+        self.assertEqual(1, stats.count('datastore_put'))
+        self.assertEqual(1, stats.count('datastore_delete'))
+        self.assertEqual(0, stats.count('datastore_get'))
+
+    def test_ids(self):
+        '''Should create and resolve usage and definition ids.'''
+        id_generator = backends.IdGenerator(self.backend)
+        id_reader = backends.IdReader(self.backend)
+        def_id = id_generator.create_definition('my_block')
+        usage_id = id_generator.create_usage(def_id)
+        self.assertEqual(def_id, id_reader.get_definition_id(usage_id))
+        self.assertEqual('my_block', id_reader.get_block_type(def_id))
+        self.assertRaises(
+            xblock.exceptions.NoSuchUsage, id_reader.get_definition_id, 'x')
+
+    def test_runtime(self):
+        '''The runtime should run over the backend.'''
+        rt = RuntimeForTest(
+            id_reader=backends.IdReader(self.backend),
+            key_value_store=backends.KeyValueStore(self.backend))
+        usage_id = rt.parse_xml_string(
+            '<html_demo>text</html_demo>',
+            backends.IdGenerator(self.backend))
+
+        rt = RuntimeForTest(
+            id_reader=backends.IdReader(self.backend),
+            key_value_store=backends.KeyValueStore(self.backend))
+        self.assertEqual('text', rt.get_blocks([usage_id])[0].content)
+
+
+class TestMemoryBackend(BackendTestMixin, unittest.TestCase):
+    """Unit tests for the in-memory backend."""
+
+    def make_backend(self):
+        return backends.MemoryBackend()
+
+
+class TestSqliteBackend(BackendTestMixin, unittest.TestCase):
+    """Unit tests for the SQLite backend."""
+
+    def make_backend(self):
+        return backends.SqliteBackend()
+
+    def test_large_batches(self):
+        '''Should read and write more keys than fit in one statement.'''
+        values = dict(('key%d' % i, i) for i in xrange(1200))
+        self.backend.write_multi('t', values, [])
+        self.assertEqual(values, self.backend.get_multi('t', values.keys()))
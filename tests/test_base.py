@@ -0,0 +1,83 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the storage classes shared by the stores."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import unittest
+
+from appengine_xblock_runtime import base
+import xblock.fields
+import xblock.runtime
+
+
+class StoreForTest(base.BufferedKeyValueStore):
+    """A store which holds nothing, for testing its shared state."""
+
+    def get(self, key):
+        raise KeyError()
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def has(self, key):
+        return False
+
+
+class TestBufferedKeyValueStore(unittest.TestCase):
+    """Unit tests for the state held by BufferedKeyValueStore."""
+    # pylint: disable=W0212
+
+    def setUp(self):
+        super(TestBufferedKeyValueStore, self).setUp()
+        self.written = []
+        self.kvs = StoreForTest(
+            write_listeners=[self.written.extend])
+        self.key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state, user_id='123',
+            block_scope_id='456', field_name='my_field')
+
+    def test_key_string(self):
+        '''Should name the scope, block, user and field of a key.'''
+        self.assertEqual('usage.456.123.my_field', base.key_string(self.key))
+
+    def test_take_pending(self):
+        '''Should split the buffered writes and leave buffered mode.'''
+        self.kvs.start_buffering()
+        self.kvs._pending.update({'a': 1, 'b': base.DELETED})
+        self.kvs._written(self.key)
+        self.assertEqual([], self.written)
+
+        puts, deletes, written_keys = self.kvs._take_pending()
+        self.assertEqual({'a': 1}, puts)
+        self.assertEqual(['b'], deletes)
+        self.assertEqual([self.key], written_keys)
+        self.assertFalse(self.kvs.buffering)
+        self.assertEqual({}, self.kvs._pending)
+
+    def test_unbuffered_writes_are_reported(self):
+        '''Outside buffered mode, listeners should be told at once.'''
+        self.kvs._written(self.key)
+        self.assertEqual([self.key], self.written)
+
+    def test_originals(self):
+        '''Only rows which were read should be expected, until written.'''
+        self.kvs._originals['a'] = 1
+        self.assertEqual({'a': 1}, self.kvs._expected(['a', 'b']))
+        self.kvs._forget_written(['a'])
+        self.assertEqual({}, self.kvs._expected(['a', 'b']))
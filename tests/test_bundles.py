@@ -0,0 +1,122 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the deduplication and bundling of fragment resources."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+from appengine_xblock_runtime import bundles
+from xblock.fragment import FragmentResource
+from tests.helpers import TestbedTestCase
+
+
+JS = 'application/javascript'
+CSS = 'text/css'
+
+
+def text(data, mimetype=JS, placement='foot'):
+    return FragmentResource('text', data, mimetype, placement)
+
+
+def url(data, mimetype=JS, placement='foot'):
+    return FragmentResource('url', data, mimetype, placement)
+
+
+class TestBundles(TestbedTestCase):
+    """Tests for dedupe_resources and ResourceBundler."""
+
+    def setUp(self):
+        super(TestBundles, self).setUp()
+        self.local_files = {'/local_resource/thumbs/thumbs.js': 'var b = 2'}
+        self.bundler = bundles.ResourceBundler(
+            load_url=self.local_files.get)
+
+    def body(self, resource):
+        bundle_id = resource.data.rsplit('/', 1)[1].split('.')[0]
+        return bundles.ResourceBundler().get(bundle_id)[0]
+
+    def test_dedupe_resources(self):
+        """Should drop repeated resources, keeping the order of the first."""
+        self.assertEqual(
+            [url('/jquery.js'), text('a'), url('/b.js')],
+            bundles.dedupe_resources([
+                url('/jquery.js'), text('a'), url('/jquery.js'),
+                url('/b.js'), text('a')]))
+
+    def test_resources_are_bundled(self):
+        """Inline and local resources should be combined into one bundle."""
+        resources = self.bundler.process('thumbs', [
+            text('var a = 1'), url('/local_resource/thumbs/thumbs.js'),
+            text('.a {}', mimetype=CSS, placement='head')])
+
+        self.assertEqual(2, len(resources))
+        js_bundle, css_bundle = resources
+        self.assertEqual('url', js_bundle.kind)
+        self.assertTrue(js_bundle.data.startswith('/bundle/thumbs/'))
+        self.assertTrue(js_bundle.data.endswith('.js'))
+        self.assertEqual('var a = 1;\nvar b = 2', self.body(js_bundle))
+        self.assertEqual(('head', CSS), (
+            css_bundle.placement, css_bundle.mimetype))
+        self.assertEqual('.a {}', self.body(css_bundle))
+
+    def test_order_is_kept(self):
+        """Resources which cannot be bundled should split the bundles."""
+        resources = self.bundler.process('thumbs', [
+            text('var a = 1'), url('/static/jquery.js'), text('var c = 3')])
+
+        self.assertEqual(3, len(resources))
+        self.assertEqual('var a = 1', self.body(resources[0]))
+        self.assertEqual(url('/static/jquery.js'), resources[1])
+        self.assertEqual('var c = 3', self.body(resources[2]))
+
+    def test_relative_css_urls_are_resolved(self):
+        """Relative URLs in local CSS should resolve against its own URL."""
+        self.local_files['/local_resource/thumbs/css/thumbs.css'] = (
+            '.a { background: url(../img/up.png); }\n'
+            '.b { background: url("/static/down.png"); }\n'
+            '.c { background: url(data:image/png;base64,AAAA); }\n'
+            '@import "print.css";')
+        resources = self.bundler.process('thumbs', [url(
+            '/local_resource/thumbs/css/thumbs.css', mimetype=CSS,
+            placement='head')])
+
+        self.assertEqual(
+            '.a { background: url(/local_resource/thumbs/img/up.png); }\n'
+            '.b { background: url("/static/down.png"); }\n'
+            '.c { background: url(data:image/png;base64,AAAA); }\n'
+            '@import "/local_resource/thumbs/css/print.css";',
+            self.body(resources[0]))
+
+    def test_inline_css_with_relative_urls_is_not_bundled(self):
+        """Inline CSS should only be bundled if it has no relative URLs."""
+        relative = text('.a { background: url(up.png); }', mimetype=CSS)
+        absolute = text('.b { background: url(/up.png); }', mimetype=CSS)
+        resources = self.bundler.process('thumbs', [relative, absolute])
+
+        self.assertEqual(relative, resources[0])
+        self.assertEqual(
+            '.b { background: url(/up.png); }', self.body(resources[1]))
+
+    def test_same_content_gives_same_bundle(self):
+        """Blocks of a type with the same resources should share a bundle."""
+        first = self.bundler.process('thumbs', [text('var a = 1')])
+        second = self.bundler.process('thumbs', [text('var a = 1')])
+        self.assertEqual(first, second)
+        self.assertEqual(first, self.bundler.process(
+            'thumbs', first + second))
+        self.assertEqual(1, bundles.ResourceBundleEntity.query().count())
+
+    def test_unknown_bundle(self):
+        """Should return None for a bundle which was never stored."""
+        self.assertIsNone(self.bundler.get('0' * 32))
@@ -0,0 +1,98 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the in-process caches."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import threading
+import time
+import unittest
+
+from appengine_xblock_runtime import cache
+
+
+class TestLRUCache(unittest.TestCase):
+    """Unit tests for the LRU cache."""
+
+    def test_put_then_get(self):
+        '''Should retrieve stored values and count hits and misses.'''
+        lru = cache.LRUCache(max_size=10)
+        lru.put('a', 1)
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(1, lru.hits)
+        self.assertEqual(1, lru.misses)
+        self.assertEqual(0.5, lru.stats()['hit_rate'])
+
+    def test_evicts_least_recently_used(self):
+        '''Should evict the least recently used item when full.'''
+        lru = cache.LRUCache(max_size=2)
+        lru.put('a', 1)
+        lru.put('b', 2)
+        lru.get('a')
+        lru.put('c', 3)
+        self.assertEqual(2, len(lru))
+        self.assertEqual(1, lru.get('a'))
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(3, lru.get('c'))
+
+    def test_delete(self):
+        '''Should remove a key, and ignore absent keys.'''
+        lru = cache.LRUCache()
+        lru.put('a', 1)
+        lru.delete('a')
+        lru.delete('b')
+        self.assertIsNone(lru.get('a'))
+
+    def test_expired_items_are_absent(self):
+        '''Items should not be returned after their time to live.'''
+        lru = cache.LRUCache()
+        lru.put('a', 1, ttl=-1)
+        lru.put('b', 2, ttl=60)
+        self.assertIsNone(lru.get('a'))
+        self.assertEqual(2, lru.get('b'))
+        self.assertEqual(1, len(lru))
+
+    def test_items_without_ttl_do_not_expire(self):
+        '''Items stored without a time to live should stay valid.'''
+        lru = cache.LRUCache()
+        lru.put('a', 1)
+        time.sleep(0.01)
+        self.assertEqual(1, lru.get('a'))
+
+    def test_concurrent_access(self):
+        '''Threads sharing a cache should not corrupt it or its counters.'''
+        lru = cache.LRUCache(max_size=50)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in xrange(1000):
+                    key = (offset + i) % 100
+                    if lru.get(key) is None:
+                        lru.put(key, key)
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=worker, args=(n,)) for n in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        self.assertLessEqual(len(lru), 50)
+        self.assertEqual(8000, lru.hits + lru.misses)
@@ -0,0 +1,149 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the buffering of published events."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from appengine_xblock_runtime import events
+from appengine_xblock_runtime import runtime
+from tests.helpers import RuntimeForTest
+from tests.helpers import TestbedTestCase
+
+
+class ListSink(events.EventSink):
+    """A sink which keeps its batches, and whose writes complete on demand."""
+
+    def __init__(self):
+        self.batches = []
+        self.waited = 0
+
+    def write_async(self, lines):
+        self.batches.append(lines)
+        return self
+
+    def get_result(self):
+        self.waited += 1
+
+
+class PublishingRuntime(RuntimeForTest):
+    """A test runtime which publishes events through the base runtime."""
+
+    def publish(self, block, event):
+        runtime.Runtime.publish(self, block, event)
+
+
+class TestEventBuffer(unittest.TestCase):
+    """Unit tests for EventBuffer."""
+
+    def setUp(self):
+        super(TestEventBuffer, self).setUp()
+        self.sink = ListSink()
+
+    def test_flush_writes_compact_json(self):
+        """Events should be written as compact JSON lines on flush."""
+        buf = events.EventBuffer(self.sink)
+        buf.add({'a': 1})
+        buf.add({'b': [1, 2]})
+        self.assertEqual([], self.sink.batches)
+        buf.flush()
+        self.assertEqual([['{"a":1}', '{"b":[1,2]}']], self.sink.batches)
+        self.assertEqual(1, self.sink.waited)
+
+    def test_full_batches_are_written_early(self):
+        """A full batch should be written before the request ends."""
+        buf = events.EventBuffer(self.sink, max_events=2)
+        for index in xrange(5):
+            buf.add({'n': index})
+        self.assertEqual(2, len(self.sink.batches))
+        self.assertEqual(1, len(buf))
+
+    def test_backpressure(self):
+        """Outstanding writes beyond the limit should be waited for."""
+        buf = events.EventBuffer(self.sink, max_events=1, max_pending=2)
+        for index in xrange(4):
+            buf.add({'n': index})
+        self.assertEqual(2, self.sink.waited)
+
+    def test_rollback(self):
+        """Rollback should drop only events which are not yet written."""
+        buf = events.EventBuffer(self.sink, max_events=3)
+        buf.add({'n': 0})
+        mark = buf.mark()
+        buf.add({'n': 1})
+        buf.add({'n': 2})
+        buf.add({'n': 3})
+        buf.rollback(mark)
+        buf.flush()
+        self.assertEqual(
+            [['{"n":0}', '{"n":1}', '{"n":2}']], self.sink.batches)
+
+    def test_unserializable_values(self):
+        """Values which are not JSON should be written as their repr."""
+        self.assertEqual(
+            '{"v":"set([1])"}', events.serialize_event({'v': set([1])}))
+
+
+class TestSinks(TestbedTestCase):
+    """Tests for the event sinks."""
+
+    def test_file_sink(self):
+        """The file sink should append lines."""
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'events.log')
+            sink = events.FileSink(path)
+            sink.write_async(['a'])
+            sink.write_async(['b', 'c'])
+            with open(path) as events_file:
+                self.assertEqual('a\nb\nc\n', events_file.read())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_datastore_sink(self):
+        """The datastore sink should store a batch in one entity."""
+        events.DatastoreSink().write_async(['a', 'b']).get_result()
+        batches = events.EventBatchEntity.query().fetch()
+        self.assertEqual(1, len(batches))
+        self.assertEqual('a\nb', batches[0].events)
+
+    def test_runtime_publish(self):
+        """Events published in a failed buffered block should be dropped."""
+        usage_id = PublishingRuntime().parse_xml_string(
+            '<html_demo>text</html_demo>', runtime.IdGenerator())
+        sink = ListSink()
+        rt = PublishingRuntime(student_id='student', event_sink=sink)
+        block = rt.get_block(usage_id)
+
+        rt.publish(block, {'kept': True})
+        try:
+            with rt.buffered_writes():
+                rt.publish(block, {'kept': False})
+                raise ValueError()
+        except ValueError:
+            pass
+        rt.flush_events()
+
+        self.assertEqual(1, len(sink.batches))
+        record = json.loads(sink.batches[0][0])
+        self.assertEqual(1, len(sink.batches[0]))
+        self.assertEqual({'kept': True}, record['event'])
+        self.assertEqual('student', record['user_id'])
+        self.assertEqual(usage_id, record['usage_id'])
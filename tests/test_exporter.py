@@ -0,0 +1,77 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the streaming XML exporter."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+from cStringIO import StringIO
+
+from appengine_xblock_runtime import exporter
+from appengine_xblock_runtime import runtime
+from tests.helpers import RuntimeForTest
+from tests.helpers import TestbedTestCase
+
+
+COURSE_XML = (
+    '<vertical_demo>'
+    '<vertical_demo><html_demo>one</html_demo><slider_demo/></vertical_demo>'
+    '<html_demo>two &amp; &lt;xblock-stub usage_id="x"/&gt;</html_demo>'
+    '<vertical_demo><html_demo>three</html_demo></vertical_demo>'
+    '</vertical_demo>')
+
+
+class TestStreamingExporter(TestbedTestCase):
+    """Tests for StreamingExporter."""
+
+    def setUp(self):
+        super(TestStreamingExporter, self).setUp()
+        self.usage_id = RuntimeForTest().parse_xml_string(
+            COURSE_XML, runtime.IdGenerator())
+
+    def expected_xml(self):
+        rt = RuntimeForTest()
+        xml_buffer = StringIO()
+        rt.export_to_xml(rt.get_block(self.usage_id), xml_buffer)
+        return xml_buffer.getvalue()
+
+    def export(self, window_size):
+        rt = RuntimeForTest()
+        xml_buffer = StringIO()
+        exporter.StreamingExporter(rt, window_size=window_size).export(
+            self.usage_id, xml_buffer)
+        self.assertFalse(rt.export_child_stubs)
+        return xml_buffer.getvalue()
+
+    def test_matches_export_to_xml(self):
+        """The streamed XML should be the same as the runtime's export."""
+        self.assertEqual(self.expected_xml(), self.export(window_size=500))
+
+    def test_small_windows(self):
+        """Trees larger than the window should be exported in full."""
+        self.assertEqual(self.expected_xml(), self.export(window_size=1))
+
+    def test_loads_each_level_in_a_batch(self):
+        """Each level of the tree should be loaded with one get_blocks."""
+        rt = RuntimeForTest()
+        calls = []
+        get_blocks = rt.get_blocks
+
+        def counting_get_blocks(usage_ids):
+            calls.append(len(usage_ids))
+            return get_blocks(usage_ids)
+
+        rt.get_blocks = counting_get_blocks
+        exporter.StreamingExporter(rt).export(self.usage_id, StringIO())
+        self.assertEqual([1, 3, 3], calls)
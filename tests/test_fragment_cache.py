@@ -0,0 +1,140 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the rendered fragment cache."""
+
+__author__ = 'John Orr (jorr@google.com)'
+import time
+
+from appengine_xblock_runtime import cache
+from appengine_xblock_runtime import fragment_cache
+from appengine_xblock_runtime import runtime
+from appengine_xblock_runtime import store
+from tests.helpers import RuntimeForTest
+from tests.helpers import TestbedTestCase
+from xblock.fields import Scope
+
+
+class TestFragmentCache(TestbedTestCase):
+    """Tests for FragmentCache."""
+
+    def setUp(self):
+        super(TestFragmentCache, self).setUp()
+        self.cache = fragment_cache.FragmentCache(
+            [('html_demo', 'student_view')])
+        self.usage_id = self.new_runtime().parse_xml_string(
+            '<vertical_demo><html_demo>text</html_demo></vertical_demo>',
+            runtime.IdGenerator())
+
+    def new_runtime(self, frag_cache=None, cache_policy=None):
+        frag_cache = frag_cache or self.cache
+        return RuntimeForTest(
+            fragment_cache=frag_cache,
+            key_value_store=store.KeyValueStore(
+                cache_policy=cache_policy,
+                write_listeners=[frag_cache.on_write]))
+
+    def render(self, frag_cache=None, cache_policy=None):
+        rt = self.new_runtime(
+            frag_cache=frag_cache, cache_policy=cache_policy)
+        html = rt.render(rt.get_block(self.usage_id), 'student_view')
+        return html.body_html(), rt.stats.count('fragment_cache_hit')
+
+    def test_second_render_is_cached(self):
+        """Cacheable children should be served from the cache."""
+        first_html, first_hits = self.render()
+        second_html, second_hits = self.render()
+        self.assertIn('text', first_html)
+        self.assertEqual(first_html, second_html)
+        self.assertEqual(0, first_hits)
+        self.assertEqual(1, second_hits)
+
+    def test_cached_children_are_not_prefetched(self):
+        """Rendering should not load the fields of cached children."""
+        self.render()
+        rt = self.new_runtime()
+        root = rt.get_block(self.usage_id)
+        prefetches = rt.stats.count('prefetch')
+        rt.render(root, 'student_view')
+        self.assertEqual(1, rt.stats.count('fragment_cache_hit'))
+        self.assertEqual(prefetches, rt.stats.count('prefetch'))
+
+    def test_content_write_invalidates(self):
+        """Writing the content of a block should orphan its fragments."""
+        self.render()
+        rt = self.new_runtime()
+        child = rt.get_block(rt.get_block(self.usage_id).children[0])
+        child.content = 'changed'
+        child.save()
+
+        html, hits = self.render()
+        self.assertIn('changed', html)
+        self.assertEqual(0, hits)
+
+    def test_returns_copies(self):
+        """Changing a returned fragment should not change the cached one."""
+        self.render()
+        rt = self.new_runtime()
+        child = rt.get_block(rt.get_block(self.usage_id).children[0])
+        fragment = rt.render(child, 'student_view')
+        fragment.add_content('extra')
+        self.assertNotIn('extra', rt.render(
+            child, 'student_view').body_html())
+
+    def test_containers_are_not_cached(self):
+        """Blocks with children should never be cached."""
+        cache = fragment_cache.FragmentCache(
+            [('vertical_demo', 'student_view')])
+        self.assertFalse(cache.is_cacheable(
+            self.new_runtime().get_block(self.usage_id), 'student_view'))
+
+    def test_ttl_is_capped_at_process_ttl(self):
+        """Fragments should be kept no longer than their fields in-process."""
+        policy = store.CachePolicy({
+            Scope.content: store.CacheOptions(True, True, 60),
+            Scope.settings: store.CacheOptions(True, True, 120)})
+        views = [('html_demo', 'student_view')]
+        self.assertEqual(60, fragment_cache.FragmentCache(
+            views, cache_policy=policy).ttl)
+        self.assertEqual(30, fragment_cache.FragmentCache(
+            views, ttl=30, cache_policy=policy).ttl)
+        self.assertEqual(3600, fragment_cache.FragmentCache(
+            views, cache_policy=store.CachePolicy()).ttl)
+
+    def test_stale_render_expires_with_process_cache(self):
+        """A fragment rendered from stale fields should expire with them."""
+        # Instance A holds content in its own in-process cache for a second.
+        policy = store.CachePolicy(
+            {Scope.content: store.CacheOptions(True, True, 1)},
+            process_cache=cache.LRUCache())
+        cache_a = fragment_cache.FragmentCache(
+            [('html_demo', 'student_view')], local_cache=cache.LRUCache(),
+            cache_policy=policy)
+        self.render(frag_cache=cache_a, cache_policy=policy)
+
+        # Instance B changes the content, which bumps the shared stamps.
+        rt = self.new_runtime()
+        child = rt.get_block(rt.get_block(self.usage_id).children[0])
+        child.content = 'changed'
+        child.save()
+
+        # Instance A re-renders from its stale in-process copy...
+        html, hits = self.render(frag_cache=cache_a, cache_policy=policy)
+        self.assertEqual(0, hits)
+        self.assertNotIn('changed', html)
+
+        # ...but that fragment expires along with the copy.
+        time.sleep(1.1)
+        html, _ = self.render(frag_cache=cache_a, cache_policy=policy)
+        self.assertIn('changed', html)
@@ -0,0 +1,62 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the HTTP handlers of the example server."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import json
+
+from appengine_xblock_runtime import runtime
+from examples import handlers
+import webapp2
+from tests.helpers import TestbedTestCase
+
+
+class TestXBlockBatchEndpointHandler(TestbedTestCase):
+    """Tests for the batched handler endpoint."""
+
+    STUDENT_ID = 'student_01'
+
+    def setUp(self):
+        super(TestXBlockBatchEndpointHandler, self).setUp()
+        self.testbed.init_user_stub()
+        self.testbed.setup_env(
+            user_id=self.STUDENT_ID, user_email='student@example.com',
+            overwrite=True)
+        self.app = webapp2.WSGIApplication([
+            (r'/handler_batch', handlers.XBlockBatchEndpointHandler)])
+
+    def test_calls_are_run_in_order(self):
+        """Each call should see the writes of those before it."""
+        usage_id = handlers.WorkbenchRuntime(
+            student_id=self.STUDENT_ID).parse_xml_string(
+                '<thumbs/>', runtime.IdGenerator())
+        body = json.dumps({'calls': [
+            {'usage_id': usage_id, 'handler': 'vote',
+             'data': {'voteType': vote_type}}
+            for vote_type in ('up', 'down', 'up')]})
+
+        response = self.app.get_response(
+            '/handler_batch?student=%s' % self.STUDENT_ID, method='POST',
+            body=body)
+
+        self.assertEqual(200, response.status_int)
+        results = json.loads(response.body)['results']
+        self.assertEqual([200, 200, 200], [
+            result['status'] for result in results])
+        self.assertEqual(
+            [{'up': 1, 'down': 0}, {'up': 1, 'down': 1},
+             {'up': 2, 'down': 1}],
+            [json.loads(result['body']) for result in results])
@@ -0,0 +1,74 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the streaming XML importer."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+from cStringIO import StringIO
+
+from appengine_xblock_runtime import importer
+from appengine_xblock_runtime import runtime
+from tests.helpers import RuntimeForTest
+from tests.helpers import TestbedTestCase
+
+
+COURSE_XML = (
+    '<vertical_demo>'
+    '<vertical_demo><html_demo>one</html_demo><slider_demo/></vertical_demo>'
+    '<html_demo>two</html_demo>'
+    '<vertical_demo><html_demo>three</html_demo></vertical_demo>'
+    '</vertical_demo>')
+
+
+class TestStreamingImporter(TestbedTestCase):
+    """Tests for StreamingImporter."""
+
+    def assert_course_imported(self, usage_id):
+        runtime.ID_CACHE.clear()
+        rt = RuntimeForTest()
+        root = rt.get_block(usage_id)
+        self.assertEqual(3, len(root.children))
+        first, second, third = rt.get_blocks(root.children)
+        self.assertEqual(usage_id, first.parent)
+        self.assertEqual('two', second.content)
+        one, slider = rt.get_blocks(first.children)
+        self.assertEqual('one', one.content)
+        self.assertEqual(first.scope_ids.usage_id, one.parent)
+        self.assertEqual('slider_demo', slider.scope_ids.block_type)
+        self.assertEqual(
+            'three', rt.get_blocks(third.children)[0].content)
+
+    def test_import(self):
+        """Nested blocks should be created in order with their fields."""
+        usage_id = importer.import_xml_file(
+            RuntimeForTest(), StringIO(COURSE_XML), batch_size=2)
+        self.assert_course_imported(usage_id)
+
+    def test_resume_from_checkpoint(self):
+        """An import stopped at its deadline should resume where it left."""
+        self.assertIsNone(importer.StreamingImporter(
+            RuntimeForTest(), batch_size=2, checkpoint_id='course').run(
+                StringIO(COURSE_XML), deadline=0))
+        checkpoint = importer.ImportCheckpointEntity.get_by_id('course')
+        self.assertEqual(2, checkpoint.processed)
+
+        usage_id = importer.StreamingImporter(
+            RuntimeForTest(), batch_size=2, checkpoint_id='course').run(
+                StringIO(COURSE_XML))
+        self.assert_course_imported(usage_id)
+
+        self.assertEqual(usage_id, importer.StreamingImporter(
+            RuntimeForTest(), checkpoint_id='course').run(
+                StringIO(COURSE_XML)))
@@ -0,0 +1,82 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the request-scoped stats."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import unittest
+
+from appengine_xblock_runtime import instrumentation
+from xblock.fields import Scope
+
+
+class TestRequestStats(unittest.TestCase):
+    """Unit tests for RequestStats."""
+
+    def test_record_aggregates_by_op_and_scope(self):
+        '''Calls to the same op and scope should be summed.'''
+        stats = instrumentation.RequestStats()
+        stats.record('get', Scope.content, latency=0.002, payload_bytes=10)
+        stats.record('get', Scope.content, latency=0.004, payload_bytes=5)
+        stats.record('get', Scope.user_state, latency=0.001)
+        stats.record('datastore_get', items=3)
+
+        self.assertEqual(2, stats.count('get', Scope.content))
+        self.assertEqual(3, stats.count('get'))
+        ops = dict(
+            ((op['op'], op['scope']), op) for op in stats.summary()['ops'])
+        content_gets = ops[('get', 'content')]
+        self.assertEqual(2, content_gets['calls'])
+        self.assertAlmostEqual(6.0, content_gets['total_ms'])
+        self.assertAlmostEqual(4.0, content_gets['max_ms'])
+        self.assertEqual(15, content_gets['payload_bytes'])
+        self.assertEqual(3, ops[('datastore_get', None)]['items'])
+
+    def test_payload_size(self):
+        '''Payload sizes should be measured only when enabled.'''
+        self.assertEqual(7, instrumentation.RequestStats(
+            measure_payloads=True).payload_size('hello'))
+        self.assertEqual(
+            0, instrumentation.RequestStats().payload_size('hello'))
+
+    def test_export(self):
+        '''Export should pass the summary to local and registered exporters.'''
+        local = []
+        registered = []
+        stats = instrumentation.RequestStats(exporters=[local.append])
+        stats.record('render')
+        instrumentation.register_exporter(registered.append)
+        try:
+            stats.export()
+        finally:
+            instrumentation.unregister_exporter(registered.append)
+        self.assertEqual(1, len(local))
+        self.assertEqual(local, registered)
+        self.assertEqual('render', local[0]['ops'][0]['op'])
+
+    def test_failing_exporter_is_ignored(self):
+        '''An exporter which raises should not prevent the others running.'''
+        def failing_exporter(unused_summary):
+            raise ValueError()
+        exported = []
+        stats = instrumentation.RequestStats(
+            exporters=[failing_exporter, exported.append])
+        stats.export()
+        self.assertEqual(1, len(exported))
+
+    def test_null_stats_record_nothing(self):
+        '''The shared null stats should not accumulate.'''
+        instrumentation.NULL_STATS.record('get', Scope.content)
+        self.assertEqual(0, instrumentation.NULL_STATS.count('get'))
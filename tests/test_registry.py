@@ -0,0 +1,89 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS-IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Unit tests for the registry of XBlock classes."""
+
+__author__ = 'John Orr (jorr@google.com)'
+
+import unittest
+
+from appengine_xblock_runtime import instrumentation
+from appengine_xblock_runtime import registry
+from xblock.core import XBlock
+import xblock.plugin
+
+
+class CountingRegistry(registry.BlockTypeRegistry):
+    """A registry which counts the times it reads the entry points."""
+
+    def __init__(self):
+        super(CountingRegistry, self).__init__()
+        self.index_count = 0
+
+    def _index(self):
+        self.index_count += 1
+        return super(CountingRegistry, self)._index()
+
+
+class TestBlockTypeRegistry(unittest.TestCase):
+    """Unit tests for BlockTypeRegistry."""
+
+    def setUp(self):
+        super(TestBlockTypeRegistry, self).setUp()
+        self.registry = CountingRegistry()
+
+    def test_nothing_is_read_until_needed(self):
+        '''Creating a registry should not read the entry points.'''
+        self.assertEqual(0, self.registry.index_count)
+        self.assertIsNone(self.registry.index_time)
+
+    def test_load_class(self):
+        '''Should load the same class as XBlock.load_class.'''
+        self.assertIs(
+            XBlock.load_class('html_demo'),
+            self.registry.load_class('html_demo'))
+
+    def test_classes_are_memoized(self):
+        '''Entry points should be read once, and each class loaded once.'''
+        stats = instrumentation.RequestStats()
+        first = self.registry.load_class('html_demo', stats=stats)
+        second = self.registry.load_class('html_demo', stats=stats)
+        self.registry.load_class('slider_demo', stats=stats)
+
+        self.assertIs(first, second)
+        self.assertEqual(1, self.registry.index_count)
+        self.assertEqual(2, stats.count('block_class_import'))
+        self.assertEqual(
+            set(['html_demo', 'slider_demo']),
+            set(self.registry.load_times))
+
+    def test_unknown_block_type(self):
+        '''Unknown types should raise, unless a default is given.'''
+        with self.assertRaises(xblock.plugin.PluginMissingError):
+            self.registry.load_class('no_such_block')
+        self.assertIs(
+            XBlock, self.registry.load_class('no_such_block', default=XBlock))
+
+    def test_preload(self):
+        '''Should load the known types and skip unknown ones.'''
+        self.registry.preload(['html_demo', 'no_such_block'])
+        self.assertEqual(['html_demo'], self.registry.load_times.keys())
+
+    def test_clear(self):
+        '''Should read the entry points again after being cleared.'''
+        self.registry.load_class('html_demo')
+        self.registry.clear()
+        self.registry.load_class('html_demo')
+        self.assertEqual(2, self.registry.index_count)
+
@@ -16,43 +16,42 @@
 
 __author__ = 'John Orr (jorr@google.com)'
 
-import unittest
+import json
+import threading
 
+from appengine_xblock_runtime import registry
 from appengine_xblock_runtime import runtime
 from appengine_xblock_runtime import store
+from lxml import etree
+import webob
+import xblock.core
 import xblock.fields
 import xblock.runtime
-from google.appengine.ext import testbed
+from google.appengine.ext import ndb
+from tests.helpers import RuntimeForTest
+from tests.helpers import TestbedTestCase
 
 
-class RuntimeForTest(runtime.Runtime):
+def vote_request(vote_type='up'):
+    request = webob.Request.blank('/')
+    request.method = 'POST'
+    request.body = json.dumps({'voteType': vote_type})
+    return request
 
-    def handler_url(
-            self, block, handler_name, suffix='', query='', thirdparty=False):
-        raise Exception("Not Used By Tests")
 
-    def resource_url(self, resource):
-        raise Exception("Not Used By Tests")
+class TwoFieldBlock(xblock.core.XBlock):
+    """A block with two fields in the user_state scope."""
+    first = xblock.fields.Integer(scope=xblock.fields.Scope.user_state)
+    second = xblock.fields.Integer(scope=xblock.fields.Scope.user_state)
 
-    def local_resource_url(self, block, uri):
-        raise Exception("Not Used By Tests")
 
-    def publish(self, block, event):
-        raise Exception("Not Used By Tests")
-
-
-class TestRuntime(unittest.TestCase):
+class TestRuntime(TestbedTestCase):
     """Integration tests between XBlock and the runtime."""
 
     STUDENT_ID = 'student_01'
 
     def setUp(self):
         super(TestRuntime, self).setUp()
-        self.testbed = testbed.Testbed()
-        self.testbed.activate()
-        self.testbed.init_datastore_v3_stub()
-        self.testbed.init_memcache_stub()
-
         self.runtime = RuntimeForTest(student_id=self.STUDENT_ID)
         self.id_generator = runtime.IdGenerator()
 
@@ -86,3 +85,274 @@ class TestRuntime(unittest.TestCase):
             field_name='value')
 
         self.assertEqual(50, store.KeyValueStore().get(key))
+
+    def test_save_fields_of_a_group(self):
+        """Saving several fields of one field group should keep them all."""
+        fresh_runtime = RuntimeForTest(
+            student_id=self.STUDENT_ID,
+            key_value_store=store.KeyValueStore(
+                consolidated_scopes=[xblock.fields.Scope.user_state]))
+        block = fresh_runtime.construct_xblock_from_class(
+            TwoFieldBlock, xblock.fields.ScopeIds(
+                self.STUDENT_ID, 'two_field', 'def_id', 'usage_id'))
+        block.first = 1
+        block.second = 2
+        block.save()
+
+        keys = runtime.field_keys(block.scope_ids, block.fields)
+        values = store.KeyValueStore(
+            consolidated_scopes=[xblock.fields.Scope.user_state]).get_many(
+                keys)
+        self.assertEqual(
+            {'first': 1, 'second': 2},
+            dict((key.field_name, value) for key, value in values.items()))
+        self.assertEqual(1, store.FieldGroupEntity.query().count())
+
+    def test_prefetch_fields(self):
+        """Fields should be readable from the prefetched snapshot."""
+        usage_id = self.runtime.parse_xml_string(
+            '<html_demo>text</html_demo>', self.id_generator)
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        block = fresh_runtime.get_block(usage_id)
+        fresh_runtime.prefetch_fields(block)
+
+        key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.content,
+            user_id=None,
+            block_scope_id=block.scope_ids.def_id,
+            field_name='content')
+        ndb.Key(store.KeyValueEntity, store.key_string(key)).delete()
+
+        self.assertEqual('text', block.content)
+
+    def test_buffered_writes(self):
+        """Field writes should be stored when the buffered block exits."""
+        usage_id = self.runtime.parse_xml_string(
+            '<slider_demo/>', self.id_generator)
+        block = self.runtime.get_block(usage_id)
+        key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state,
+            user_id=self.STUDENT_ID,
+            block_scope_id=block.scope_ids.usage_id,
+            field_name='value')
+
+        with self.runtime.buffered_writes():
+            block.value = 50
+            block.save()
+            self.assertFalse(store.KeyValueStore().has(key))
+
+        self.assertEqual(50, store.KeyValueStore().get(key))
+
+    def test_get_blocks(self):
+        """Should create several blocks in one call, in order."""
+        html_usage_id = self.runtime.parse_xml_string(
+            '<html_demo>text</html_demo>', self.id_generator)
+        slider_usage_id = self.runtime.parse_xml_string(
+            '<slider_demo/>', self.id_generator)
+
+        html_block, slider_block = RuntimeForTest(
+            student_id=self.STUDENT_ID).get_blocks(
+                [html_usage_id, slider_usage_id])
+
+        self.assertEqual(html_usage_id, html_block.scope_ids.usage_id)
+        self.assertEqual('text', html_block.content)
+        self.assertEqual(slider_usage_id, slider_block.scope_ids.usage_id)
+
+    def test_parse_with_batching_id_generator(self):
+        """Nested blocks should be importable with batched id creation."""
+        id_generator = runtime.BatchingIdGenerator()
+        with self.runtime.buffered_writes():
+            usage_id = self.runtime.parse_xml_string(
+                '<vertical_demo><html_demo>text</html_demo>'
+                '<slider_demo/></vertical_demo>', id_generator)
+            id_generator.flush()
+
+        runtime.ID_CACHE.clear()
+        block = RuntimeForTest(student_id=self.STUDENT_ID).get_block(usage_id)
+        self.assertEqual(2, len(block.children))
+        self.assertEqual('text', block.runtime.get_block(
+            block.children[0]).content)
+
+    def test_stats(self):
+        """The runtime should count the datastore calls made in a request."""
+        usage_id = self.runtime.parse_xml_string(
+            '<html_demo>text</html_demo>', self.id_generator)
+        runtime.ID_CACHE.clear()
+
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        self.assertIs(fresh_runtime.stats, fresh_runtime.id_reader.stats)
+        self.assertIs(
+            fresh_runtime.stats, fresh_runtime.key_value_store.stats)
+        block = fresh_runtime.get_block(usage_id)
+        fresh_runtime.render(block, 'student_view')
+
+        stats = fresh_runtime.stats
+        self.assertEqual(2, stats.count('id_cache_miss'))
+        self.assertEqual(1, stats.count('render'))
+        self.assertGreaterEqual(
+            stats.count('get', xblock.fields.Scope.content), 1)
+        self.assertGreater(stats.count('datastore_get'), 0)
+
+    def test_prefetch_tree(self):
+        """Descendants should be readable after the tree is prefetched."""
+        usage_id = self.runtime.parse_xml_string(
+            '<vertical_demo><vertical_demo><html_demo>text</html_demo>'
+            '</vertical_demo></vertical_demo>', self.id_generator)
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        root = fresh_runtime.get_block(usage_id)
+        fresh_runtime.prefetch_tree(root)
+        self.assertEqual(2, fresh_runtime.stats.count('get_blocks'))
+
+        ndb.delete_multi(store.KeyValueEntity.query().fetch(keys_only=True))
+        ndb.get_context().clear_cache()
+
+        child = fresh_runtime.get_block(root.children[0])
+        grandchild = fresh_runtime.get_block(child.children[0])
+        self.assertEqual('text', grandchild.content)
+        self.assertIn(
+            'text', fresh_runtime.render(root, 'student_view').body_html())
+
+    def test_prefetch_tree_skips_missing_children(self):
+        """A missing child should not stop the rest of the tree loading."""
+        usage_id = self.runtime.parse_xml_string(
+            '<vertical_demo><vertical_demo><html_demo>text</html_demo>'
+            '</vertical_demo></vertical_demo>', self.id_generator)
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        root = fresh_runtime.get_block(usage_id)
+        root.children = ['missing'] + root.children
+
+        descendants = fresh_runtime.prefetch_tree(root)
+
+        self.assertEqual(
+            ['vertical_demo', 'html_demo'],
+            [block.scope_ids.block_type for block in descendants])
+        self.assertEqual(
+            1, fresh_runtime.stats.count('prefetch_missing_usage'))
+
+    def test_parse_xml_node_then_stub(self):
+        """A block parsed alone should get its parent from a stub."""
+        child_id = self.runtime.parse_xml_node(
+            etree.fromstring('<html_demo>text</html_demo>'),
+            self.id_generator)
+        self.assertIsNone(self.runtime.get_block(child_id).parent)
+
+        parent_id = self.runtime.parse_xml_string(
+            '<vertical_demo><%s %s="%s"/></vertical_demo>' % (
+                runtime.STUB_TAG, runtime.STUB_USAGE_ID_ATTR, child_id),
+            self.id_generator)
+
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        self.assertEqual(
+            [child_id], fresh_runtime.get_block(parent_id).children)
+        self.assertEqual(parent_id, fresh_runtime.get_block(child_id).parent)
+
+    def test_handle_transactionally_after_conflict(self):
+        """A handler should be re-run on the current values after a conflict."""
+        usage_id = self.runtime.parse_xml_string(
+            '<thumbs/>', self.id_generator)
+        upvotes_key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state_summary, user_id=None,
+            block_scope_id=usage_id, field_name='upvotes')
+
+        class ConflictingRuntime(RuntimeForTest):
+            """Has another request write upvotes after the first handle()."""
+
+            def handle(self, block, *args, **kwargs):
+                result = super(ConflictingRuntime, self).handle(
+                    block, *args, **kwargs)
+                if not self.stats.count('handler_retry'):
+                    # Bypass this request's ndb context, as another request
+                    # would.
+                    entity = store.KeyValueEntity(
+                        id=store.key_string(upvotes_key))
+                    entity.value = 10
+                    entity.put(use_cache=False)
+                return result
+
+        fresh_runtime = ConflictingRuntime(student_id=self.STUDENT_ID)
+        response = fresh_runtime.handle_transactionally(
+            usage_id, 'vote', vote_request())
+
+        self.assertEqual(11, json.loads(response.body)['up'])
+        self.assertEqual(1, fresh_runtime.stats.count('handler_retry'))
+        ndb.get_context().clear_cache()
+        self.assertEqual(11, store.KeyValueStore().get(upvotes_key))
+
+    def test_handle_batch(self):
+        """Batched calls should share blocks and write in one flush."""
+        thumbs_ids = [
+            self.runtime.parse_xml_string('<thumbs/>', self.id_generator)
+            for _ in xrange(2)]
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        responses = fresh_runtime.handle_batch([
+            (thumbs_ids[0], 'vote', vote_request('up')),
+            (thumbs_ids[1], 'vote', vote_request('down')),
+            (thumbs_ids[0], 'vote', vote_request('up'))])
+
+        self.assertEqual(
+            [{'up': 1, 'down': 0}, {'up': 0, 'down': 1},
+             {'up': 2, 'down': 0}],
+            [json.loads(response.body) for response in responses])
+        self.assertEqual(1, fresh_runtime.stats.count('get_blocks'))
+        blocks = RuntimeForTest(student_id=self.STUDENT_ID).get_blocks(
+            thumbs_ids)
+        self.assertEqual(
+            [(2, 0, True), (0, 1, True)],
+            [(block.upvotes, block.downvotes, block.voted)
+             for block in blocks])
+
+    def test_handle_batch_discards_writes_on_error(self):
+        """If a handler raises, no write of the batch should be kept."""
+        usage_id = self.runtime.parse_xml_string(
+            '<thumbs/>', self.id_generator)
+        bad_request = vote_request()
+        bad_request.body = json.dumps({})
+        fresh_runtime = RuntimeForTest(student_id=self.STUDENT_ID)
+        with self.assertRaises(KeyError):
+            fresh_runtime.handle_batch([
+                (usage_id, 'vote', vote_request()),
+                (usage_id, 'vote', bad_request)])
+
+        block = RuntimeForTest(student_id=self.STUDENT_ID).get_block(usage_id)
+        self.assertEqual(0, block.upvotes)
+
+    def test_block_classes_come_from_registry(self):
+        """The runtime should look up block classes in its class registry."""
+        usage_id = self.runtime.parse_xml_string(
+            '<html_demo>text</html_demo>', self.id_generator)
+        class_registry = registry.BlockTypeRegistry()
+        fresh_runtime = RuntimeForTest(
+            student_id=self.STUDENT_ID, class_registry=class_registry)
+        fresh_runtime.get_block(usage_id)
+        self.assertEqual(['html_demo'], class_registry.load_times.keys())
+        self.assertEqual(1, fresh_runtime.stats.count('block_class_import'))
+
+    def test_concurrent_requests(self):
+        """Runtimes serving concurrent requests should not share state."""
+        usage_id = self.runtime.parse_xml_string(
+            '<slider_demo/>', self.id_generator)
+        runtime.ID_CACHE.clear()
+        errors = []
+
+        def request(student_number):
+            try:
+                student_runtime = RuntimeForTest(
+                    student_id='student_%d' % student_number)
+                block = student_runtime.get_block(usage_id)
+                block.value = student_number
+                block.save()
+            except Exception as e:  # pylint: disable=broad-except
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=request, args=(n,)) for n in xrange(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([], errors)
+        for student_number in xrange(10):
+            block = RuntimeForTest(
+                student_id='student_%d' % student_number).get_block(usage_id)
+            self.assertEqual(student_number, block.value)
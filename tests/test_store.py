@@ -16,13 +16,17 @@
 
 __author__ = 'John Orr (jorr@google.com)'
 
+import threading
 import unittest
 
 from appengine_xblock_runtime import store
+import appengine_xblock_runtime.cache
 import appengine_xblock_runtime.runtime
 import xblock.exceptions
 import xblock.fields
 import xblock.runtime
+from google.appengine.api import datastore
+from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 
 
@@ -35,11 +39,36 @@ class BaseTestCase(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        appengine_xblock_runtime.runtime.ID_CACHE.clear()
 
     def tearDown(self):
         self.testbed.deactivate()
 
 
+class TestBaseEntity(BaseTestCase):
+    """Unit tests for the entity encoding."""
+
+    def test_reads_legacy_encoding(self):
+        '''Entities with a JSON blob in the legacy data field can be read.'''
+        store.DefinitionEntity(
+            id='legacy', data='{"block_type": "my_block"}').put()
+        definition = store.DefinitionEntity.get_by_id('legacy')
+        self.assertEqual('my_block', definition.block_type)
+
+    def test_migrate_legacy_entities(self):
+        '''Migration should move legacy data into the payload.'''
+        store.UsageEntity(id='legacy', data='{"definition_id": "def"}').put()
+        new_usage = store.UsageEntity(id='new')
+        new_usage.definition_id = 'def'
+        new_usage.put()
+
+        self.assertEqual(1, store.migrate_legacy_entities(store.UsageEntity))
+
+        usage = store.UsageEntity.get_by_id('legacy', use_cache=False)
+        self.assertIsNone(usage.data)
+        self.assertEqual({'definition_id': 'def'}, usage.payload)
+
+
 class TestUsageStore(BaseTestCase):
     """Unit tests for the usage store."""
 
@@ -67,6 +96,46 @@ class TestUsageStore(BaseTestCase):
         except AssertionError:
             pass
 
+    def test_async_create_and_get_usage(self):
+        '''The async variants should create and resolve ids concurrently.'''
+        def_future = self.id_generator.create_definition_async('my_block')
+        other_def_future = self.id_generator.create_definition_async('other')
+        def_id = def_future.get_result()
+        usage_id = self.id_generator.create_usage_async(def_id).get_result()
+
+        block_type_future = self.id_reader.get_block_type_async(
+            other_def_future.get_result())
+        def_id_future = self.id_reader.get_definition_id_async(usage_id)
+        self.assertEqual('other', block_type_future.get_result())
+        self.assertEqual(def_id, def_id_future.get_result())
+
+    def test_resolved_ids_are_cached(self):
+        '''Once resolved, ids should be served from the cache.'''
+        def_id = self.id_generator.create_definition('my_block')
+        usage_id = self.id_generator.create_usage(def_id)
+        appengine_xblock_runtime.runtime.ID_CACHE.clear()
+
+        self.id_reader.get_definition_id(usage_id)
+        self.id_reader.get_block_type(def_id)
+        store.UsageEntity.get_by_id(usage_id).key.delete()
+        store.DefinitionEntity.get_by_id(def_id).key.delete()
+
+        self.assertEqual(def_id, self.id_reader.get_definition_id(usage_id))
+        self.assertEqual('my_block', self.id_reader.get_block_type(def_id))
+        self.assertEqual(2, appengine_xblock_runtime.runtime.ID_CACHE.hits)
+
+    def test_batching_id_generator(self):
+        '''Batched ids should be usable at once but only stored on flush.'''
+        id_generator = appengine_xblock_runtime.runtime.BatchingIdGenerator()
+        def_id = id_generator.create_definition('my_block')
+        usage_id = id_generator.create_usage(def_id)
+        self.assertIsNone(store.UsageEntity.get_by_id(usage_id))
+
+        id_generator.flush()
+        appengine_xblock_runtime.runtime.ID_CACHE.clear()
+        self.assertEqual(def_id, self.id_reader.get_definition_id(usage_id))
+        self.assertEqual('my_block', self.id_reader.get_block_type(def_id))
+
     def test_get_non_existent_usage_raises_exception(self):
         """Should raise NoSuchUsage when non-existent usage_id requested."""
         try:
@@ -158,3 +227,415 @@ class TestKeyValueStore(BaseTestCase):
         '''Should be able to detect absence of key.'''
         key = self._user_state_key()
         self.assertFalse(self.key_value_store.has(key))
+
+    def test_has_result_is_reused_by_get(self):
+        '''A get following a has should not go back to the datastore.'''
+        key = self._user_state_key()
+        store.KeyValueStore().set(key, 'data')
+        self.assertTrue(self.key_value_store.has(key))
+        ndb.Key(store.KeyValueEntity, store.key_string(key)).delete()
+        self.assertEqual('data', self.key_value_store.get(key))
+
+    def test_absent_key_is_remembered(self):
+        '''A key found to be absent should stay absent for the request.'''
+        key = self._user_state_key()
+        self.assertFalse(self.key_value_store.has(key))
+        store.KeyValueStore().set(key, 'data')
+        self.assertFalse(self.key_value_store.has(key))
+        self.assertRaises(KeyError, self.key_value_store.get, key)
+
+    def test_get_many(self):
+        '''Should retrieve all present keys in a batch and omit absent ones.'''
+        key = self._user_state_key()
+        other_key = key._replace(field_name='other_field')
+        self.key_value_store.set(key, 'data')
+        self.assertEqual(
+            {key: 'data'}, self.key_value_store.get_many([key, other_key]))
+
+    def test_prefetch_serves_reads_from_snapshot(self):
+        '''After prefetch, get and has should not go back to the datastore.'''
+        key = self._user_state_key()
+        absent_key = key._replace(field_name='absent_field')
+        store.KeyValueStore().set(key, 'data')
+
+        self.key_value_store.prefetch([key, absent_key])
+        ndb.Key(store.KeyValueEntity, store.key_string(key)).delete()
+        store.KeyValueStore().set(absent_key, 'new_data')
+
+        self.assertEqual('data', self.key_value_store.get(key))
+        self.assertFalse(self.key_value_store.has(absent_key))
+
+    def test_buffered_writes_are_flushed_together(self):
+        '''Buffered writes should be visible locally, and stored on flush.'''
+        key = self._user_state_key()
+        other_key = key._replace(field_name='other_field')
+        store.KeyValueStore().set(other_key, 'old_data')
+
+        self.key_value_store.start_buffering()
+        self.key_value_store.set(key, 'first')
+        self.key_value_store.set(key, 'second')
+        self.key_value_store.delete(other_key)
+
+        self.assertEqual('second', self.key_value_store.get(key))
+        self.assertFalse(self.key_value_store.has(other_key))
+        self.assertFalse(store.KeyValueStore().has(key))
+        self.assertTrue(store.KeyValueStore().has(other_key))
+
+        self.key_value_store.flush()
+        self.assertEqual('second', store.KeyValueStore().get(key))
+        self.assertFalse(store.KeyValueStore().has(other_key))
+
+    def test_discard_drops_buffered_writes(self):
+        '''Discarded writes should never reach the datastore.'''
+        key = self._user_state_key()
+        self.key_value_store.start_buffering()
+        self.key_value_store.set(key, 'data')
+        self.key_value_store.discard()
+
+        self.assertFalse(self.key_value_store.has(key))
+        self.assertFalse(store.KeyValueStore().has(key))
+
+    def test_async_operations(self):
+        '''The async variants should honour the same contract as the sync.'''
+        key = self._user_state_key()
+        self.key_value_store.set_async(key, 'data').get_result()
+        self.assertTrue(self.key_value_store.has_async(key).get_result())
+        self.assertEqual(
+            'data', self.key_value_store.get_async(key).get_result())
+
+        self.key_value_store.delete_async(key).get_result()
+        self.assertFalse(self.key_value_store.has_async(key).get_result())
+        self.assertRaises(
+            KeyError, self.key_value_store.get_async(key).get_result)
+
+    def test_transactional_flush_detects_conflicting_write(self):
+        '''A transactional flush should fail if the value read has changed.'''
+        key = self._user_state_key()
+        store.KeyValueStore().set(key, 1)
+
+        self.assertEqual(1, self.key_value_store.get(key))
+        store.KeyValueStore().set(key, 2)
+
+        self.key_value_store.start_buffering()
+        self.key_value_store.set(key, 3)
+        self.assertRaises(
+            store.ContentionError, self.key_value_store.flush,
+            transactional=True)
+        self.assertEqual(2, store.KeyValueStore().get(key))
+
+    def test_transactional_flush_writes_unchanged_values(self):
+        '''A transactional flush should write if nothing has changed.'''
+        key = self._user_state_key()
+        store.KeyValueStore().set(key, 1)
+
+        self.key_value_store.start_buffering()
+        self.key_value_store.set(key, self.key_value_store.get(key) + 1)
+        self.key_value_store.flush(transactional=True)
+        self.assertEqual(2, store.KeyValueStore().get(key))
+
+    def test_transactional_flush_after_own_write(self):
+        '''A value the store wrote itself should not count as a conflict.'''
+        key = self._user_state_key()
+        store.KeyValueStore().set(key, 1)
+
+        self.assertEqual(1, self.key_value_store.get(key))
+        self.key_value_store.set(key, 2)
+        self.key_value_store.start_buffering()
+        self.key_value_store.set(key, self.key_value_store.get(key) + 1)
+        self.key_value_store.flush(transactional=True)
+        self.assertEqual(3, store.KeyValueStore().get(key))
+
+    def test_transactional_flush_of_many_groups(self):
+        '''Batches over the transaction limit should be refused.'''
+        keys = [
+            xblock.runtime.KeyValueStore.Key(
+                scope=xblock.fields.Scope.user_state, user_id='123',
+                block_scope_id='456', field_name='field%d' % index)
+            for index in xrange(store.MAX_TRANSACTION_GROUPS + 1)]
+        self.key_value_store.start_buffering()
+        for index, key in enumerate(keys):
+            self.key_value_store.set(key, index)
+        self.assertRaises(
+            store.TransactionTooLargeError, self.key_value_store.flush,
+            transactional=True)
+        self.assertFalse(self.key_value_store.buffering)
+        self.assertEqual({}, store.KeyValueStore().get_many(keys))
+
+    def test_transactional_flush_of_consolidated_scope(self):
+        '''Many fields of one block and user should fit a transaction.'''
+        scopes = [xblock.fields.Scope.user_state]
+        keys = [
+            xblock.runtime.KeyValueStore.Key(
+                scope=xblock.fields.Scope.user_state, user_id='123',
+                block_scope_id='456', field_name='field%d' % index)
+            for index in xrange(store.MAX_TRANSACTION_GROUPS + 1)]
+        kvs = store.KeyValueStore(consolidated_scopes=scopes)
+        kvs.start_buffering()
+        for index, key in enumerate(keys):
+            kvs.set(key, index)
+        kvs.flush(transactional=True)
+        self.assertEqual(
+            dict((key, index) for index, key in enumerate(keys)),
+            store.KeyValueStore(consolidated_scopes=scopes).get_many(keys))
+
+        kvs = store.KeyValueStore(consolidated_scopes=scopes)
+        kvs.start_buffering()
+        for key in keys:
+            kvs.set(key, kvs.get(key) + 1)
+        store.KeyValueStore(consolidated_scopes=scopes).set(keys[0], 10)
+        self.assertRaises(
+            store.ContentionError, kvs.flush, transactional=True)
+        self.assertEqual(
+            10, store.KeyValueStore(consolidated_scopes=scopes).get(keys[0]))
+
+
+class TestShardedCounters(BaseTestCase):
+    """Unit tests for sharded counters in the key value store."""
+
+    COUNTERS = {(xblock.fields.Scope.user_state_summary, 'upvotes'): 5}
+
+    def setUp(self):
+        super(TestShardedCounters, self).setUp()
+        self.key_value_store = store.KeyValueStore(
+            sharded_counters=self.COUNTERS)
+        self.key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state_summary, user_id=None,
+            block_scope_id='456', field_name='upvotes')
+
+    def test_concurrent_stores_add_up(self):
+        '''Increments from separate requests should not be lost.'''
+        first = store.KeyValueStore(sharded_counters=self.COUNTERS)
+        second = store.KeyValueStore(sharded_counters=self.COUNTERS)
+        first.prefetch([self.key])
+        second.prefetch([self.key])
+
+        first.set(self.key, 1)
+        second.set(self.key, 1)
+
+        self.assertEqual(2, self.key_value_store.get(self.key))
+        self.assertEqual(
+            {self.key: 2}, store.KeyValueStore(
+                sharded_counters=self.COUNTERS).get_many([self.key]))
+
+    def test_reads_existing_unsharded_value(self):
+        '''A value written before sharding should be included in the total.'''
+        store.KeyValueStore().set(self.key, 10)
+        self.key_value_store.set(self.key, 11)
+        self.assertEqual(11, store.KeyValueStore(
+            sharded_counters=self.COUNTERS).get(self.key))
+
+    def test_buffered_counter_writes(self):
+        '''Buffered deletes and sets of a counter should apply in order.'''
+        self.key_value_store.set(self.key, 3)
+        self.key_value_store.start_buffering()
+        self.key_value_store.delete(self.key)
+        self.key_value_store.set(self.key, 2)
+        self.key_value_store.set(self.key, 4)
+        self.key_value_store.flush()
+
+        self.assertEqual(4, store.KeyValueStore(
+            sharded_counters=self.COUNTERS).get(self.key))
+
+    def test_delete(self):
+        '''Deleting a counter should remove all its shards.'''
+        self.key_value_store.set(self.key, 3)
+        self.key_value_store.delete(self.key)
+        self.assertFalse(store.KeyValueStore(
+            sharded_counters=self.COUNTERS).has(self.key))
+
+    def test_non_numeric_value_rejected(self):
+        '''Only numbers can be stored in a sharded counter.'''
+        self.assertRaises(
+            TypeError, self.key_value_store.set, self.key, 'many')
+
+    def test_only_marked_scope_is_sharded(self):
+        '''Fields of the same name in other scopes should be stored as is.'''
+        for scope, user_id in (
+                (xblock.fields.Scope.user_state, '123'),
+                (xblock.fields.Scope.content, None)):
+            key = xblock.runtime.KeyValueStore.Key(
+                scope=scope, user_id=user_id, block_scope_id='456',
+                field_name='upvotes')
+            self.key_value_store.set(key, 'many')
+            self.assertEqual('many', store.KeyValueStore().get(key))
+        self.assertEqual(0, store.CounterShardEntity.query().count())
+
+
+class TestCachePolicy(BaseTestCase):
+    """Unit tests for the per-scope cache policy of the key value store."""
+
+    def setUp(self):
+        super(TestCachePolicy, self).setUp()
+        self.policy = store.CachePolicy(
+            {xblock.fields.Scope.content: store.CacheOptions(
+                use_cache=False, use_memcache=False, process_ttl=60)},
+            process_cache=appengine_xblock_runtime.cache.LRUCache())
+        self.key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.content, user_id=None,
+            block_scope_id='456', field_name='content')
+
+    def test_process_cache_serves_reads(self):
+        '''Values should be served from the in-process cache once read.'''
+        store.KeyValueStore().set(self.key, 'text')
+        self.assertEqual(
+            'text', store.KeyValueStore(cache_policy=self.policy).get(self.key))
+        ndb.Key(store.KeyValueEntity, store.key_string(self.key)).delete()
+
+        self.assertEqual(
+            'text', store.KeyValueStore(cache_policy=self.policy).get(self.key))
+        stats = self.policy.stats()[xblock.fields.Scope.content]
+        self.assertEqual(1, stats['process_hits'])
+        self.assertEqual(1, stats['ndb_reads'])
+
+    def test_write_invalidates_process_cache(self):
+        '''Writing a value should remove it from the in-process cache.'''
+        kvs = store.KeyValueStore(cache_policy=self.policy)
+        self.assertFalse(kvs.has(self.key))
+        store.KeyValueStore(cache_policy=self.policy).set(self.key, 'text')
+        self.assertEqual(
+            'text', store.KeyValueStore(cache_policy=self.policy).get(self.key))
+
+    def test_concurrent_counts_add_up(self):
+        '''Counts recorded from many threads should not be lost.'''
+        scope = xblock.fields.Scope.content
+
+        def worker():
+            for _ in xrange(1000):
+                self.policy.record(scope, 'process_hits')
+
+        threads = [threading.Thread(target=worker) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(8000, self.policy.stats()[scope]['process_hits'])
+
+
+class TestFieldGroups(BaseTestCase):
+    """Unit tests for stores which consolidate scopes into field groups."""
+
+    def setUp(self):
+        super(TestFieldGroups, self).setUp()
+        self.scopes = [xblock.fields.Scope.user_state]
+        self.key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state, user_id='123',
+            block_scope_id='456', field_name='my_field')
+        self.other_key = self.key._replace(field_name='other_field')
+
+    def _consolidating_store(self):
+        return store.KeyValueStore(consolidated_scopes=self.scopes)
+
+    def test_fields_are_stored_together(self):
+        '''All of a user's fields for a block should share one entity.'''
+        kvs = self._consolidating_store()
+        kvs.set_many({self.key: 'a', self.other_key: 'b'})
+
+        self.assertEqual(1, store.FieldGroupEntity.query().count())
+        self.assertEqual(0, store.KeyValueEntity.query().count())
+        self.assertEqual(
+            {self.key: 'a', self.other_key: 'b'},
+            self._consolidating_store().get_many([self.key, self.other_key]))
+
+    def test_concurrent_sets_of_a_group(self):
+        '''Sets of two fields of a group run together should keep both.'''
+        kvs = self._consolidating_store()
+        ndb.Future.wait_all([
+            kvs.set_async(self.key, 'a'), kvs.set_async(self.other_key, 'b')])
+        self.assertEqual(
+            {self.key: 'a', self.other_key: 'b'},
+            self._consolidating_store().get_many([self.key, self.other_key]))
+
+    def test_contract(self):
+        '''Grouped fields should honour the get/set/has/delete contract.'''
+        self._consolidating_store().set(self.key, 'a')
+        self._consolidating_store().set(self.other_key, 'b')
+
+        kvs = self._consolidating_store()
+        self.assertTrue(kvs.has(self.key))
+        kvs.delete(self.key)
+        self.assertFalse(kvs.has(self.key))
+
+        kvs = self._consolidating_store()
+        self.assertRaises(KeyError, kvs.get, self.key)
+        self.assertEqual('b', kvs.get(self.other_key))
+
+        kvs.delete(self.other_key)
+        self.assertEqual(0, store.FieldGroupEntity.query().count())
+
+    def test_migrate_to_field_groups(self):
+        '''Per-field rows should be copied into field groups.'''
+        store.KeyValueStore().set(self.key, 'a')
+        store.KeyValueStore().set(self.other_key, 'b')
+        self._consolidating_store().set(self.key, 'new')
+
+        self.assertEqual(2, store.migrate_to_field_groups(delete_old=True))
+        self.assertEqual(0, store.KeyValueEntity.query().count())
+        self.assertEqual(
+            {self.key: 'new', self.other_key: 'b'},
+            self._consolidating_store().get_many([self.key, self.other_key]))
+
+
+class TestStateScans(BaseTestCase):
+    """Unit tests for listing the state of a user or of a block."""
+
+    def setUp(self):
+        super(TestStateScans, self).setUp()
+        self.user_key = xblock.runtime.KeyValueStore.Key(
+            scope=xblock.fields.Scope.user_state, user_id='user1',
+            block_scope_id='block1', field_name='answer')
+        kvs = store.KeyValueStore()
+        kvs.set(self.user_key, 'a')
+        kvs.set(self.user_key._replace(user_id='user2'), 'b')
+        kvs.set(self.user_key._replace(block_scope_id='block2'), 'c')
+        kvs.set(self.user_key._replace(
+            scope=xblock.fields.Scope.settings, user_id=None), 'd')
+        store.KeyValueStore(
+            consolidated_scopes=[xblock.fields.Scope.user_state]).set(
+                self.user_key._replace(
+                    block_scope_id='block3', field_name='grouped'), 'e')
+
+    def test_entities_are_indexed(self):
+        """Puts should set the block and user properties from the key."""
+        kv_entity = store.KeyValueEntity.get_by_id('usage.block1.user1.answer')
+        self.assertEqual('usage', kv_entity.block_scope)
+        self.assertEqual('block1', kv_entity.block_id)
+        self.assertEqual('user1', kv_entity.user_id)
+        settings = store.KeyValueEntity.get_by_id('usage.block1.answer')
+        self.assertIsNone(settings.user_id)
+
+    def test_iter_user_state(self):
+        """Should list a user's fields from both rows and groups."""
+        self.assertEqual([
+            ('usage.block1.user1.answer', 'a'),
+            ('usage.block2.user1.answer', 'c'),
+            ('usage.block3.user1.grouped', 'e')],
+            sorted(store.iter_user_state('user1', batch_size=1)))
+
+    def test_iter_block_state(self):
+        """Should list all users' fields for a block."""
+        self.assertEqual([
+            ('usage.block1.user1.answer', 'a'),
+            ('usage.block1.user2.answer', 'b')],
+            sorted(store.iter_block_state('block1', batch_size=1)))
+        self.assertEqual(3, len(list(
+            store.iter_block_state('block1', users_only=False))))
+
+    def test_delete_user_state(self):
+        """Should delete every entity holding the user's state."""
+        self.assertEqual(3, store.delete_user_state('user1', batch_size=1))
+        self.assertEqual([], list(store.iter_user_state('user1')))
+        self.assertEqual(
+            [('usage.block1.user2.answer', 'b')],
+            list(store.iter_user_state('user2')))
+
+    def test_index_scoped_entities(self):
+        """Entities written without the index properties should gain them."""
+        datastore.Put(datastore.Entity(
+            'KeyValueEntity', name='usage.block9.user9.answer'))
+
+        self.assertEqual(
+            1, store.index_scoped_entities(store.KeyValueEntity))
+        self.assertEqual(
+            'user9',
+            store.KeyValueEntity.get_by_id('usage.block9.user9.answer').user_id)